@@ -0,0 +1,119 @@
+import asyncio
+import datetime
+import logging
+import random
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+import discord
+from redbot.core import Config
+from redbot.core.bot import Red
+
+log = logging.getLogger("red.vcraycogs.serverbackup.autobackup")
+
+
+def select_evictions(entries: Iterable[dict], *, keep_last: int = 0, keep_daily: int = 0, keep_weekly: int = 0) -> List[str]:
+    """
+    The ids of the backups a retention policy doesn't keep.
+
+    `entries` are backup index entries. The newest `keep_last` backups are kept, along with
+    the newest backup of each of the last `keep_daily` days and `keep_weekly` weeks that have one."""
+    entries = sorted(entries, key=lambda e: e["created_at"], reverse=True)
+    keep = {e["id"] for e in entries[:max(keep_last, 0)]}
+
+    def thin(period: Callable[[datetime.datetime], tuple], count: int):
+        seen = set()
+        for entry in entries:
+            if len(seen) >= count:
+                return
+            key = period(datetime.datetime.fromtimestamp(entry["created_at"]))
+            if key not in seen:
+                seen.add(key)
+                keep.add(entry["id"])
+
+    thin(lambda d: (d.year, d.month, d.day), keep_daily)
+    thin(lambda d: tuple(d.isocalendar()[:2]), keep_weekly)
+
+    return [e["id"] for e in entries if e["id"] not in keep]
+
+
+class AutoBackupScheduler:
+    """
+    Makes periodic backups of the guilds that turned them on.
+
+    Each guild's next backup is set to one interval after its last one, moved by
+    a random jitter, and a guild's first backup is placed at a random point within
+    the interval. That way backups of many guilds spread out instead of all starting
+    at once, and at most `auto_backup_concurrency` of them run at the same time."""
+    def __init__(
+        self,
+        bot: Red,
+        config: Config,
+        backup: Callable[[discord.Guild], Awaitable[None]],
+        *,
+        tick: int = 60,
+        jitter: float = 0.1,
+    ) -> None:
+        self.bot = bot
+        self.config = config
+        self.backup = backup
+        self.tick = tick
+        self.jitter = jitter # fraction of the interval the next run can move either way
+        self.task: Optional[asyncio.Task] = None
+        self._running: Dict[int, asyncio.Task] = {}
+
+    def next_run(self, interval: int, last: Optional[float] = None) -> float:
+        now = datetime.datetime.now().timestamp()
+        if last is None:
+            return now + random.uniform(0, interval)
+        return max(last + interval + random.uniform(-self.jitter, self.jitter) * interval, now)
+
+    def start(self):
+        self.task = asyncio.create_task(self._loop())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+        for task in self._running.values():
+            task.cancel()
+
+    async def _loop(self):
+        await self.bot.wait_until_red_ready()
+        while True:
+            try:
+                await self._check()
+            except Exception as e:
+                log.exception("Error while checking for due auto backups.", exc_info=e)
+            await asyncio.sleep(self.tick)
+
+    async def _check(self):
+        now = datetime.datetime.now().timestamp()
+        limit = max(await self.config.auto_backup_concurrency(), 1)
+        for guild_id, data in (await self.config.all_guilds()).items():
+            interval = data.get("auto_backup_interval")
+            if not interval or guild_id in self._running:
+                continue
+
+            if (guild := self.bot.get_guild(guild_id)) is None:
+                continue
+
+            due = data.get("next_auto_backup")
+            if due is None:
+                # first run for this guild, put it somewhere in the interval.
+                await self.config.guild(guild).next_auto_backup.set(self.next_run(interval))
+                continue
+
+            # guilds over the limit are still due and get picked up on a later tick.
+            if due <= now and len(self._running) < limit:
+                self._running[guild_id] = asyncio.create_task(self._run(guild, interval))
+
+    async def _run(self, guild: discord.Guild, interval: int):
+        try:
+            await self.backup(guild)
+        except Exception as e:
+            log.exception("Auto backup of guild %s failed.", guild.id, exc_info=e)
+        finally:
+            # failed backups wait for the next interval too, so a broken guild can't be retried every tick.
+            now = datetime.datetime.now().timestamp()
+            await self.config.guild(guild).last_auto_backup.set(now)
+            await self.config.guild(guild).next_auto_backup.set(self.next_run(interval, now))
+            self._running.pop(guild.id, None)
@@ -0,0 +1,588 @@
+"""
+Offline benchmarks for capturing and restoring backups.
+
+Runs `Template.from_guild`, `GuildMirror.snapshot`, `history.capture_backup` (a full and an incremental one),
+`Template.json`, `Template.from_json`, the compact encoding, `Template.apply_to_guild` and `plan_reconcile` against an in-memory stand-in for `discord.Guild` that
+records every API call and can simulate latency and rate limits. Nothing touches the network.
+
+    python -m serverbackup.benchmark --roles 100 --categories 20 --channels 10 --messages 3 --latency 0.05
+    python -m serverbackup.benchmark --messages 2000 --history 1000
+    python -m serverbackup.benchmark --duplicates 3
+"""
+import argparse
+import asyncio
+import copy
+import itertools
+import json
+import logging
+import random
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+import discord
+
+from . import serialization
+from .chunks import ChunkedBackups
+from .history import capture_backup
+from .instrumentation import Instrumentation, OperationReport
+from .mirror import MAX_MESSAGES, GuildMirror
+from .models import Template
+from .reconcile import plan_reconcile
+from .storage import open_store
+
+_ids = itertools.count(100000000000000000)
+_http_log = logging.getLogger("discord.http")
+
+
+class FakeAPI:
+    """
+    Records the API calls made against the fake guild.
+
+    Every call waits `latency` seconds, and with a chance of `ratelimit_chance` it is
+    answered with a 429 first and retried after `retry_after` seconds like discord.py would."""
+    def __init__(self, *, latency: float = 0.0, ratelimit_chance: float = 0.0, retry_after: float = 0.5, seed: int = 0) -> None:
+        self.latency = latency
+        self.ratelimit_chance = ratelimit_chance
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.calls: Counter = Counter()
+        self.ratelimits = 0
+        self.ratelimit_wait = 0.0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    @property
+    def total(self):
+        return sum(self.calls.values())
+
+    def reset(self):
+        self.calls.clear()
+        self.ratelimits = 0
+        self.ratelimit_wait = 0.0
+        self.max_in_flight = 0
+
+    async def request(self, route: str):
+        self.calls[route] += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            while self.ratelimit_chance and self.random.random() < self.ratelimit_chance:
+                self.ratelimits += 1
+                self.ratelimit_wait += self.retry_after
+                # the same warning discord.py logs, so instrumentation sees fake rate limits too.
+                _http_log.warning('We are being rate limited. Retrying in %.2f seconds. Handled under the bucket "%s"', self.retry_after, route)
+                await asyncio.sleep(self.retry_after)
+            if self.latency:
+                await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+
+
+class FakeUser:
+    def __init__(self, name: str) -> None:
+        self.id = next(_ids)
+        self.name = name
+        self.discriminator = "0001"
+        self.avatar_url = f"https://cdn.discordapp.com/avatars/{self.id}/avatar.png"
+
+    def __str__(self):
+        return f"{self.name}#{self.discriminator}"
+
+
+class FakeMessage:
+    def __init__(self, author: FakeUser, content: str, embeds: List[discord.Embed] = ()) -> None:
+        self.id = next(_ids)
+        self.author = author
+        self.content = content
+        self.embeds = list(embeds)
+        self.attachments = []
+
+
+class FakeRole:
+    def __init__(self, guild: "FakeGuild", name: str, position: int, **kwargs) -> None:
+        self.guild = guild
+        self.id = kwargs.get("id") or next(_ids)
+        self.name = name
+        self.position = position
+        self.colour = self.color = kwargs.get("colour") or discord.Colour.default()
+        self.hoist = kwargs.get("hoist", False)
+        self.mentionable = kwargs.get("mentionable", False)
+        self.permissions = kwargs.get("permissions") or discord.Permissions.none()
+        self.managed = False
+
+    def __repr__(self):
+        return f"<FakeRole name={self.name!r} position={self.position}>"
+
+    def __lt__(self, other):
+        return self.position < other.position
+
+    def __le__(self, other):
+        return self.position <= other.position
+
+    def is_default(self):
+        return self.id == self.guild.id
+
+    def is_bot_managed(self):
+        return False
+
+    def is_integration(self):
+        return False
+
+    def is_premium_subscriber(self):
+        return False
+
+    async def delete(self, *, reason=None):
+        await self.guild.api.request("DELETE /guilds/{guild_id}/roles/{role_id}")
+        self.guild.roles.remove(self)
+
+    async def edit(self, *, reason=None, **fields):
+        await self.guild.api.request("PATCH /guilds/{guild_id}/roles/{role_id}")
+        for key, value in fields.items():
+            setattr(self, "colour" if key == "color" else key, value)
+        self.color = self.colour
+
+
+class FakeWebhook:
+    def __init__(self, channel: "FakeChannel", name: str) -> None:
+        self.id = next(_ids)
+        self.channel = channel
+        self.name = name
+        self.token = "token"
+
+    async def send(self, content=None, *, username=None, avatar_url=None, embeds=None, files=None, **kwargs):
+        await self.channel.guild.api.request("POST /webhooks/{webhook_id}/{webhook_token}")
+        self.channel.messages.append(FakeMessage(FakeUser(username or self.name), content or "", embeds or ()))
+
+    async def edit(self, **kwargs):
+        await self.channel.guild.api.request("PATCH /webhooks/{webhook_id}")
+
+
+class FakeChannel:
+    def __init__(self, guild: "FakeGuild", name: str, type: discord.ChannelType, position: int, **kwargs) -> None:
+        self.guild = guild
+        self.id = next(_ids)
+        self.name = name
+        self.type = type
+        self.position = position
+        self.topic = kwargs.get("topic")
+        self.category: Optional[FakeChannel] = kwargs.get("category")
+        self.overwrites: Dict[Any, discord.PermissionOverwrite] = kwargs.get("overwrites") or {}
+        self.messages: List[FakeMessage] = kwargs.get("messages") or []
+        self._webhooks: List[FakeWebhook] = []
+
+    def __repr__(self):
+        return f"<FakeChannel name={self.name!r} type={self.type.name}>"
+
+    @property
+    def channels(self):
+        return sorted((c for c in self.guild.channels if c.category is self), key=lambda c: c.position)
+
+    @property
+    def category_id(self):
+        return self.category.id if self.category is not None else None
+
+    async def history(self, *, limit=100, before=None, after=None, oldest_first=None):
+        # newest first unless only `after` is given, one request per 100 messages like the real thing.
+        messages = [m for m in self.messages if (before is None or m.id < before.id) and (after is None or m.id > after.id)]
+        if oldest_first is None:
+            oldest_first = after is not None
+        messages = (messages if oldest_first else messages[::-1])[:limit]
+        for page in range(0, max(len(messages), 1), 100):
+            await self.guild.api.request("GET /channels/{channel_id}/messages")
+            for message in messages[page:page + 100]:
+                yield message
+
+    async def delete(self, *, reason=None):
+        await self.guild.api.request("DELETE /channels/{channel_id}")
+        self.guild.channels.remove(self)
+
+    async def edit(self, *, reason=None, **fields):
+        await self.guild.api.request("PATCH /channels/{channel_id}")
+        for key, value in fields.items():
+            setattr(self, key, value)
+
+    async def send(self, content=None, **kwargs):
+        await self.guild.api.request("POST /channels/{channel_id}/messages")
+        message = FakeMessage(self.guild.me, content or "")
+        self.messages.append(message)
+        return message
+
+    async def create_webhook(self, *, name, **kwargs):
+        await self.guild.api.request("POST /channels/{channel_id}/webhooks")
+        webhook = FakeWebhook(self, name)
+        self._webhooks.append(webhook)
+        return webhook
+
+    async def webhooks(self):
+        await self.guild.api.request("GET /channels/{channel_id}/webhooks")
+        return list(self._webhooks)
+
+    async def create_text_channel(self, name, **kwargs):
+        return await self.guild.create_text_channel(name, category=self, **kwargs)
+
+    async def create_voice_channel(self, name, **kwargs):
+        return await self.guild.create_voice_channel(name, category=self, **kwargs)
+
+
+class FakeMember(FakeUser):
+    def __init__(self, guild: "FakeGuild", name: str) -> None:
+        super().__init__(name)
+        self.guild = guild
+        self.roles: List[FakeRole] = []
+
+    @property
+    def top_role(self):
+        return max(self.roles, key=lambda r: r.position, default=self.guild.default_role)
+
+    async def add_roles(self, *roles, reason=None):
+        for _ in roles:
+            await self.guild.api.request("PUT /guilds/{guild_id}/members/{user_id}/roles/{role_id}")
+        self.roles.extend(roles)
+
+
+class FakeHTTP:
+    def __init__(self, guild: "FakeGuild") -> None:
+        self.guild = guild
+
+    async def bulk_channel_update(self, guild_id, data, *, reason=None):
+        await self.guild.api.request("PATCH /guilds/{guild_id}/channels")
+        channels = {c.id: c for c in self.guild.channels}
+        for entry in data:
+            channel = channels[entry["id"]]
+            channel.position = entry.get("position", channel.position)
+
+
+class FakeState:
+    def __init__(self, guild: "FakeGuild") -> None:
+        self.http = FakeHTTP(guild)
+
+
+class FakeGuild:
+    """
+    Enough of `discord.Guild` for capturing and restoring backups."""
+    def __init__(self, api: Optional[FakeAPI] = None, name: str = "Benchmark Guild") -> None:
+        self.api = api or FakeAPI()
+        self.id = next(_ids)
+        self.name = name
+        self.roles: List[FakeRole] = []
+        self.channels: List[FakeChannel] = []
+        self._state = FakeState(self)
+        self.default_role = FakeRole(self, "@everyone", 0, id=self.id)
+        self.roles.append(self.default_role)
+        self.me = FakeMember(self, "Server Backup")
+        bot_role = FakeRole(self, "Server Backup", 1)
+        bot_role.managed = True
+        bot_role.is_bot_managed = lambda: True
+        self.roles.append(bot_role)
+        self.me.roles.append(bot_role)
+
+    @property
+    def categories(self):
+        return [c for c in self.channels if c.type is discord.ChannelType.category]
+
+    @property
+    def text_channels(self):
+        return [c for c in self.channels if c.type is discord.ChannelType.text]
+
+    def get_role(self, id):
+        return discord.utils.get(self.roles, id=id)
+
+    def get_channel(self, id):
+        return discord.utils.get(self.channels, id=id)
+
+    def _bump_roles(self):
+        # new roles go right above @everyone, the way discord does it.
+        for role in self.roles:
+            if not role.is_default():
+                role.position += 1
+
+    async def create_role(self, *, name="new role", reason=None, **fields):
+        await self.api.request("POST /guilds/{guild_id}/roles")
+        self._bump_roles()
+        role = FakeRole(self, name, 1, **fields)
+        self.roles.append(role)
+        return role
+
+    async def edit_role_positions(self, positions, *, reason=None):
+        await self.api.request("PATCH /guilds/{guild_id}/roles")
+        for role, position in positions.items():
+            role.position = position
+
+    async def create_category(self, name, *, overwrites=None, reason=None, position=None):
+        await self.api.request("POST /guilds/{guild_id}/channels")
+        channel = FakeChannel(self, name, discord.ChannelType.category, position or 0, overwrites=overwrites)
+        self.channels.append(channel)
+        return channel
+
+    async def create_text_channel(self, name, *, overwrites=None, category=None, reason=None, position=None, topic=None, **kwargs):
+        await self.api.request("POST /guilds/{guild_id}/channels")
+        channel = FakeChannel(self, name, discord.ChannelType.text, position or 0, overwrites=overwrites, category=category, topic=topic)
+        self.channels.append(channel)
+        return channel
+
+    async def create_voice_channel(self, name, *, overwrites=None, category=None, reason=None, position=None, **kwargs):
+        await self.api.request("POST /guilds/{guild_id}/channels")
+        channel = FakeChannel(self, name, discord.ChannelType.voice, position or 0, overwrites=overwrites, category=category)
+        self.channels.append(channel)
+        return channel
+
+
+def make_guild(
+    *,
+    roles: int = 50,
+    categories: int = 10,
+    channels: int = 10,
+    uncategorised: int = 5,
+    messages: int = 3,
+    duplicates: int = 0,
+    api: Optional[FakeAPI] = None,
+    seed: int = 0,
+) -> FakeGuild:
+    """
+    Build a synthetic guild with `channels` channels in each of `categories` categories,
+    `uncategorised` more at the top level and `messages` messages in every text channel.
+
+    `duplicates` adds that many roles and categories named like existing ones, and that many
+    voice channels called Lounge to every category."""
+    rand = random.Random(seed)
+    guild = FakeGuild(api)
+    authors = [FakeUser(f"user{i}") for i in range(20)]
+
+    made_roles = []
+    for i in range(roles):
+        role = FakeRole(
+            guild, f"role {i}", i + 1,
+            colour=discord.Colour(rand.randrange(0xFFFFFF)),
+            hoist=rand.random() < 0.2,
+            permissions=discord.Permissions(rand.getrandbits(32)),
+        )
+        made_roles.append(role)
+    for i in range(duplicates):
+        made_roles.append(FakeRole(guild, f"role {i % max(roles, 1)}", roles + i + 1))
+    # the bot's role sits on top so every other role is valid for a template
+    guild.me.roles[0].position = len(made_roles) + 1
+    guild.roles.extend(made_roles)
+
+    def overwrites():
+        chosen = rand.sample(made_roles, min(len(made_roles), 3))
+        result = {guild.default_role: discord.PermissionOverwrite(read_messages=rand.random() < 0.5)}
+        result.update({role: discord.PermissionOverwrite(send_messages=True, manage_messages=False) for role in chosen})
+        return result
+
+    def fill(channel: FakeChannel):
+        for m in range(messages):
+            embeds = [discord.Embed(title=f"embed {m}", description="x" * 50)] if m % 3 == 0 else []
+            channel.messages.append(FakeMessage(rand.choice(authors), f"message {m} in {channel.name}", embeds))
+
+    position = 0
+    for c in range(categories + duplicates):
+        category = FakeChannel(guild, f"category {c % max(categories, 1)}", discord.ChannelType.category, c, overwrites=overwrites())
+        guild.channels.append(category)
+        for i in range(duplicates):
+            guild.channels.append(FakeChannel(guild, "Lounge", discord.ChannelType.voice, position, category=category))
+            position += 1
+        for i in range(channels if c < categories else 0):
+            type = discord.ChannelType.voice if i % 5 == 4 else discord.ChannelType.text
+            channel = FakeChannel(guild, f"channel-{c}-{i}", type, position, category=category, overwrites=overwrites(), topic=f"topic {c}-{i}")
+            position += 1
+            guild.channels.append(channel)
+            if type is discord.ChannelType.text:
+                fill(channel)
+
+    for i in range(uncategorised):
+        channel = FakeChannel(guild, f"channel-{i}", discord.ChannelType.text, position, overwrites=overwrites())
+        position += 1
+        guild.channels.append(channel)
+        fill(channel)
+
+    return guild
+
+
+class BenchmarkResult:
+    def __init__(self, name: str, seconds: float, peak_memory: int, api: Optional[FakeAPI] = None, report: Optional[OperationReport] = None, **kwargs) -> None:
+        self.name = name
+        self.report = report
+        self.seconds = seconds
+        self.peak_memory = peak_memory
+        self.loop_stall: float = kwargs.get("loop_stall", 0.0) # longest time the event loop couldn't run anything else
+        self.api_calls = dict(api.calls) if api else {}
+        self.ratelimits = api.ratelimits if api else 0
+        self.max_in_flight = api.max_in_flight if api else 0
+
+    @property
+    def json(self):
+        return {
+            "name": self.name,
+            "seconds": round(self.seconds, 6),
+            "peak_memory": self.peak_memory,
+            "loop_stall": round(self.loop_stall, 6),
+            "api_calls": sum(self.api_calls.values()),
+            "api_calls_by_route": self.api_calls,
+            "ratelimits": self.ratelimits,
+            "max_in_flight": self.max_in_flight,
+            "phases": self.report.json["phases"] if self.report else [],
+        }
+
+    def __str__(self):
+        return (
+            f"{self.name:<16} {self.seconds * 1000:>10.1f} ms {self.peak_memory / 1024:>10.1f} KiB "
+            f"{self.loop_stall * 1000:>8.1f} ms stall {sum(self.api_calls.values()):>7} calls {self.ratelimits:>5} 429s {self.max_in_flight:>4} max in flight"
+        )
+
+
+async def _measure(name: str, func, api: Optional[FakeAPI] = None, report: Optional[OperationReport] = None):
+    if api is not None:
+        api.reset()
+
+    # a ticker that notices whenever the loop was blocked for longer than it sleeps
+    stall = 0.0
+    running = True
+
+    async def ticker(interval: float = 0.001):
+        nonlocal stall
+        last = time.perf_counter()
+        while running:
+            await asyncio.sleep(interval)
+            now = time.perf_counter()
+            stall = max(stall, now - last - interval)
+            last = now
+
+    tick = asyncio.ensure_future(ticker())
+    await asyncio.sleep(0)
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = func()
+        if asyncio.iscoroutine(result):
+            result = await result
+        seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        await asyncio.sleep(0.002)
+        running = False
+        await tick
+
+    if report is not None:
+        report.finish()
+    return result, BenchmarkResult(name, seconds, peak, api, report, loop_stall=stall)
+
+
+async def run_benchmarks(*, concurrency: int = 5, latency: float = 0.0, ratelimit_chance: float = 0.0, seed: int = 0, history: int = 3, **guild_options) -> List[BenchmarkResult]:
+    instrumentation = Instrumentation()
+    instrumentation.install()
+    try:
+        return await _run_benchmarks(concurrency, latency, ratelimit_chance, seed, history, **guild_options)
+    finally:
+        instrumentation.uninstall()
+
+
+async def _run_benchmarks(concurrency: int, latency: float, ratelimit_chance: float, seed: int, history: int, **guild_options) -> List[BenchmarkResult]:
+    api = FakeAPI(latency=latency, ratelimit_chance=ratelimit_chance, seed=seed)
+    guild = make_guild(api=api, seed=seed, **guild_options)
+    results = []
+
+    report = OperationReport("create", guild.id)
+    template, result = await _measure("from_guild", lambda: Template.from_guild(guild, guild.me, concurrency=concurrency, report=report, history=history), api, report)
+    results.append(result)
+
+    mirror = GuildMirror(guild, messages=min(history, MAX_MESSAGES))
+    await mirror.build(concurrency=concurrency)
+    _, result = await _measure("mirror snapshot", lambda: mirror.snapshot(guild.me), api)
+    results.append(result)
+
+    with tempfile.TemporaryDirectory() as path:
+        backups = ChunkedBackups(open_store("sqlite", path))
+
+        async def capture(previous=None):
+            writer, captured = await capture_backup(guild, guild.me, backups, depth=history, concurrency=concurrency, previous=previous)
+            await writer.finish()
+            return captured
+
+        # the second one only asks for messages newer than the first one has
+        captured, result = await _measure("capture_backup", capture, api)
+        results.append(result)
+        _, result = await _measure("capture_backup (incremental)", lambda: capture(captured), api)
+        results.append(result)
+        backups.store.close()
+
+    data, result = await _measure("json", lambda: template.json)
+    results.append(result)
+
+    # from_json changes the dict it gets, so give it a copy made outside the measurement.
+    raw = copy.deepcopy(data)
+    _, result = await _measure("from_json", lambda: Template.from_json(raw))
+    results.append(result)
+
+    encoded, result = await _measure("encode", lambda: serialization.encode(template))
+    results.append(result)
+
+    _, result = await _measure("decode", lambda: serialization.decode(encoded))
+    results.append(result)
+
+    _, result = await _measure("decode (lazy)", lambda: serialization.decode(encoded, lazy=True))
+    results.append(result)
+
+    _, result = await _measure("decode_async", lambda: serialization.decode_async(encoded))
+    results.append(result)
+
+    target = make_guild(api=api, seed=seed + 1, **guild_options)
+    report = OperationReport("restore", target.id, template.id)
+    _, result = await _measure("apply_to_guild", lambda: template.apply_to_guild(target, concurrency=concurrency, report=report), api, report)
+    results.append(result)
+
+    # a guild that was restored from something else, only what differs is changed. it has none of the
+    # duplicate names, so every role, category and channel that shares one with another is created.
+    target = make_guild(api=api, seed=seed + 2, **{**guild_options, "duplicates": 0})
+    _, result = await _measure("reconcile", lambda: plan_reconcile(template, target, concurrency=concurrency).apply(), api)
+    results.append(result)
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m serverbackup.benchmark", description="Benchmark backups against a fake guild.")
+    parser.add_argument("--roles", type=int, default=50)
+    parser.add_argument("--categories", type=int, default=10)
+    parser.add_argument("--channels", type=int, default=10, help="channels in each category")
+    parser.add_argument("--uncategorised", type=int, default=5)
+    parser.add_argument("--messages", type=int, default=3, help="messages in each text channel")
+    parser.add_argument("--history", type=int, default=3, help="messages captured from each text channel")
+    parser.add_argument("--duplicates", type=int, default=0, help="roles, categories and voice channels per category whose names repeat")
+    parser.add_argument("--concurrency", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds every fake API call takes")
+    parser.add_argument("--ratelimit-chance", type=float, default=0.0, help="chance of a call getting a 429 first")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the results as json")
+    parser.add_argument("--phases", action="store_true", help="also print the time and API calls of each phase")
+    args = parser.parse_args(argv)
+
+    results = asyncio.run(run_benchmarks(
+        roles=args.roles,
+        categories=args.categories,
+        channels=args.channels,
+        uncategorised=args.uncategorised,
+        messages=args.messages,
+        duplicates=args.duplicates,
+        concurrency=args.concurrency,
+        latency=args.latency,
+        ratelimit_chance=args.ratelimit_chance,
+        seed=args.seed,
+        history=args.history,
+    ))
+
+    if args.json:
+        print(json.dumps([r.json for r in results], indent=2))
+    else:
+        for r in results:
+            print(r)
+            if args.phases and r.report:
+                for p in r.report.phases.values():
+                    print(f"    {p.name:<20} {p.duration * 1000:>10.1f} ms {p.api_calls:>7} calls {p.retries:>5} retries")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import asyncio
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional
+
+import aiohttp
+
+
+class AssetCache:
+    """
+    On-disk cache of attachments keyed by the sha256 of their content.
+
+    The same file downloaded from several urls is only stored once and the least
+    recently used files are evicted once the cache grows past `max_size` bytes.
+    All downloads go through the session the cog owns. Which url has which file is
+    only written to disk on `flush`."""
+    def __init__(self, path: Path, session: aiohttp.ClientSession, *, max_size: int = 500 * 1024 * 1024) -> None:
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.session = session
+        self.max_size = max_size
+        self._urls_file = self.path / "urls.json"
+        self._lock = asyncio.Lock()
+
+        # hash -> size, oldest first. file mtimes are bumped on use so the order survives restarts.
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        for file in sorted(self.path.glob("*.bin"), key=lambda f: f.stat().st_mtime):
+            self._entries[file.stem] = file.stat().st_size
+
+        try:
+            self._urls: Dict[str, str] = json.loads(self._urls_file.read_text())
+        except (FileNotFoundError, ValueError):
+            self._urls = {}
+        self._dirty = False # the urls changed since they were last written
+
+    @property
+    def size(self):
+        return sum(self._entries.values())
+
+    def _file(self, digest: str) -> Path:
+        return self.path / f"{digest}.bin"
+
+    def __contains__(self, digest: str):
+        return digest in self._entries
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    def _touch(self, digest: str):
+        self._entries.move_to_end(digest)
+        try:
+            os.utime(self._file(digest))
+        except FileNotFoundError:
+            self._entries.pop(digest, None)
+
+    async def get(self, digest: str) -> Optional[bytes]:
+        if digest not in self._entries:
+            return None
+
+        self._touch(digest)
+        try:
+            return await self._run(self._file(digest).read_bytes)
+        except FileNotFoundError:
+            self._entries.pop(digest, None)
+            return None
+
+    async def put(self, data: bytes, *, url: Optional[str] = None) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        async with self._lock:
+            if digest in self._entries:
+                self._touch(digest)
+            else:
+                await self._run(self._file(digest).write_bytes, data)
+                self._entries[digest] = len(data)
+
+            if url is not None and self._urls.get(url) != digest:
+                self._urls[url] = digest
+                self._dirty = True
+
+            await self._evict()
+
+        return digest
+
+    async def flush(self):
+        """
+        Write the urls to disk if they changed, done once a capture is over instead of on every `put`."""
+        async with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            await self._run(self._urls_file.write_text, json.dumps(self._urls))
+
+    async def _evict(self):
+        evicted = set()
+        while self._entries and sum(self._entries.values()) > self.max_size:
+            digest, _ = self._entries.popitem(last=False)
+            evicted.add(digest)
+            await self._run(self._unlink, digest)
+
+        if evicted:
+            self._urls = {url: digest for url, digest in self._urls.items() if digest not in evicted}
+            self._dirty = True
+
+    def _unlink(self, digest: str):
+        try:
+            self._file(digest).unlink()
+        except FileNotFoundError:
+            pass
+
+    async def download(self, url: str, *, max_size: Optional[int] = None) -> Optional[str]:
+        """
+        Download `url` into the cache and return its hash.
+
+        Urls that were downloaded before aren't requested again while their file is cached.
+        Returns None if the request fails or the file is bigger than `max_size`."""
+        if (digest := self._urls.get(url)) and digest in self._entries:
+            self._touch(digest)
+            return digest
+
+        try:
+            async with self.session.get(url) as resp:
+                if resp.status != 200:
+                    return None
+                if max_size is not None and (resp.content_length or 0) > max_size:
+                    return None
+                data = await resp.read()
+
+        except aiohttp.ClientError:
+            return None
+
+        if max_size is not None and len(data) > max_size:
+            return None
+
+        return await self.put(data, url=url)
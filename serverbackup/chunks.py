@@ -0,0 +1,786 @@
+import asyncio
+import base64
+import datetime
+import hashlib
+import json
+import zlib
+from concurrent.futures import Executor
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+import discord
+
+from . import serialization
+from .diff import TemplateDiff, _channel_label, _diff_pairs, _role_changes
+from .models import Template, TemplateCategory, TemplateChannel, TemplateMessage, TemplateRole
+from .storage import BackupStore
+from .utils import _overwrite_mapping_compact
+
+# chunks share the store with backups, their ids are far longer than any backup id.
+CHUNK_PREFIX = "chunk-"
+# each chunk's reference count, size and links are kept next to it, so they never have to be
+# rebuilt from the chunks themselves.
+REFS_PREFIX = "refs-"
+# the chunks nothing points to yet or anymore, which are only kept for a reader or writer.
+UNUSED_ID = "refs-unused"
+
+_RAW = b"\x00"
+_COMPRESSED = b"\x01"
+
+# the first item of every chunk says what it is, which also says where its links to other chunks are.
+ROLE = "r"
+OVERWRITES = "o"
+MESSAGE = "m"
+CHANNEL = "c"
+CATEGORY = "g"
+LIST = "l"
+
+
+def chunk_id(digest: str) -> str:
+    return CHUNK_PREFIX + digest
+
+
+def is_chunk_id(id: str) -> bool:
+    return id.startswith(CHUNK_PREFIX)
+
+
+def refs_id(digest: str) -> str:
+    return REFS_PREFIX + digest
+
+
+def chunk_links(chunk: list) -> List[str]:
+    """
+    The digests of the chunks a decoded chunk points to."""
+    kind = chunk[0]
+    if kind == CHANNEL:
+        return [chunk[4], *chunk[6]]
+    if kind == CATEGORY:
+        return [chunk[3], *chunk[4]]
+    if kind == LIST:
+        return list(chunk[1])
+    return []
+
+
+class Chunker:
+    """
+    Turns roles, channels and categories into content addressed chunks, collected in `chunks`.
+
+    Each chunk is named by the hash of its content. Channels and categories point to
+    the chunks of their overwrites, messages and children."""
+    def __init__(self) -> None:
+        self.chunks: Dict[str, Tuple[bytes, List[str]]] = {} # digest -> payload and links
+
+    @staticmethod
+    def encode(chunk: list) -> Tuple[str, bytes, List[str]]:
+        # doesn't touch `chunks`, so it can run in another thread
+        payload = json.dumps(chunk, separators=(",", ":")).encode()
+        # 18 bytes of the hash are plenty to tell chunks apart and keep references short
+        digest = base64.urlsafe_b64encode(hashlib.sha256(payload).digest()[:18]).decode()
+        return digest, payload, chunk_links(chunk)
+
+    def add(self, chunk: list) -> str:
+        digest, payload, links = self.encode(chunk)
+        self.chunks.setdefault(digest, (payload, links))
+        return digest
+
+    def role(self, role: TemplateRole) -> str:
+        return self.add([ROLE, *role.compact])
+
+    def message(self, compact: list) -> str:
+        return self.add([MESSAGE, *compact])
+
+    def channel(self, c: TemplateChannel, messages: Optional[List[str]] = None) -> str:
+        """
+        `messages` are the digests of message chunks that were already added, instead of the channel's own messages."""
+        return self.add([
+            CHANNEL,
+            c.name,
+            c.topic,
+            c.type.value,
+            self.add([OVERWRITES, _overwrite_mapping_compact(c.permissions)]),
+            c.position,
+            [self.message(m) for m in c.messages_compact] if messages is None else messages
+        ])
+
+    def category(self, c: TemplateCategory, children: List[str]) -> str:
+        return self.add([CATEGORY, c.name, c.position, self.add([OVERWRITES, _overwrite_mapping_compact(c.permissions)]), children])
+
+    def manifest(self, header: Template, roles: List[str], channels: List[str]) -> list:
+        return [
+            header.id,
+            header.created_at.timestamp(),
+            header.original_guild_id,
+            header.owner,
+            header.uses,
+            self.add([LIST, roles]),
+            self.add([LIST, channels]),
+        ]
+
+
+def split_template(template: Template) -> Tuple[list, Dict[str, Tuple[bytes, List[str]]]]:
+    """
+    Split a template into chunks with a `Chunker`, the roles and top level channels are each kept
+    in a list chunk. Returns the manifest, which only points to those two lists, and the chunks."""
+    chunker = Chunker()
+    roles = [chunker.role(role) for role in template._roles]
+    channels = [
+        chunker.category(c, [chunker.channel(child) for child in c._children]) if isinstance(c, TemplateCategory) else chunker.channel(c)
+        for c in template._channels
+    ]
+    return chunker.manifest(template, roles, channels), chunker.chunks
+
+
+def manifest_roots(manifest: list) -> List[str]:
+    return manifest[5:7]
+
+
+def _channel_compact(chunks: Dict[str, list], digest: str) -> list:
+    _, name, topic, type, permissions, position, messages = chunks[digest]
+    return [TemplateChannel.COMPACT_TAG, name, topic, type, chunks[permissions][1], position, [chunks[m][1:] for m in messages]]
+
+
+def _category_compact(chunks: Dict[str, list], digest: str, children: List[list]) -> list:
+    _, name, position, permissions, _ = chunks[digest]
+    return [TemplateCategory.COMPACT_TAG, name, position, chunks[permissions][1], children]
+
+
+def _manifest_header(manifest: list) -> Template:
+    id, created_at, original_guild_id, owner, uses, *_ = manifest
+    return Template(
+        id=id,
+        created_at=datetime.datetime.fromtimestamp(created_at),
+        original_guild_id=original_guild_id,
+        owner=owner,
+        uses=uses,
+    )
+
+
+def join_template(manifest: list, chunks: Dict[str, list], *, lazy: bool = False) -> Template:
+    """
+    Put a template split by `split_template` back together from its decoded chunks."""
+    id, created_at, original_guild_id, owner, uses, roles, channels = manifest
+
+    def category(digest: str) -> list:
+        return _category_compact(chunks, digest, [_channel_compact(chunks, c) for c in chunks[digest][4]])
+
+    return Template.from_compact([
+        id,
+        created_at,
+        original_guild_id,
+        owner,
+        uses,
+        [chunks[r][1:] for r in chunks[roles][1]],
+        [category(c) if chunks[c][0] == CATEGORY else _channel_compact(chunks, c) for c in chunks[channels][1]],
+    ], lazy=lazy)
+
+
+def _message_hashes(chunks: Dict[str, list], digests: List[str]) -> List[str]:
+    return [TemplateMessage.compact_hash(chunks[digest][1:]) for digest in digests]
+
+
+def _unshared(old: List[str], new: List[str]) -> Tuple[List[str], List[str]]:
+    # a chunk both point to is the same in both, along with everything under it
+    old_set, new_set = set(old), set(new)
+    return [d for d in old if d not in new_set], [d for d in new if d not in old_set]
+
+
+def _channel_key(chunk: list) -> Tuple[str, str]:
+    return chunk[1], discord.ChannelType(chunk[3]).name
+
+
+def _channel_chunk_changes(old: list, new: list) -> List[str]:
+    # overwrites and messages are compared by their digests, neither has to be read
+    changes = [attr for attr, index in (("topic", 2), ("position", 5)) if old[index] != new[index]]
+    if old[4] != new[4]:
+        changes.append("overwrites")
+    if old[6] != new[6]:
+        changes.append("messages")
+    return changes
+
+
+def _category_chunk_changes(old: list, new: list) -> Optional[List[str]]:
+    changes = ["position"] if old[2] != new[2] else []
+    if old[3] != new[3]:
+        changes.append("overwrites")
+    return changes or None
+
+
+def _encode_messages(messages: List[TemplateMessage]) -> Tuple[List[Tuple[str, bytes, List[str]]], List[str]]:
+    compacts = [m.compact for m in messages]
+    return [Chunker.encode([MESSAGE, *c]) for c in compacts], [TemplateMessage.compact_hash(c) for c in compacts]
+
+
+class _Refs:
+    """
+    The reference records one change to `ChunkedBackups` read and wrote, saved together by `ChunkedBackups._save`."""
+    def __init__(self) -> None:
+        self.records: Dict[str, Optional[list]] = {} # chunk digest -> [references, size, links], None if it isn't stored
+        self.changed: Set[str] = set()
+        self.deleted: List[str] = []
+
+
+class ChunkedBackups:
+    """
+    Backups stored as manifests of shared chunks.
+
+    A chunk is written once no matter how many backups use it, so successive backups
+    of the same guild only add what changed. Every chunk has a record next to it with the
+    number of manifests and chunks that point to it, its size and its links, and is deleted,
+    along with whatever only it pointed to, once that reaches zero. Only the records a change
+    touches are read, none are held between changes. Chunks that are only pinned by a reader
+    or writer are listed in the store too, so `load` can remove the ones a crash left behind.
+    
+    Splitting, joining, compressing and decoding run in `executor`, the loop's default
+    thread pool if it's None, so large backups don't block the event loop."""
+    def __init__(self, store: BackupStore, *, compress: bool = True, executor: Optional[Executor] = None) -> None:
+        self.store = store
+        self.compress = compress
+        self.executor = executor
+        self._pins: Dict[str, int] = {} # chunk digest -> readers and writers that hold on to it
+        self._unused: Set[str] = set() # chunks with no references, kept for their pins or until they're deleted
+        self._lock = asyncio.Lock()
+        self._loaded = False
+
+    def _pack(self, payload: bytes) -> bytes:
+        if self.compress and len(compressed := zlib.compress(payload)) < len(payload):
+            return _COMPRESSED + compressed
+        return _RAW + payload
+
+    @staticmethod
+    def _unpack(data: bytes) -> list:
+        payload = zlib.decompress(data[1:]) if data[:1] == _COMPRESSED else data[1:]
+        return json.loads(payload)
+
+    @classmethod
+    def _unpack_all(cls, stored: Dict[str, bytes]) -> Dict[str, list]:
+        return {key[len(CHUNK_PREFIX):]: cls._unpack(data) for key, data in stored.items()}
+
+    async def _read_chunks(self, digests: Iterable[str]) -> Dict[str, list]:
+        digests = list(digests)
+        chunks = {}
+        for start in range(0, len(digests), 500):
+            stored = await self.store.get_many(chunk_id(digest) for digest in digests[start:start + 500])
+            chunks.update(await serialization.run_in_executor(self._unpack_all, stored, executor=self.executor))
+        return chunks
+
+    async def _read_tree(self, roots: Iterable[str]) -> Dict[str, list]:
+        # every chunk reachable from the roots, a level at a time
+        chunks: Dict[str, list] = {}
+        level = set(roots)
+        while level:
+            chunks.update(await self._read_chunks(level))
+            level = {link for digest in level if digest in chunks for link in chunk_links(chunks[digest])} - chunks.keys()
+        return chunks
+
+    async def load(self):
+        async with self._lock:
+            if self._loaded:
+                return
+
+            # nothing is pinned yet, so the chunks listed as unused are what a crash left behind.
+            if (data := await self.store.get(UNUSED_ID)) is not None:
+                refs = _Refs()
+                await self._fetch(refs, json.loads(data))
+                await self._collect(refs, [digest for digest, record in refs.records.items() if record is not None and not record[0]])
+                await self._save(refs)
+                await self.store.delete(UNUSED_ID)
+            self._loaded = True
+
+    async def _fetch(self, refs: _Refs, digests: Iterable[str]):
+        # reads the records `refs` doesn't have yet
+        missing = [digest for digest in set(digests) if digest not in refs.records]
+        for start in range(0, len(missing), 500):
+            batch = missing[start:start + 500]
+            stored = await self.store.get_many(refs_id(digest) for digest in batch)
+            for digest in batch:
+                refs.records[digest] = json.loads(stored[refs_id(digest)]) if refs_id(digest) in stored else None
+
+    async def _link(self, refs: _Refs, digests: List[str]):
+        # add a reference to each
+        await self._fetch(refs, digests)
+        for digest in digests:
+            refs.records[digest][0] += 1
+            refs.changed.add(digest)
+
+    async def _release(self, refs: _Refs, digests: List[str]):
+        # drop a reference to each, and delete the ones nothing points to or pins anymore
+        await self._fetch(refs, digests)
+        unused = []
+        for digest in digests:
+            refs.records[digest][0] -= 1
+            refs.changed.add(digest)
+            if not refs.records[digest][0] and not self._pins.get(digest):
+                unused.append(digest)
+        await self._collect(refs, unused)
+
+    def _pin(self, digests: Iterable[str]):
+        for digest in digests:
+            self._pins[digest] = self._pins.get(digest, 0) + 1
+
+    async def _unpin(self, refs: _Refs, digests: Iterable[str]):
+        released = []
+        for digest in digests:
+            self._pins[digest] -= 1
+            if not self._pins[digest]:
+                del self._pins[digest]
+                released.append(digest)
+        await self._fetch(refs, released)
+        await self._collect(refs, [digest for digest in released if refs.records[digest] is not None and not refs.records[digest][0]])
+
+    async def _collect(self, refs: _Refs, unused: List[str]):
+        # deleting a chunk releases everything it pointed to, which can free those too.
+        while unused:
+            digest = unused.pop()
+            links = refs.records[digest][2]
+            refs.records[digest] = None
+            refs.deleted.append(digest)
+            await self._fetch(refs, links)
+            for link in links:
+                refs.records[link][0] -= 1
+                refs.changed.add(link)
+                if not refs.records[link][0] and not self._pins.get(link):
+                    unused.append(link)
+
+    async def _save(self, refs: _Refs, *, chunks: Optional[Dict[str, bytes]] = None, manifests: Optional[Dict[str, bytes]] = None):
+        # chunks go before their records and records before the manifests pointing to them, whatever a crash
+        # interrupts is at worst kept longer than it has to be. Deletions come last for the same reason.
+        unused = set(self._unused)
+        for digest in refs.changed:
+            if (record := refs.records[digest]) is not None and not record[0]:
+                unused.add(digest)
+            else:
+                unused.discard(digest)
+        unused.difference_update(refs.deleted)
+        items = {chunk_id(digest): data for digest, data in (chunks or {}).items()}
+        items.update((refs_id(digest), json.dumps(refs.records[digest]).encode()) for digest in refs.changed if refs.records[digest] is not None)
+        deleted = [*map(refs_id, refs.deleted), *map(chunk_id, refs.deleted)]
+        if unused != self._unused:
+            if unused:
+                items[UNUSED_ID] = json.dumps(sorted(unused)).encode()
+            else:
+                deleted.append(UNUSED_ID)
+            self._unused = unused
+        items.update(manifests or {})
+        if items:
+            await self.store.put_many(items)
+        if deleted:
+            await self.store.delete_many(deleted)
+        refs.changed.clear()
+        refs.deleted.clear()
+
+    def _split(self, template: Template):
+        manifest, chunks = split_template(template)
+        data = serialization.encode_manifest(manifest, compress=self.compress)
+        return manifest, chunks, data, self._pack_all(chunks)
+
+    def _pack_all(self, chunks: Dict[str, Tuple[bytes, List[str]]]) -> Dict[str, bytes]:
+        return {digest: self._pack(payload) for digest, (payload, _) in chunks.items()}
+
+    async def _write(self, refs: _Refs, chunks: Dict[str, Tuple[bytes, List[str]]], packed: Dict[str, bytes]) -> List[str]:
+        # called with the lock held, adds records for the chunks that aren't stored yet and returns their digests.
+        # they're only stored by the `_save` after it.
+        await self._fetch(refs, chunks)
+        new = [digest for digest in chunks if refs.records[digest] is None]
+        for digest in new:
+            refs.records[digest] = [0, len(packed[digest]), chunks[digest][1]]
+            refs.changed.add(digest)
+        # children always come before the chunks pointing to them, so they have records by now.
+        for digest in new:
+            await self._link(refs, chunks[digest][1])
+        return new
+
+    async def _roots(self, id: str) -> List[str]:
+        data = await self.store.get(id)
+        return manifest_roots(serialization.decode_manifest(data)) if data is not None and serialization.is_chunked(data) else []
+
+    async def _commit(self, id: str, manifest: list, refs: _Refs, chunks: Optional[Dict[str, bytes]] = None):
+        # called with the lock held, a manifest is only stored after everything it points to.
+        old = await self._roots(id)
+        await self._link(refs, manifest_roots(manifest))
+        await self._save(refs, chunks=chunks, manifests={id: serialization.encode_manifest(manifest, compress=self.compress)})
+        # a backup that was already stored lets go of what it pointed to before.
+        await self._release(refs, old)
+        await self._save(refs)
+
+    async def put(self, template: Template) -> Tuple[int, int]:
+        """
+        Store a template, replacing the backup with the same id if there is one.
+
+        Returns the size of the backup with all of its chunks and how many of those bytes were new."""
+        await self.load()
+        manifest, chunks, data, packed = await serialization.run_in_executor(self._split, template, executor=self.executor)
+        async with self._lock:
+            refs = _Refs()
+            new = await self._write(refs, chunks, packed)
+            await self._commit(template.id, manifest, refs, {digest: packed[digest] for digest in new})
+        return len(data) + sum(map(len, packed.values())), len(data) + sum(len(packed[digest]) for digest in new)
+
+    def writer(self, header: Template) -> "BackupWriter":
+        """
+        Write a backup a piece at a time, see `BackupWriter`."""
+        return BackupWriter(self, header)
+
+    async def set_uses(self, id: str, uses: int) -> bool:
+        """
+        Change how many times a backup was used, only its manifest is written again."""
+        await self.load()
+        async with self._lock:
+            data = await self.store.get(id)
+            if data is None:
+                return False
+            if not serialization.is_chunked(data):
+                # stored whole, before chunks existed
+                template = await serialization.decode_async(data, executor=self.executor)
+                template.uses = uses
+                await self.store.put(id, await serialization.encode_async(template, compress=self.compress, executor=self.executor))
+                return True
+            manifest = serialization.decode_manifest(data)
+            manifest[4] = uses
+            # same roots, so no counts change
+            await self.store.put(id, serialization.encode_manifest(manifest, compress=self.compress))
+        return True
+
+    async def get(self, id: str, *, lazy: bool = False) -> Optional[Template]:
+        """
+        Read a backup, with `lazy` its messages are only decoded once they're used."""
+        await self.load()
+        data = await self.store.get(id)
+        if data is None:
+            return None
+        if not serialization.is_chunked(data):
+            # stored whole, before chunks existed
+            return await serialization.decode_async(data, lazy=lazy, executor=self.executor)
+
+        manifest = serialization.decode_manifest(data)
+        chunks = await self._read_tree(manifest_roots(manifest))
+        return await serialization.run_in_executor(join_template, manifest, chunks, lazy=lazy, executor=self.executor)
+
+    async def iter_backup(self, id: str) -> AsyncIterator[Tuple[str, Union[Template, TemplateRole, TemplateCategory, TemplateChannel]]]:
+        """
+        Read a backup a piece at a time, without ever holding all of it.
+
+        Yields ("header", template) first, a template with no roles or channels, then
+        ("role", role) for each role and for each category ("category", category) with no
+        children followed by ("child", channel) for its channels, and ("channel", channel)
+        for the channels outside of categories. Only one channel's chunks are read at a time.
+        The backup's chunks are kept even if it's deleted while this is still going."""
+        await self.load()
+        data = await self.store.get(id)
+        if data is None:
+            return
+        if not serialization.is_chunked(data):
+            # stored whole, there's nothing to read it in pieces from.
+            template = await serialization.decode_async(data, executor=self.executor)
+            yield "header", Template(id=template.id, created_at=template.created_at, original_guild_id=template.original_guild_id, owner=template.owner, uses=template.uses)
+            for role in template._roles:
+                yield "role", role
+            for c in template._channels:
+                if isinstance(c, TemplateCategory):
+                    yield "category", TemplateCategory(name=c.name, position=c.position, permissions=c.permissions)
+                    for child in c._children:
+                        yield "child", child
+                else:
+                    yield "channel", c
+            return
+
+        manifest = serialization.decode_manifest(data)
+        roots = manifest_roots(manifest)
+        async with self._lock:
+            self._pin(roots)
+
+        async def channel(digest: str, chunks: Dict[str, list]) -> TemplateChannel:
+            chunks.update(await self._read_chunks(chunk_links(chunks[digest])))
+            return TemplateChannel.from_compact(_channel_compact(chunks, digest))
+
+        try:
+            yield "header", _manifest_header(manifest)
+            lists = await self._read_chunks(roots)
+            roles, channels = (lists[root][1] for root in roots)
+            for start in range(0, len(roles), 500):
+                chunks = await self._read_chunks(roles[start:start + 500])
+                for digest in roles[start:start + 500]:
+                    yield "role", TemplateRole.from_compact(chunks[digest][1:])
+
+            for digest in channels:
+                top = await self._read_chunks([digest])
+                if top[digest][0] != CATEGORY:
+                    yield "channel", await channel(digest, top)
+                    continue
+                top.update(await self._read_chunks([top[digest][3]]))
+                yield "category", TemplateCategory.from_compact(_category_compact(top, digest, []))
+                for child in top[digest][4]:
+                    yield "child", await channel(child, await self._read_chunks([child]))
+        finally:
+            async with self._lock:
+                refs = _Refs()
+                await self._unpin(refs, roots)
+                await self._save(refs)
+
+    async def message_digests(self, channel: str) -> Optional[List[str]]:
+        """
+        The digests of a stored channel chunk's messages, None if it isn't stored."""
+        refs = _Refs()
+        await self._fetch(refs, [channel])
+        if (record := refs.records[channel]) is None:
+            return None
+        # the overwrites come first
+        return record[2][1:]
+
+    async def message_hashes(self, digests: List[str]) -> List[str]:
+        """
+        `TemplateMessage.compact_hash` of stored message chunks, in the same order."""
+        hashes = []
+        # a batch at a time, a long history is never read all at once
+        for start in range(0, len(digests), 500):
+            batch = digests[start:start + 500]
+            chunks = await self._read_chunks(batch)
+            hashes.extend(await serialization.run_in_executor(_message_hashes, chunks, batch, executor=self.executor))
+        return hashes
+
+    async def diff(self, old_id: str, new_id: str) -> Optional[TemplateDiff]:
+        """
+        Compare two backups like `diff_templates`, None if either of them doesn't exist.
+
+        Only the chunks the two don't share are read, and no overwrites or messages at all,
+        those are compared by their digests."""
+        await self.load()
+        async with self._lock:
+            # read and pinned together, so neither can be deleted in between
+            data = [await self.store.get(id) for id in (old_id, new_id)]
+            if None in data:
+                return None
+            chunked = all(map(serialization.is_chunked, data))
+            if chunked:
+                old, new = (serialization.decode_manifest(d) for d in data)
+                roots = manifest_roots(old) + manifest_roots(new)
+                self._pin(roots)
+        if not chunked:
+            # stored whole, before chunks existed
+            old, new = await self.get(old_id), await self.get(new_id)
+            return old.diff(new) if old is not None and new is not None else None
+
+        diff = TemplateDiff(_manifest_header(old), _manifest_header(new))
+        try:
+            if manifest_roots(old) == manifest_roots(new):
+                return diff
+            lists = await self._read_chunks(set(roots))
+            if old[5] != new[5]:
+                old_roles, new_roles = _unshared(lists[old[5]][1], lists[new[5]][1])
+                chunks = await self._read_chunks(old_roles + new_roles)
+                _diff_pairs(
+                    diff,
+                    "role",
+                    {role.name: role for role in (TemplateRole.from_compact(chunks[d][1:]) for d in old_roles)},
+                    {role.name: role for role in (TemplateRole.from_compact(chunks[d][1:]) for d in new_roles)},
+                    _role_changes,
+                )
+            if old[6] == new[6]:
+                return diff
+
+            old_top, new_top = _unshared(lists[old[6]][1], lists[new[6]][1])
+            chunks = await self._read_chunks(old_top + new_top)
+            old_categories = {chunks[d][1]: chunks[d] for d in old_top if chunks[d][0] == CATEGORY}
+            new_categories = {chunks[d][1]: chunks[d] for d in new_top if chunks[d][0] == CATEGORY}
+            # the changed children of categories that are in both, read before anything is compared
+            children = {}
+            for name in old_categories.keys() & new_categories.keys():
+                children[name] = _unshared(old_categories[name][4], new_categories[name][4])
+                chunks.update(await self._read_chunks(children[name][0] + children[name][1]))
+
+            def channels(digests: List[str]) -> Dict[Tuple[str, str], list]:
+                return {_channel_key(chunks[d]): chunks[d] for d in digests if chunks[d][0] == CHANNEL}
+
+            def category(old_category: list, new_category: list):
+                old_children, new_children = children[old_category[1]]
+                _diff_pairs(diff, "channel", channels(old_children), channels(new_children), _channel_chunk_changes, label=_channel_label(old_category[1]))
+
+            _diff_pairs(
+                diff,
+                "category",
+                old_categories,
+                new_categories,
+                _category_chunk_changes,
+                size=lambda chunk: [f"{len(chunk[4])} channels"],
+                inner=category,
+            )
+            _diff_pairs(diff, "channel", channels(old_top), channels(new_top), _channel_chunk_changes, label=_channel_label())
+        finally:
+            async with self._lock:
+                refs = _Refs()
+                await self._unpin(refs, roots)
+                await self._save(refs)
+        return diff
+
+    async def delete(self, id: str) -> bool:
+        await self.load()
+        async with self._lock:
+            roots = await self._roots(id)
+            # the manifest goes first, so nothing is left pointing to chunks that are gone
+            deleted = await self.store.delete(id)
+            refs = _Refs()
+            await self._release(refs, roots)
+            await self._save(refs)
+        return deleted
+
+    async def total_size(self) -> int:
+        return await self.store.total_size()
+
+
+class BackupWriter:
+    """
+    Writes a backup to `ChunkedBackups` a piece at a time, in the order `iter_backup` yields them.
+
+    Chunks are stored in batches of `batch_size` as pieces are added, so only the pieces
+    not stored yet and the digests of the ones before them are held. The chunks it stored
+    or reused stay pinned until `finish` or `abort`, so a backup deleted in the meantime
+    can't take them away, and nothing it stored is left behind if it's aborted."""
+    def __init__(self, backups: ChunkedBackups, header: Template, *, batch_size: int = 256) -> None:
+        self.backups = backups
+        self.header = header
+        self.batch_size = batch_size
+        self.chunker = Chunker()
+        self.roles: List[str] = []
+        self.channels: List[str] = []
+        self.role_count = 0
+        self.channel_count = 0
+        self.size = 0 # bytes of the chunks this backup uses
+        self.new = 0 # bytes of those that weren't stored before
+        self._pinned: Set[str] = set()
+        self._role_hashes: List[str] = []
+        self._channel_hashes: List[str] = []
+        # the open category and the digests and hashes of its channels so far
+        self._category: Optional[Tuple[TemplateCategory, List[str], List[str]]] = None
+
+    async def add_role(self, role: TemplateRole):
+        self.roles.append(self.chunker.role(role))
+        self._role_hashes.append(role.content_hash)
+        self.role_count += 1
+        await self._flush()
+
+    async def add_category(self, category: TemplateCategory):
+        """
+        Start a category, the channels added with `add_channel(..., in_category=True)` after it are its children."""
+        self._close_category()
+        self._category = (category, [], [])
+        # counted like `Template.index_json` does, categories are channels too
+        self.channel_count += 1
+
+    async def add_messages(self, messages: List[TemplateMessage]) -> Tuple[List[str], List[str]]:
+        """
+        Store messages on their own, returns their digests and hashes to pass to `add_channel`."""
+        chunks, hashes = await serialization.run_in_executor(_encode_messages, messages, executor=self.backups.executor)
+        for digest, payload, links in chunks:
+            self.chunker.chunks.setdefault(digest, (payload, links))
+        await self._flush()
+        return [digest for digest, _, _ in chunks], hashes
+
+    async def reuse(self, digests: List[str]) -> bool:
+        """
+        Pin chunks that are already stored so they can be pointed to, False if any of them isn't anymore."""
+        await self.backups.load()
+        async with self.backups._lock:
+            refs = _Refs()
+            await self.backups._fetch(refs, digests)
+            if any(record is None for record in refs.records.values()):
+                return False
+            pinned = set(digests) - self._pinned
+            self.backups._pin(pinned)
+            self._pinned.update(pinned)
+            # part of this backup's size too, they just aren't new
+            self.size += sum(refs.records[digest][1] for digest in pinned)
+        return True
+
+    async def add_channel(self, channel: TemplateChannel, *, in_category: bool = False, messages: Optional[Tuple[List[str], List[str]]] = None) -> str:
+        """
+        Add a channel and return the digest of its chunk.
+
+        `messages` are the digests and hashes of messages stored with `add_messages` or
+        pinned with `reuse`, which are used instead of the channel's own."""
+        if in_category and self._category is None:
+            raise ValueError("A category channel was added before any category.")
+        if not in_category:
+            self._close_category()
+        if messages is None:
+            digest, content_hash = self.chunker.channel(channel), channel.content_hash
+        else:
+            digest, content_hash = self.chunker.channel(channel, messages[0]), channel.hash_with(messages[1])
+        if in_category:
+            self._category[1].append(digest)
+            self._category[2].append(content_hash)
+        else:
+            self.channels.append(digest)
+            self._channel_hashes.append(content_hash)
+        self.channel_count += 1
+        await self._flush()
+        return digest
+
+    def _close_category(self):
+        if self._category is None:
+            return
+        category, children, hashes = self._category
+        self.channels.append(self.chunker.category(category, children))
+        self._channel_hashes.append(category.hash_with(hashes))
+        self._category = None
+
+    @property
+    def content_hash(self):
+        # the same as `Template.content_hash` of everything added so far
+        hashes = self._channel_hashes
+        if self._category is not None:
+            hashes = hashes + [self._category[0].hash_with(self._category[2])]
+        return Template.hash_of(self._role_hashes, hashes)
+
+    @property
+    def index_json(self):
+        # `Template.index_json` of everything added, the header alone has no roles or channels to count.
+        return {
+            **self.header.index_json,
+            "channel_count": self.channel_count,
+            "role_count": self.role_count,
+            "hash": self.content_hash,
+        }
+
+    async def _flush(self, *, force: bool = False):
+        if len(self.chunker.chunks) < self.batch_size and not force:
+            return
+        await self.backups.load()
+        # the same chunk can come up again in a later batch, it's only stored and pinned once.
+        chunks = {digest: chunk for digest, chunk in self.chunker.chunks.items() if digest not in self._pinned}
+        self.chunker.chunks = {}
+        if not chunks:
+            return
+        packed = await serialization.run_in_executor(self.backups._pack_all, chunks, executor=self.backups.executor)
+        async with self.backups._lock:
+            refs = _Refs()
+            new = await self.backups._write(refs, chunks, packed)
+            self.backups._pin(chunks)
+            self._pinned.update(chunks)
+            await self.backups._save(refs, chunks={digest: packed[digest] for digest in new})
+        self.size += sum(map(len, packed.values()))
+        self.new += sum(len(packed[digest]) for digest in new)
+
+    async def finish(self) -> Tuple[int, int]:
+        """
+        Store the manifest, which makes the backup visible, and let go of the pins.
+
+        Returns the size of the backup with all of its chunks and how many of those bytes were new."""
+        self._close_category()
+        manifest = self.chunker.manifest(self.header, self.roles, self.channels)
+        await self._flush(force=True)
+        data = serialization.encode_manifest(manifest, compress=self.backups.compress)
+        async with self.backups._lock:
+            refs = _Refs()
+            await self.backups._commit(self.header.id, manifest, refs)
+            await self.backups._unpin(refs, self._pinned)
+            await self.backups._save(refs)
+        self._pinned = set()
+        return self.size + len(data), self.new + len(data)
+
+    async def abort(self):
+        """
+        Give up on the backup, chunks only it used are deleted again."""
+        self.chunker.chunks = {}
+        async with self.backups._lock:
+            refs = _Refs()
+            await self.backups._unpin(refs, self._pinned)
+            await self.backups._save(refs)
+        self._pinned = set()
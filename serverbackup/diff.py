@@ -0,0 +1,157 @@
+from typing import TYPE_CHECKING, Callable, Dict, Hashable, List, Optional, Tuple
+
+from .utils import _overwrite_mapping_compact
+
+if TYPE_CHECKING:
+    from .models import Template, TemplateCategory, TemplateChannel, TemplateRole
+
+
+class DiffEntry:
+    def __init__(self, action: str, kind: str, name: str, **kwargs) -> None:
+        self.action = action # added, removed or changed
+        self.kind = kind # role, category or channel
+        self.name = name
+        self.changes: List[str] = kwargs.get("changes", []) # the attributes that differ
+
+    def __repr__(self) -> str:
+        return f"<DiffEntry action={self.action!r} kind={self.kind!r} name={self.name!r}>"
+
+    @property
+    def description(self):
+        prefix = {"added": "+", "removed": "-", "changed": "!"}[self.action]
+        desc = f"{prefix} {self.action} {self.kind} {self.name}"
+        if self.changes:
+            desc += f" ({', '.join(self.changes)})"
+        return desc
+
+
+class TemplateDiff:
+    """
+    What changed between two templates, from `old` to `new`."""
+    def __init__(self, old: "Template", new: "Template") -> None:
+        self.old = old
+        self.new = new
+        self.entries: List[DiffEntry] = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def summary(self, limit: int = 20) -> str:
+        if not self.entries:
+            return "No differences."
+        lines = [entry.description for entry in self.entries[:limit]]
+        if len(self) > limit:
+            lines.append(f"...and {len(self) - limit} more.")
+        return "\n".join(lines)
+
+
+def _pair(old: Dict[Hashable, object], new: Dict[Hashable, object]) -> List[Tuple[Hashable, object, object]]:
+    # old order first, then whatever only the new one has
+    keys = list(old) + [key for key in new if key not in old]
+    return [(key, old.get(key), new.get(key)) for key in keys]
+
+
+def _changed_attrs(old, new, attrs: Tuple[str, ...]) -> List[str]:
+    return [attr for attr in attrs if getattr(old, attr) != getattr(new, attr)]
+
+
+def _diff_pairs(
+    diff: TemplateDiff,
+    kind: str,
+    old: Dict[Hashable, object],
+    new: Dict[Hashable, object],
+    changes: Callable[[object, object], Optional[List[str]]],
+    *,
+    label: Callable[[Hashable], str] = str,
+    size: Optional[Callable[[object], List[str]]] = None,
+    inner: Optional[Callable[[object, object], None]] = None,
+):
+    # `changes` is None for two with the same key that are the same, `size` describes one that was added or
+    # removed and `inner` compares what's in two with the same key. they only get what they need, so the same
+    # matching works for templates and for stored chunks.
+    for key, before, after in _pair(old, new):
+        if after is None:
+            diff.entries.append(DiffEntry("removed", kind, label(key), changes=size(before) if size else []))
+        elif before is None:
+            diff.entries.append(DiffEntry("added", kind, label(key), changes=size(after) if size else []))
+        else:
+            if (found := changes(before, after)) is not None:
+                diff.entries.append(DiffEntry("changed", kind, label(key), changes=found))
+            if inner is not None:
+                inner(before, after)
+
+
+def _channel_label(category: Optional[str] = None) -> Callable[[Tuple[str, str]], str]:
+    prefix = f"{category}/" if category else ""
+    return lambda key: f"{prefix}#{key[0]}" if key[1] == "text" else f"{prefix}{key[0]} ({key[1]})"
+
+
+def _role_changes(old: "TemplateRole", new: "TemplateRole") -> List[str]:
+    changes = _changed_attrs(old, new, ("color", "hoist", "mentionable", "position"))
+    if old.permissions.value != new.permissions.value:
+        changes.append("permissions")
+    return changes
+
+
+def _channel_changes(old: "TemplateChannel", new: "TemplateChannel") -> Optional[List[str]]:
+    if old.content_hash == new.content_hash:
+        return None
+    changes = _changed_attrs(old, new, ("topic", "position"))
+    if _overwrite_mapping_compact(old.permissions) != _overwrite_mapping_compact(new.permissions):
+        changes.append("overwrites")
+    if old.message_hashes != new.message_hashes:
+        changes.append("messages")
+    return changes
+
+
+def _diff_channels(diff: TemplateDiff, old: List["TemplateChannel"], new: List["TemplateChannel"], category: Optional[str] = None):
+    old_map = {(c.name, c.type.name): c for c in old}
+    new_map = {(c.name, c.type.name): c for c in new}
+    _diff_pairs(diff, "channel", old_map, new_map, _channel_changes, label=_channel_label(category))
+
+
+def _category_changes(old: "TemplateCategory", new: "TemplateCategory") -> Optional[List[str]]:
+    changes = _changed_attrs(old, new, ("position",))
+    if _overwrite_mapping_compact(old.permissions) != _overwrite_mapping_compact(new.permissions):
+        changes.append("overwrites")
+    return changes or None
+
+
+def _diff_category(diff: TemplateDiff, old: "TemplateCategory", new: "TemplateCategory"):
+    if old.content_hash != new.content_hash:
+        _diff_channels(diff, old.children, new.children, old.name)
+
+
+def diff_templates(old: "Template", new: "Template") -> TemplateDiff:
+    """
+    Compare two templates.
+
+    Roles are matched by name, categories by name and channels by name and type
+    within their category. Only the parts whose hashes differ are looked into,
+    so identical templates and unchanged subtrees are skipped right away."""
+    diff = TemplateDiff(old, new)
+    if old.content_hash == new.content_hash:
+        return diff
+
+    _diff_pairs(
+        diff,
+        "role",
+        {role.name: role for role in old.roles},
+        {role.name: role for role in new.roles},
+        lambda before, after: _role_changes(before, after) if before.content_hash != after.content_hash else None,
+    )
+
+    old_categories, old_channels = old.channels
+    new_categories, new_channels = new.channels
+    _diff_pairs(
+        diff,
+        "category",
+        {category.name: category for category in old_categories},
+        {category.name: category for category in new_categories},
+        lambda before, after: _category_changes(before, after) if before.content_hash != after.content_hash else None,
+        size=lambda category: [f"{len(category._children)} channels"],
+        inner=lambda before, after: _diff_category(diff, before, after),
+    )
+
+    _diff_channels(diff, old_channels, new_channels)
+    return diff
@@ -0,0 +1,199 @@
+import asyncio
+import time
+from typing import TYPE_CHECKING, AsyncIterator, Dict, List, Optional, Tuple
+
+import discord
+
+from .chunks import BackupWriter, ChunkedBackups
+from .instrumentation import phase, record_api_call
+from .models import Template, TemplateCategory, TemplateChannel, TemplateMessage, TemplateRole, _NullSemaphore
+from .utils import _proper_overwrites_mapping, valid_role_for_template
+
+if TYPE_CHECKING:
+    from .cache import AssetCache
+
+# the most messages discord returns for one history request
+PAGE_SIZE = 100
+
+
+class RequestBudget:
+    """
+    The most history requests one capture can make, shared by all of its channels.
+
+    No limit if `limit` is None."""
+    def __init__(self, limit: Optional[int] = None) -> None:
+        self.limit = limit
+        self.spent = 0
+
+    @property
+    def exhausted(self):
+        return self.limit is not None and self.spent >= self.limit
+
+    def take(self) -> bool:
+        if self.exhausted:
+            return False
+        self.spent += 1
+        return True
+
+
+class HistoryPager:
+    """
+    A channel's messages a page at a time, newest first.
+
+    Up to `limit` messages are fetched, only those after `after` if it's given, and every page is
+    one request that takes from `budget`. `complete` says whether all of them were fetched,
+    it stays False if the budget ran out first."""
+    def __init__(
+        self,
+        channel: discord.TextChannel,
+        *,
+        limit: int,
+        after: Optional[discord.abc.Snowflake] = None,
+        budget: Optional[RequestBudget] = None,
+        semaphore: Optional[asyncio.Semaphore] = None,
+    ) -> None:
+        self.channel = channel
+        self.limit = limit
+        self.after = after
+        self.budget = budget
+        self.semaphore = semaphore
+        self.fetched = 0
+        self.complete = False
+
+    async def pages(self) -> AsyncIterator[List[discord.Message]]:
+        before = None
+        while self.fetched < self.limit:
+            if self.budget is not None and not self.budget.take():
+                return
+            size = min(PAGE_SIZE, self.limit - self.fetched)
+            # the semaphore is held for one page at a time so long histories don't hold up other channels.
+            async with self.semaphore or _NullSemaphore():
+                with phase("capture:history"):
+                    record_api_call()
+                    # newest first even with `after`, so the latest messages are the ones kept if the budget runs out.
+                    page = [msg async for msg in self.channel.history(limit=size, before=before, after=self.after, oldest_first=False)]
+            self.fetched += len(page)
+            if page:
+                yield page
+            if len(page) < size:
+                # reached the start of the channel or `after`
+                break
+            before = page[-1]
+        self.complete = True
+
+
+async def _capture_messages(
+    writer: BackupWriter,
+    channel: discord.TextChannel,
+    *,
+    depth: int,
+    cursor: Optional[list],
+    budget: Optional[RequestBudget],
+    semaphore: asyncio.Semaphore,
+    cache: Optional["AssetCache"],
+) -> Tuple[List[str], List[str], Optional[int]]:
+    # returns the digests and hashes of the channel's messages, oldest first, and the id of the newest one
+    old_digests, old_hashes, after = [], [], None
+    if cursor is not None and (stored := await writer.backups.message_digests(cursor[1])) is not None and await writer.reuse(stored):
+        old_digests, old_hashes = stored, await writer.backups.message_hashes(stored)
+        after = discord.Object(cursor[0]) if cursor[0] is not None else None
+
+    digests, hashes = [], []
+    newest = after.id if after is not None else None
+    pager = HistoryPager(channel, limit=depth, after=after, budget=budget, semaphore=semaphore)
+    async for page in pager.pages():
+        if newest is None or page[0].id > newest:
+            newest = page[0].id
+        messages = [TemplateMessage.from_message(msg) for msg in page]
+        if cache is not None:
+            with phase("capture:attachments"):
+                await asyncio.gather(*(msg.store_files(cache) for msg in messages))
+        # stored before the next page is fetched, only the digests and hashes are kept.
+        page_digests, page_hashes = await writer.add_messages(messages)
+        digests.extend(page_digests)
+        hashes.extend(page_hashes)
+
+    digests.reverse()
+    hashes.reverse()
+    if pager.complete or not digests:
+        # a fetch the budget cut short didn't reach the stored messages, joining them would leave a gap.
+        digests, hashes = old_digests + digests, old_hashes + hashes
+    start = max(len(digests) - depth, 0)
+    return digests[start:], hashes[start:], newest
+
+
+async def capture_backup(
+    guild: discord.Guild,
+    owner: discord.abc.Snowflake,
+    backups: ChunkedBackups,
+    *,
+    depth: int = 3,
+    concurrency: int = 5,
+    budget: Optional[RequestBudget] = None,
+    cache: Optional["AssetCache"] = None,
+    previous: Optional[dict] = None,
+) -> Tuple[BackupWriter, dict]:
+    """
+    Capture a backup of the guild straight into `backups`, with the latest `depth` messages of each text channel.
+
+    Messages are fetched a page at a time and every page is stored before the next one
+    is fetched, so only the digests and hashes of the messages are held. Channels and
+    categories are the same as `Template.from_guild` captures.
+
+    `previous` is the `history` of an earlier capture's index entry. Channels it has
+    only fetch the messages newer than the newest one it stored and reuse the stored
+    ones, edits and deletes of those older messages aren't seen.
+
+    Returns the writer, which still has to be finished or aborted, and the `history`
+    to keep in the new backup's index entry."""
+    start = time.perf_counter()
+    writer = backups.writer(Template(original_guild_id=guild.id, owner=owner.id))
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+    # cursors are only reused with the same depth, a deeper one has older messages to fetch.
+    cursors: Dict[str, list] = previous["cursors"] if previous and previous.get("depth") == depth else {}
+    try:
+        with phase("capture:roles"):
+            for role in guild.roles:
+                if valid_role_for_template(role):
+                    await writer.add_role(TemplateRole.from_role(role))
+
+        categories: Dict[str, discord.CategoryChannel] = {}
+        channels = []
+        for channel in guild.channels:
+            if channel.type not in (discord.ChannelType.text, discord.ChannelType.voice):
+                continue
+            if channel.category:
+                categories.setdefault(channel.category.name, channel.category)
+                continue
+            channels.append(channel)
+
+        # messages of every channel are fetched at once, the channels are added in order once they're all in.
+        everything = [child for category in categories.values() for child in category.channels] + channels
+        text = [channel for channel in everything if channel.type is discord.ChannelType.text and depth]
+        captured = dict(zip((channel.id for channel in text), await asyncio.gather(*(
+            _capture_messages(writer, channel, depth=depth, cursor=cursors.get(str(channel.id)), budget=budget, semaphore=semaphore, cache=cache)
+            for channel in text
+        ))))
+
+        history = {"depth": depth, "cursors": {}}
+
+        async def add(channel: discord.abc.GuildChannel, in_category: bool):
+            if (messages := captured.get(channel.id)) is None:
+                await writer.add_channel(await TemplateChannel.from_channel(channel, limit=0), in_category=in_category)
+                return
+            digests, hashes, newest = messages
+            digest = await writer.add_channel(await TemplateChannel.from_channel(channel, limit=0), in_category=in_category, messages=(digests, hashes))
+            history["cursors"][str(channel.id)] = [newest, digest]
+
+        for category in categories.values():
+            await writer.add_category(TemplateCategory(name=category.name, position=category.position, permissions=_proper_overwrites_mapping(category.overwrites)))
+            for child in category.channels:
+                await add(child, True)
+        for channel in channels:
+            await add(channel, False)
+    except BaseException:
+        await writer.abort()
+        raise
+
+    writer.header.capture_time = time.perf_counter() - start
+    return writer, history
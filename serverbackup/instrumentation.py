@@ -0,0 +1,176 @@
+import contextvars
+import datetime
+import json
+import logging
+import re
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Iterator, List, Optional
+
+log = logging.getLogger("red.vcraycogs.serverbackup")
+
+# the report and phase the running task is in, tasks copy these from whoever created them.
+_current_report: "contextvars.ContextVar[Optional[OperationReport]]" = contextvars.ContextVar("serverbackup_report", default=None)
+_current_phase: "contextvars.ContextVar[Optional[PhaseStats]]" = contextvars.ContextVar("serverbackup_phase", default=None)
+
+_RETRY_AFTER = re.compile(r"[Rr]etrying in (\d+(?:\.\d+)?) seconds")
+
+
+class PhaseStats:
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.api_calls = 0
+        self.retries = 0
+        self.ratelimit_wait = 0.0
+
+    @property
+    def duration(self) -> float:
+        # steps of a phase can run concurrently, so this is the span from the first start to the last finish.
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.perf_counter()) - self.started
+
+    @property
+    def json(self):
+        return {
+            "name": self.name,
+            "duration": round(self.duration, 4),
+            "api_calls": self.api_calls,
+            "retries": self.retries,
+            "ratelimit_wait": round(self.ratelimit_wait, 3),
+        }
+
+
+class OperationReport:
+    """
+    Timing and API usage of one backup create or restore, split into phases."""
+    def __init__(self, kind: str, guild_id: Optional[int] = None, backup_id: Optional[str] = None) -> None:
+        self.kind = kind
+        self.guild_id = guild_id
+        self.backup_id = backup_id
+        self.started_at = datetime.datetime.now()
+        self._start = time.perf_counter()
+        self._end: Optional[float] = None
+        self.phases: Dict[str, PhaseStats] = {}
+        self.error: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        return (self._end or time.perf_counter()) - self._start
+
+    def get_phase(self, name: str) -> PhaseStats:
+        if (phase := self.phases.get(name)) is None:
+            phase = self.phases[name] = PhaseStats(name)
+        return phase
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[PhaseStats]:
+        """
+        Attribute everything done inside the block, including tasks started from it, to `name`."""
+        phase = self.get_phase(name)
+        now = time.perf_counter()
+        if phase.started is None:
+            phase.started = now
+        token = _current_phase.set(phase)
+        try:
+            yield phase
+        finally:
+            _current_phase.reset(token)
+            phase.finished = max(phase.finished or 0.0, time.perf_counter())
+
+    @contextmanager
+    def active(self) -> Iterator["OperationReport"]:
+        """
+        Make this the report `phase` records to inside the block."""
+        token = _current_report.set(self)
+        try:
+            yield self
+        finally:
+            _current_report.reset(token)
+
+    def finish(self):
+        if self._end is None:
+            self._end = time.perf_counter()
+
+    @property
+    def json(self):
+        return {
+            "kind": self.kind,
+            "guild_id": self.guild_id,
+            "backup_id": self.backup_id,
+            "started_at": self.started_at.timestamp(),
+            "duration": round(self.duration, 4),
+            "api_calls": sum(p.api_calls for p in self.phases.values()),
+            "error": self.error,
+            "phases": [p.json for p in self.phases.values()],
+        }
+
+
+@contextmanager
+def phase(name: str) -> Iterator[Optional[PhaseStats]]:
+    """
+    `OperationReport.phase` on the active report, does nothing if there isn't one."""
+    report = _current_report.get()
+    if report is None:
+        yield None
+        return
+
+    with report.phase(name) as stats:
+        yield stats
+
+
+def record_api_call(count: int = 1):
+    """
+    Count API requests against the current phase, does nothing outside of one."""
+    if (phase := _current_phase.get()) is not None:
+        phase.api_calls += count
+
+
+class _RateLimitHandler(logging.Handler):
+    # discord.py logs a warning with the wait time every time a request is rate limited and retried.
+    def emit(self, record: logging.LogRecord):
+        phase = _current_phase.get()
+        if phase is None:
+            return
+        try:
+            match = _RETRY_AFTER.search(record.getMessage())
+        except Exception:
+            return
+        if match:
+            phase.retries += 1
+            phase.ratelimit_wait += float(match.group(1))
+
+
+class Instrumentation:
+    """
+    Keeps the reports of the most recent operations and logs each one when it finishes."""
+    LOGGERS = ("discord.http", "discord.webhook")
+
+    def __init__(self, maxlen: int = 50) -> None:
+        self.reports: Deque[OperationReport] = deque(maxlen=maxlen)
+        self._handler = _RateLimitHandler(logging.WARNING)
+
+    def install(self):
+        for name in self.LOGGERS:
+            logging.getLogger(name).addHandler(self._handler)
+
+    def uninstall(self):
+        for name in self.LOGGERS:
+            logging.getLogger(name).removeHandler(self._handler)
+
+    def start(self, kind: str, guild_id: Optional[int] = None, backup_id: Optional[str] = None) -> OperationReport:
+        return OperationReport(kind, guild_id, backup_id)
+
+    def finish(self, report: OperationReport, error: Optional[BaseException] = None):
+        if error is not None:
+            report.error = f"{type(error).__name__}: {error}"
+        report.finish()
+        self.reports.append(report)
+        data = report.json
+        log.info("serverbackup %s finished: %s", report.kind, json.dumps(data), extra={"serverbackup_stats": data})
+
+    def for_guild(self, guild_id: int) -> List[OperationReport]:
+        return [r for r in self.reports if r.guild_id == guild_id]
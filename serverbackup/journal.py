@@ -0,0 +1,104 @@
+import asyncio
+import datetime
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import discord
+
+
+class RestoreJournal:
+    """
+    Checkpoints of a restore, written to disk as each step finishes.
+
+    It keeps what the restore planned to delete, the id of everything it created
+    and how many messages were replayed in each channel, which are only written every
+    few messages and once a channel's replay ends. A restore that stopped
+    halfway can be continued from it without repeating the requests that already went through."""
+    def __init__(self, path: Path, **kwargs) -> None:
+        self.path = Path(path)
+        self.guild_id: int = kwargs.get("guild_id")
+        self.backup_id: str = kwargs.get("backup_id")
+        self.started_at: float = kwargs.get("started_at") or datetime.datetime.now().timestamp()
+        # ids of the roles and channels that were in the guild before the restore started
+        self.deletes: Optional[Dict[str, List[int]]] = kwargs.get("deletes")
+        # step key -> id of the role or channel it created, None for steps that don't create anything
+        self.done: Dict[str, Optional[int]] = kwargs.get("done", {})
+        # channel step key -> number of its messages that were replayed
+        self.replayed: Dict[str, int] = kwargs.get("replayed", {})
+        self.guild: Optional[discord.Guild] = kwargs.get("guild") # not saved, set before the journal is used
+        # replayed messages are saved every this many messages or seconds, whichever comes first
+        self.replay_checkpoint: int = kwargs.get("replay_checkpoint", 25)
+        self.replay_interval: float = kwargs.get("replay_interval", 5.0)
+        self._unsaved = 0 # replayed messages since the last save
+        self._saved_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    @property
+    def json(self):
+        return {
+            "guild_id": self.guild_id,
+            "backup_id": self.backup_id,
+            "started_at": self.started_at,
+            "deletes": self.deletes,
+            "done": self.done,
+            "replayed": self.replayed,
+        }
+
+    @classmethod
+    def load(cls, path: Path) -> Optional["RestoreJournal"]:
+        try:
+            data = json.loads(Path(path).read_text())
+        except FileNotFoundError:
+            return None
+        return cls(path, **data)
+
+    def _write(self, data: str):
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(data)
+        os.replace(tmp, self.path)
+
+    async def save(self):
+        async with self._lock:
+            # dumped inside the lock so an older snapshot can never overwrite a newer one.
+            data = json.dumps(self.json)
+            self._unsaved, self._saved_at = 0, time.monotonic()
+            await asyncio.get_running_loop().run_in_executor(None, self._write, data)
+
+    async def clear(self):
+        async with self._lock:
+            try:
+                self.path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def is_done(self, key: str) -> bool:
+        return key in self.done
+
+    def resolve(self, key: str) -> Any:
+        """
+        The role or channel a finished step created, None if it's gone since."""
+        id = self.done.get(key)
+        if id is None:
+            return None
+        return self.guild.get_role(id) or self.guild.get_channel(id)
+
+    async def record(self, key: str, result: Any):
+        # only the roles and channels steps create are needed again, anything else is just marked as done.
+        self.done[key] = getattr(result, "id", None)
+        await self.save()
+
+    async def record_replayed(self, key: str, count: int):
+        # saving rewrites the whole journal, a few messages sent twice after a crash are cheaper than that after every one.
+        self.replayed[key] = count
+        self._unsaved += 1
+        if self._unsaved >= self.replay_checkpoint or time.monotonic() - self._saved_at >= self.replay_interval:
+            await self.save()
+
+    async def flush(self):
+        """
+        Save the replayed messages that weren't saved by a checkpoint yet."""
+        if self._unsaved:
+            await self.save()
@@ -1,9 +1,33 @@
+import asyncio
+import base64
+import contextlib
 import datetime
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+import aiohttp
 import discord
 from redbot.core import Config, commands
 from redbot.core.bot import Red
+from redbot.core.data_manager import cog_data_path
+from redbot.core.commands import TimedeltaConverter
+from redbot.core.utils.chat_formatting import box, humanize_number, humanize_timedelta
+from redbot.core.utils.menus import DEFAULT_CONTROLS, menu
+from redbot.core.utils.predicates import MessagePredicate
+from . import serialization
+from .autobackup import AutoBackupScheduler, select_evictions
+from .cache import AssetCache
+from .chunks import ChunkedBackups
+from .history import RequestBudget, capture_backup
+from .instrumentation import Instrumentation, phase
+from .journal import RestoreJournal
+from .mirror import MAX_MESSAGES, GuildMirror
 from .models import Template
+from .replay import MessageReplayer
+from .storage import BACKENDS, BackupStore, open_store
+from .transfer import export_to_file, import_lines
 
 log = logging.getLogger("red.vcraycogs.serverbackup")
 
@@ -12,9 +36,49 @@ class ServerBackup(commands.Cog):
         self.bot = bot
         
         self.config = Config.get_conf(self, 987654321, force_registration=True)
-        self.config.register_guild(last_use=None, last_backup=None)
+        self.config.register_guild(last_use=None, last_backup=None, capture_concurrency=5, restore_concurrency=5, capture_attachments=False)
+        # auto backups keep their own timestamps so they don't count against the manual `backup create` limit.
+        self.config.register_guild(
+            auto_backup_interval=None,
+            next_auto_backup=None,
+            last_auto_backup=None,
+            retention={"keep_last": 7, "keep_daily": 7, "keep_weekly": 4},
+        )
+        self.config.register_guild(live_mirror=False, history_depth=3)
+        
+        self.config.register_global(schema_version=0, compress_backups=True, storage_backend="sqlite", cache_size=500, auto_backup_concurrency=2)
+        # the most history requests one backup of a guild can make, None for no limit
+        self.config.register_global(history_request_budget=None)
         
+        # only read to migrate backups stored before they were moved to `self.store`
         self.config.init_custom("BACKUP", 1)
+        # id -> Template.index_json, so listing and looking up backups never has to load them.
+        self.config.init_custom("BACKUP_INDEX", 1)
+        self._index_lock = asyncio.Lock()
+        self.store: Optional[BackupStore] = None
+        self.backups: Optional[ChunkedBackups] = None # reads and writes backups to `self.store`
+        # a backend move waits for everything using `self.backups` and holds off anything new until it's done.
+        self._store_users = 0
+        self._store_idle = asyncio.Event()
+        self._store_moved: Optional[asyncio.Event] = None # set once the running move is done
+        # encoding and decoding large backups runs here instead of on the event loop.
+        self._codec = ThreadPoolExecutor(max_workers=2, thread_name_prefix="serverbackup-codec")
+        
+        # one session for every download the cog makes, and a cache so each file is only downloaded once.
+        self.session = aiohttp.ClientSession()
+        self.cache = AssetCache(cog_data_path(self) / "assets", self.session)
+        # guild id -> the message replay of its latest restore, which keeps running in the background
+        self._replays: Dict[int, MessageReplayer] = {}
+        
+        self.instrumentation = Instrumentation()
+        self.instrumentation.install()
+        
+        self.auto_backups = AutoBackupScheduler(self.bot, self.config, self._auto_backup)
+        self.auto_backups.start()
+        
+        # guild id -> a template kept up to date from events, so backups of these guilds need no API calls.
+        self.mirrors: Dict[int, GuildMirror] = {}
+        self._mirror_task = asyncio.create_task(self._start_mirrors())
         
     # TODO
     # make commands to scroll through backups
@@ -22,10 +86,277 @@ class ServerBackup(commands.Cog):
     # restore backups
     # make a backup of the current server
     
-    async def get_all_templates(self):
-        templates = await self.config.custom("BACKUP").all()
-        templates = [Template.from_json(template) for id, template in templates.items()]
-        return templates
+    def cog_unload(self):
+        self.auto_backups.stop()
+        self._mirror_task.cancel()
+        self.instrumentation.uninstall()
+        if self.store is not None:
+            self.store.close()
+        self._codec.shutdown(wait=False)
+        for replayer in self._replays.values():
+            if replayer.task is not None:
+                replayer.task.cancel()
+        asyncio.create_task(self.cache.flush())
+        asyncio.create_task(self.session.close())
+    
+    async def _load_legacy(self, stored: dict) -> Template:
+        # backups kept in config before they had their own store
+        if "data" in stored:
+            return await serialization.decode_async(base64.b64decode(stored["data"]), executor=self._codec)
+        
+        # the old json layout is checked all the way down first, so a broken backup says what's wrong with it
+        await serialization.validate_async(stored, executor=self._codec)
+        return await serialization.decode_async(stored, executor=self._codec)
+    
+    async def _ensure_ready(self):
+        async with self._index_lock:
+            if self.store is None:
+                self.store = open_store(await self.config.storage_backend(), cog_data_path(self))
+                self.backups = ChunkedBackups(self.store, compress=await self.config.compress_backups(), executor=self._codec)
+                self.cache.max_size = await self.config.cache_size() * 1024 * 1024
+                
+            version = await self.config.schema_version()
+            if version >= 4:
+                return
+            
+            # these only ever run once per bot.
+            index = await self.config.custom("BACKUP_INDEX").all()
+            if version < 3:
+                for id, stored in (await self.config.custom("BACKUP").all()).items():
+                    try:
+                        template = await self._load_legacy(stored)
+                    except (KeyError, TypeError, ValueError) as e:
+                        # one broken backup shouldn't keep the others from being migrated
+                        log.warning("Couldn't migrate backup %s, it's left out: %s", id, e)
+                        index.pop(id, None)
+                        continue
+                    size, new = await self.backups.put(template)
+                    index[id] = {**template.index_json, "size": size, "stored": new}
+                    
+            # backups stored whole are split into chunks so they share them with newer ones.
+            for id in list(index):
+                if (data := await self.store.get(id)) is not None and not serialization.is_chunked(data):
+                    template = await serialization.decode_async(data, executor=self._codec)
+                    size, new = await self.backups.put(template)
+                    index[id] = {**index[id], "size": size, "stored": new}
+                
+            await self.config.custom("BACKUP_INDEX").set(index)
+            await self.config.custom("BACKUP").clear()
+            await self.config.schema_version.set(4)
+            
+    async def get_index(self) -> dict:
+        await self._ensure_ready()
+        return await self.config.custom("BACKUP_INDEX").all()
+    
+    async def get_index_entry(self, id: str) -> Optional[dict]:
+        await self._ensure_ready()
+        return await self.config.custom("BACKUP_INDEX", id).all() or None
+    
+    @contextlib.asynccontextmanager
+    async def _using_store(self):
+        # held by whatever reads or writes backups, so the store isn't moved and closed under it.
+        while self._store_moved is not None:
+            await self._store_moved.wait()
+        self._store_users += 1
+        try:
+            await self._ensure_ready()
+            yield
+        finally:
+            self._store_users -= 1
+            if not self._store_users:
+                self._store_idle.set()
+    
+    async def get_template(self, id: str) -> Optional[Template]:
+        async with self._using_store():
+            # messages are only needed by restores, which decode them channel by channel as they replay.
+            return await self.backups.get(id, lazy=True)
+    
+    async def save_template(self, template: Template, *, auto: bool = False):
+        # only called while the store is in use
+        await self._ensure_ready()
+        # size counts every chunk the backup uses, stored only the ones no other backup had.
+        size, stored = await self.backups.put(template)
+        # hashing the whole template is as slow as encoding it
+        index_json = await serialization.run_in_executor(getattr, template, "index_json", executor=self._codec)
+        entry = {**index_json, "size": size, "stored": stored}
+        if auto:
+            # only these are removed by the retention policy
+            entry["auto"] = True
+        await self.config.custom("BACKUP_INDEX", template.id).set(entry)
+        
+    async def record_use(self, id: str):
+        # only the use count changes, the rest of the backup and its index entry stay as they are.
+        async with self._using_store():
+            entry = self.config.custom("BACKUP_INDEX", id)
+            uses = await entry.get_raw("uses", default=0) + 1
+            await self.backups.set_uses(id, uses)
+            await entry.set_raw("uses", value=uses)
+        
+    async def delete_template(self, id: str):
+        async with self._using_store():
+            await self.backups.delete(id)
+            await self.config.custom("BACKUP_INDEX", id).clear()
+    
+    def _journal_path(self, guild: discord.Guild) -> Path:
+        path = cog_data_path(self) / "journals"
+        path.mkdir(exist_ok=True)
+        return path / f"{guild.id}.json"
+    
+    async def _run_restore(self, guild: discord.Guild, template: Template, journal: RestoreJournal):
+        report = self.instrumentation.start("restore", guild.id, template.id)
+        concurrency = await self.config.guild(guild).restore_concurrency()
+        try:
+            replayer = await template.apply_to_guild(
+                guild,
+                concurrency=concurrency,
+                cache=self.cache,
+                background_replay=True,
+                progress=self._replay_progress(),
+                report=report,
+                journal=journal,
+                executor=self._codec
+            )
+        except Exception as e:
+            # the journal stays so `backup resume` can pick up from here.
+            self.instrumentation.finish(report, e)
+            raise
+        
+        def done(task: asyncio.Task):
+            # the report and journal are done once the background replay is.
+            error = None if task.cancelled() else task.exception()
+            self.instrumentation.finish(report, error)
+            if not task.cancelled() and error is None:
+                asyncio.create_task(journal.clear())
+        
+        replayer.task.add_done_callback(done)
+        self._replays[guild.id] = replayer
+        return replayer
+    
+    def _replay_progress(self, interval: int = 5):
+        status: Optional[discord.Message] = None
+        last_edit = 0.0
+        
+        async def progress(replayer: MessageReplayer):
+            nonlocal status, last_edit
+            finished = replayer.sent + replayer.failed >= replayer.total
+            if replayer.status_channel is None or (not finished and time.monotonic() - last_edit < interval):
+                return
+            
+            content = f"Replaying messages: {replayer.sent}/{replayer.total} sent"
+            if replayer.failed:
+                content += f", {replayer.failed} failed"
+            if finished:
+                content += ". Done."
+                
+            last_edit = time.monotonic()
+            try:
+                if status is None:
+                    status = await replayer.status_channel.send(content)
+                else:
+                    await status.edit(content=content)
+            except discord.HTTPException:
+                pass
+            
+        return progress
+    
+    async def _latest_backup(self, guild: discord.Guild, owner: discord.abc.Snowflake) -> Optional[dict]:
+        entries = [e for e in (await self.get_index()).values() if e["original_guild_id"] == guild.id and e["owner"] == owner.id]
+        return max(entries, key=lambda e: e["created_at"], default=None)
+    
+    async def _create_backup(self, guild: discord.Guild, owner: discord.abc.Snowflake, *, auto: bool = False) -> Tuple[Template, Optional[str]]:
+        """
+        Capture and store a backup of the guild.
+        
+        If the owner's latest backup of the guild has the same content, nothing is stored
+        and the id of that backup is returned along with the template. Backups that aren't
+        made from the live mirror are captured straight to storage, their template only has
+        the header and no roles or channels."""
+        report = self.instrumentation.start("auto" if auto else "create", guild.id)
+        async with self._using_store():
+            try:
+                conf = await self.config.guild(guild).all()
+                cache = self.cache if conf["capture_attachments"] else None
+                # older index entries don't have a hash, those are never treated as unchanged.
+                latest = await self._latest_backup(guild, owner)
+                if (mirror := self.mirrors.get(guild.id)) is not None and mirror.ready and mirror.messages == conf["history_depth"]:
+                    with report.active(), phase("capture:mirror"):
+                        template = await mirror.snapshot(owner, cache=cache)
+                    report.backup_id = template.id
+                
+                    content_hash = await serialization.run_in_executor(getattr, template, "content_hash", executor=self._codec)
+                    if latest and latest.get("hash") == content_hash:
+                        self.instrumentation.finish(report)
+                        return template, latest["id"]
+                
+                    with report.active(), phase("store"):
+                        await self.save_template(template, auto=auto)
+                else:
+                    # only messages newer than the latest backup's are fetched, its stored ones are reused.
+                    with report.active():
+                        writer, history = await capture_backup(
+                            guild,
+                            owner,
+                            self.backups,
+                            depth=conf["history_depth"],
+                            concurrency=conf["capture_concurrency"],
+                            budget=RequestBudget(await self.config.history_request_budget()),
+                            cache=cache,
+                            previous=latest and latest.get("history"),
+                        )
+                    template = writer.header
+                    report.backup_id = template.id
+                
+                    if latest and latest.get("hash") == writer.content_hash:
+                        await writer.abort()
+                        self.instrumentation.finish(report)
+                        return template, latest["id"]
+                
+                    with report.active(), phase("store"):
+                        size, stored = await writer.finish()
+                    entry = {**writer.index_json, "size": size, "stored": stored, "history": history}
+                    if auto:
+                        entry["auto"] = True
+                    await self.config.custom("BACKUP_INDEX", template.id).set(entry)
+            except Exception as e:
+                self.instrumentation.finish(report, e)
+                raise
+            finally:
+                # the cached attachments' urls are written once per capture
+                await self.cache.flush()
+        
+        self.instrumentation.finish(report)
+        return template, None
+    
+    async def _auto_backup(self, guild: discord.Guild):
+        _, unchanged = await self._create_backup(guild, discord.Object(guild.owner_id), auto=True)
+        if unchanged:
+            return
+        
+        retention = await self.config.guild(guild).retention()
+        entries = [e for e in (await self.get_index()).values() if e.get("auto") and e["original_guild_id"] == guild.id]
+        for id in select_evictions(entries, **retention):
+            await self.delete_template(id)
+    
+    async def _start_mirrors(self):
+        await self.bot.wait_until_red_ready()
+        for guild_id, data in (await self.config.all_guilds()).items():
+            if data.get("live_mirror") and (guild := self.bot.get_guild(guild_id)) is not None:
+                try:
+                    await self._add_mirror(guild)
+                except Exception as e:
+                    log.exception("Couldn't build the live mirror of guild %s.", guild_id, exc_info=e)
+    
+    async def _add_mirror(self, guild: discord.Guild) -> Optional[GuildMirror]:
+        # a mirror only keeps shallow histories. with a deeper one it's paused, backups are captured
+        # from discord and nothing is kept up to date until the depth fits again.
+        depth = await self.config.guild(guild).history_depth()
+        if depth > MAX_MESSAGES:
+            self.mirrors.pop(guild.id, None)
+            return None
+        # added before it's built so events that come in meanwhile aren't lost.
+        mirror = self.mirrors[guild.id] = GuildMirror(guild, messages=depth)
+        await mirror.build(concurrency=await self.config.guild(guild).capture_concurrency())
+        return mirror
     
     def greater_than_7_days(self, timestamp: int):
         date = datetime.datetime.fromtimestamp(timestamp)
@@ -51,34 +382,413 @@ class ServerBackup(commands.Cog):
         await ctx.send("Creating backup. This can take a while.")
         async with ctx.typing():
             try:
-                template = await Template.from_guild(ctx.guild, ctx.author)
-                json = template.json
-                await self.config.custom("BACKUP", template.id).set(json)
-                await ctx.send("Backup created and saved with the id: `{}`".format(template.id))
+                template, unchanged = await self._create_backup(ctx.guild, ctx.author)
+                if unchanged:
+                    return await ctx.send(f"Nothing changed since your last backup `{unchanged}`, so no new backup was stored.")
+                await ctx.send("Backup created and saved with the id: `{}` (captured in {:.2f}s)".format(template.id, template.capture_time))
             
             except Exception as e:
                 log.exception("Error occurred while creating backup.", exc_info=e)
             
+    @backup.command(name="stats")
+    async def backup_stats(self, ctx: commands.Context, count: int = 3):
+        """
+        See how long the latest backups and restores of this server took.
+        
+        Shows the time, API calls and rate limits of each phase of the last `count` operations, up to 5.
+        """
+        if not 1 <= count <= 5:
+            # 5 full fields are as much as fits in one embed
+            return await ctx.send("`count` must be between 1 and 5.")
+        
+        reports = self.instrumentation.for_guild(ctx.guild.id)[-count:]
+        if not reports:
+            return await ctx.send("No backups or restores of this server have been recorded since the cog was loaded.")
+        
+        embed = discord.Embed(title="**Backup Stats**")
+        for report in reversed(reports):
+            lines = [
+                f"{name:<18} {p.duration:>8.2f}s {p.api_calls:>5} calls {p.retries:>3} retries {p.ratelimit_wait:>6.1f}s waited"
+                for name, p in report.phases.items()
+            ]
+            if report.error:
+                lines.append(f"failed: {report.error}"[:200])
+            timestamp = f"<t:{int(report.started_at.timestamp())}:R>\n"
+            # whole lines are dropped before boxing so the box is always closed, fields can't be longer than 1024.
+            room = 1024 - len(timestamp) - len(box("")) - len("\n...")
+            shown = []
+            for line in lines:
+                if sum(len(l) + 1 for l in shown) + len(line) > room:
+                    shown.append("...")
+                    break
+                shown.append(line)
+            embed.add_field(
+                name=f"{report.kind} {report.backup_id} - {report.duration:.2f}s",
+                value=timestamp + box("\n".join(shown) or "No phases recorded."),
+                inline=False
+            )
+        await ctx.send(embed=embed)
+        
+    @backup.command(name="concurrency")
+    async def backup_concurrency(self, ctx: commands.Context, kind: str, limit: int = None):
+        """
+        See or set how many requests backups send to discord at once.
+        
+        `kind` is either `capture` (used by `backup create`) or `restore` (used by `backup restore`).
+        Higher values are faster but send more requests to discord at the same time.
+        """
+        kind = kind.lower()
+        if kind not in ("capture", "restore"):
+            return await ctx.send("`kind` must be either `capture` or `restore`.")
+        
+        value = getattr(self.config.guild(ctx.guild), f"{kind}_concurrency")
+        if limit is None:
+            return await ctx.send(f"The {kind} limit for this server is {await value()} requests at a time.")
+        
+        if not 1 <= limit <= 25:
+            return await ctx.send("The limit must be between 1 and 25.")
+        
+        await value.set(limit)
+        await ctx.send(f"The {kind} limit for this server is now {limit} requests at a time.")
+            
+    @backup.command(name="attachments")
+    async def backup_attachments(self, ctx: commands.Context, enabled: bool = None):
+        """
+        See or set whether backups of this server keep the files attached to messages.
+        
+        Attachment links stop working after a while, stored files can still be sent when the backup is restored.
+        """
+        if enabled is None:
+            enabled = await self.config.guild(ctx.guild).capture_attachments()
+            return await ctx.send(f"Attachments are {'' if enabled else 'not '}stored in backups of this server.")
+        
+        await self.config.guild(ctx.guild).capture_attachments.set(enabled)
+        await ctx.send(f"Attachments will {'' if enabled else 'not '}be stored in backups of this server.")
+            
+    @backup.command(name="mirror")
+    async def backup_mirror(self, ctx: commands.Context, enabled: bool = None):
+        """
+        See or set whether this server is mirrored live.
+        
+        A live mirror is kept up to date as channels, roles and messages change, so backups
+        are made from it instantly without fetching anything from discord.
+        """
+        if enabled is None:
+            enabled = await self.config.guild(ctx.guild).live_mirror()
+            if enabled and ctx.guild.id not in self.mirrors and await self.config.guild(ctx.guild).history_depth() > MAX_MESSAGES:
+                return await ctx.send(f"The live mirror of this server is paused until backups keep {MAX_MESSAGES} messages per channel or less.")
+            return await ctx.send(f"This server is {'' if enabled else 'not '}mirrored live.")
+        
+        await self.config.guild(ctx.guild).live_mirror.set(enabled)
+        if not enabled:
+            self.mirrors.pop(ctx.guild.id, None)
+            return await ctx.send("This server is no longer mirrored live.")
+        
+        if ctx.guild.id not in self.mirrors:
+            async with ctx.typing():
+                if await self._add_mirror(ctx.guild) is None:
+                    return await ctx.send(
+                        f"This server will be mirrored live once backups keep {MAX_MESSAGES} messages per channel or less, "
+                        "see `backup history`. Until then backups are fetched from discord."
+                    )
+        await ctx.send("This server is now mirrored live, backups will be made from the mirror.")
+        
+    @backup.command(name="history")
+    async def backup_history(self, ctx: commands.Context, depth: int = None):
+        """
+        See or set how many messages of each text channel backups of this server keep.
+        
+        Up to 10000 messages per channel can be kept. Messages are fetched 100 at a time and
+        later backups only fetch the messages sent since the last one.
+        """
+        if depth is None:
+            depth = await self.config.guild(ctx.guild).history_depth()
+            return await ctx.send(f"Backups of this server keep the latest {depth} messages of each channel.")
+        
+        if not 0 <= depth <= 10000:
+            return await ctx.send("The number of messages must be between 0 and 10000.")
+        
+        await self.config.guild(ctx.guild).history_depth.set(depth)
+        mirror = self.mirrors.get(ctx.guild.id)
+        if await self.config.guild(ctx.guild).live_mirror() and (mirror is None or mirror.messages != depth):
+            # rebuilt with buffers of the new size, or paused if it can't keep that many
+            async with ctx.typing():
+                mirror = await self._add_mirror(ctx.guild)
+            if mirror is None:
+                await ctx.send(f"The live mirror only keeps up to {MAX_MESSAGES} messages, it's paused and backups will be fetched from discord instead.")
+        await ctx.send(f"Backups of this server will now keep the latest {depth} messages of each channel.")
+        
+    @backup.command(name="budget")
+    @commands.is_owner()
+    async def backup_budget(self, ctx: commands.Context, requests: int = None):
+        """
+        See or set the most history requests one backup of a server can make.
+        
+        Applies to every server. Channels the budget runs out for keep fewer messages.
+        Use 0 to remove the limit.
+        """
+        if requests is None:
+            budget = await self.config.history_request_budget()
+            return await ctx.send(f"Backups can make {'any number of' if budget is None else budget} history requests.")
+        
+        if requests < 0:
+            return await ctx.send("The budget can't be negative.")
+        
+        await self.config.history_request_budget.set(requests or None)
+        await ctx.send(f"Backups can now make {requests or 'any number of'} history requests.")
+        
+    @backup.group(name="auto", invoke_without_command=True)
+    async def backup_auto(self, ctx: commands.Context):
+        """
+        See the automatic backup settings of this server.
+        """
+        conf = await self.config.guild(ctx.guild).all()
+        if not conf["auto_backup_interval"]:
+            return await ctx.send(f"Automatic backups are off for this server. Turn them on with `{ctx.clean_prefix}backup auto interval`.")
+        
+        retention = conf["retention"]
+        lines = [f"Automatic backups are made every {humanize_timedelta(seconds=conf['auto_backup_interval'])}."]
+        if conf["last_auto_backup"]:
+            lines.append(f"Last backup: <t:{int(conf['last_auto_backup'])}:R>")
+        if conf["next_auto_backup"]:
+            lines.append(f"Next backup: <t:{int(conf['next_auto_backup'])}:R>")
+        lines.append(
+            f"Keeping the last {retention['keep_last']} backups, one a day for {retention['keep_daily']} days "
+            f"and one a week for {retention['keep_weekly']} weeks."
+        )
+        await ctx.send("\n".join(lines))
+        
+    @backup_auto.command(name="interval")
+    async def backup_auto_interval(self, ctx: commands.Context, *, interval: TimedeltaConverter(minimum=datetime.timedelta(hours=1), default_unit="hours") = None):
+        """
+        Set how often this server is backed up automatically.
+        
+        The interval must be at least an hour, leave it out to turn automatic backups off.
+        Backups are spread out so they don't all happen at the same time, so each one can be a bit earlier or later than the interval.
+        """
+        conf = self.config.guild(ctx.guild)
+        # resetting the next run lets the scheduler place this server's first backup again.
+        await conf.next_auto_backup.clear()
+        if interval is None:
+            await conf.auto_backup_interval.clear()
+            return await ctx.send("Automatic backups are now off for this server.")
+        
+        await conf.auto_backup_interval.set(int(interval.total_seconds()))
+        await ctx.send(f"This server will now be backed up every {humanize_timedelta(timedelta=interval)}.")
+        
+    @backup_auto.command(name="retention")
+    async def backup_auto_retention(self, ctx: commands.Context, keep_last: int, keep_daily: int = 0, keep_weekly: int = 0):
+        """
+        Set which automatic backups of this server are kept.
+        
+        The newest `keep_last` backups are always kept, along with the newest backup of each of the
+        last `keep_daily` days and `keep_weekly` weeks. Every other automatic backup is deleted after a new one is made.
+        Backups made with `backup create` are never deleted.
+        """
+        if min(keep_last, keep_daily, keep_weekly) < 0:
+            return await ctx.send("The numbers can't be negative.")
+        
+        if not keep_last + keep_daily + keep_weekly:
+            return await ctx.send("At least one backup has to be kept.")
+        
+        await self.config.guild(ctx.guild).retention.set({"keep_last": keep_last, "keep_daily": keep_daily, "keep_weekly": keep_weekly})
+        await ctx.send("Retention policy updated.")
+        
+    @backup_auto.command(name="concurrency")
+    @commands.is_owner()
+    async def backup_auto_concurrency(self, ctx: commands.Context, limit: int = None):
+        """
+        See or set how many servers can be backed up automatically at the same time.
+        
+        Applies to every server, backups that are due while the limit is reached wait for the next check.
+        """
+        if limit is None:
+            limit = await self.config.auto_backup_concurrency()
+            return await ctx.send(f"Up to {limit} servers are backed up automatically at the same time.")
+        
+        if limit < 1:
+            return await ctx.send("The limit must be at least 1.")
+        
+        await self.config.auto_backup_concurrency.set(limit)
+        await ctx.send(f"Up to {limit} servers will now be backed up automatically at the same time.")
+        
     @backup.command(name="list")
     async def backup_list(self, ctx: commands.Context):
         """
-        List all backups
+        List the backups of this server and the ones you own
         """
-        templates = await self.get_all_templates()
+        guild_id = ctx.guild.id if ctx.guild else None
+        templates = sorted(
+            (e for e in (await self.get_index()).values() if e["original_guild_id"] == guild_id or e["owner"] == ctx.author.id),
+            key=lambda e: e["created_at"],
+            reverse=True
+        )
         if not templates:
             await ctx.send("No backups found.")
             return
-        embed = discord.Embed(
-            title="**Stored Server Backups**",
-            description="\n\n".join(
-                [
-                    f"**{template.id}**\nCreated at: <t:{int(template.created_at.timestamp())}:R>"
-                    f"\n{len(template._channels)} channels and {len(template._roles)} roles" 
-                    for template in templates
-                ]
+        
+        # a few backups per page keeps every page far below the description limit
+        per_page = 5
+        pages = []
+        for start in range(0, len(templates), per_page):
+            embed = discord.Embed(
+                title="**Stored Server Backups**",
+                description="\n\n".join(
+                    [
+                        f"**{template['id']}**\nCreated at: <t:{int(template['created_at'])}:R>"
+                        f"\n{template['channel_count']} channels and {template['role_count']} roles"
+                        f"\n{humanize_number(template.get('size', 0))} bytes, {humanize_number(template.get('stored', template.get('size', 0)))} of them not shared with older backups" 
+                        for template in templates[start:start + per_page]
+                    ]
+                )
             )
-        )
-        await ctx.send(embed=embed)
+            embed.set_footer(text=f"Page {len(pages) + 1}/{-(-len(templates) // per_page)}, {len(templates)} backups")
+            pages.append(embed)
+        
+        if len(pages) == 1:
+            return await ctx.send(embed=pages[0])
+        await menu(ctx, pages, DEFAULT_CONTROLS)
+        
+    @backup.command(name="storage")
+    @commands.is_owner()
+    async def backup_storage(self, ctx: commands.Context, backend: str = None):
+        """
+        See or change where backups are stored.
+        
+        `backend` can be `sqlite` (one database file) or `file` (one file per backup).
+        Changing it moves every stored backup to the new backend.
+        """
+        index = await self.get_index()
+        if backend is None:
+            total = sum(entry.get("size", 0) for entry in index.values())
+            async with self._using_store():
+                used = await self.backups.total_size()
+            return await ctx.send(
+                f"Backups are stored with the `{self.store.name}` backend.\n"
+                f"{len(index)} backups using {humanize_number(used)} bytes "
+                f"({humanize_number(total)} bytes before deduplication)."
+            )
+            
+        backend = backend.lower()
+        if backend not in BACKENDS:
+            return await ctx.send(f"`backend` must be one of: {', '.join(BACKENDS)}")
+        
+        while self._store_moved is not None:
+            await self._store_moved.wait()
+        if backend == self.store.name:
+            return await ctx.send(f"Backups are already stored with the `{backend}` backend.")
+        
+        moved = self._store_moved = asyncio.Event()
+        try:
+            async with ctx.typing():
+                # backups and restores that already started finish with the old store, new ones wait for the new one.
+                while self._store_users:
+                    self._store_idle.clear()
+                    await self._store_idle.wait()
+                
+                async with self._index_lock:
+                    new = open_store(backend, cog_data_path(self))
+                    # chunks are copied as they are, they're the same on every backend. batches are kept
+                    # to a few MiB, whole backups from before chunks existed can be large.
+                    ids = await self.store.ids()
+                    batch, batch_size = [], 0
+                    for id in ids:
+                        batch.append(id)
+                        batch_size += await self.store.size(id) or 0
+                        if len(batch) == 500 or batch_size >= 8 * 1024 * 1024:
+                            await new.put_many(await self.store.get_many(batch))
+                            batch, batch_size = [], 0
+                    if batch:
+                        await new.put_many(await self.store.get_many(batch))
+                    await self.store.delete_many(ids)
+                    
+                    self.store.close()
+                    self.store = new
+                    self.backups = ChunkedBackups(new, compress=self.backups.compress, executor=self._codec)
+                    await self.config.storage_backend.set(backend)
+        finally:
+            self._store_moved = None
+            moved.set()
+        
+        await ctx.send(f"Moved {len(index)} backups to the `{backend}` backend.")
+        
+    @backup.command(name="diff")
+    async def backup_diff(self, ctx: commands.Context, id1: str, id2: str):
+        """
+        See what changed between two backups.
+        
+        The ids can be seen with `backup list`, changes are shown going from `id1` to `id2`.
+        """
+        entries = [await self.get_index_entry(id) for id in (id1, id2)]
+        if not all(entries):
+            return await ctx.send("Backup not found.")
+        
+        if any(entry["owner"] != ctx.author.id for entry in entries) and not await self.bot.is_owner(ctx.author):
+            return await ctx.send("You can only compare your own backups.")
+        
+        if entries[0].get("hash") and entries[0].get("hash") == entries[1].get("hash"):
+            # no need to load either of them
+            return await ctx.send("These backups are identical.")
+        
+        async with ctx.typing(), self._using_store():
+            # only the parts the two don't share are read
+            diff = await self.backups.diff(id1, id2)
+        if diff is None:
+            return await ctx.send("Backup not found.")
+        if not len(diff):
+            return await ctx.send("These backups are identical.")
+        
+        await ctx.send(f"{len(diff)} differences from `{id1}` to `{id2}`:\n" + box(diff.summary(), "diff"))
+        
+    @backup.command(name="export")
+    async def backup_export(self, ctx: commands.Context, id: str):
+        """
+        Export a backup as a file.
+        
+        The file can be imported again with `backup import`, on this bot or another one.
+        """
+        if not (entry := await self.get_index_entry(id)):
+            return await ctx.send("Backup not found.")
+        
+        if entry["owner"] != ctx.author.id and not await self.bot.is_owner(ctx.author):
+            return await ctx.send("You can only export your own backups.")
+        
+        # written to disk a piece at a time, the backup is never loaded whole.
+        path = cog_data_path(self) / "exports" / f"{id}-{ctx.message.id}.ndjson.gz"
+        try:
+            async with ctx.typing(), self._using_store():
+                size = await export_to_file(self.backups, id, path, executor=self._codec)
+            if size > ctx.guild.filesize_limit:
+                return await ctx.send(f"The exported backup is {humanize_number(size)} bytes, more than the {humanize_number(ctx.guild.filesize_limit)} bytes that can be uploaded here.")
+            await ctx.send(f"Backup `{id}` exported.", file=discord.File(str(path), filename=f"backup-{id}.ndjson.gz"))
+        finally:
+            path.unlink(missing_ok=True)
+            
+    @backup.command(name="import")
+    async def backup_import(self, ctx: commands.Context):
+        """
+        Import a backup from a file made with `backup export`.
+        
+        Attach the file to the command. The imported backup gets a new id and belongs to you.
+        """
+        if not ctx.message.attachments:
+            return await ctx.send("Attach an exported backup to the command.")
+        
+        attachment = ctx.message.attachments[0]
+        async with ctx.typing(), self._using_store():
+            try:
+                # read as it downloads, each line is checked and stored before the next one is read.
+                async with self.session.get(attachment.url) as resp:
+                    resp.raise_for_status()
+                    entry = await import_lines(self.backups, resp.content.iter_chunked(64 * 1024), owner=ctx.author, executor=self._codec)
+            except aiohttp.ClientError as e:
+                log.debug("Couldn't download backup %s.", attachment.url, exc_info=e)
+                return await ctx.send("Couldn't download the file.")
+            except ValueError as e:
+                return await ctx.send(f"Couldn't import the backup: {e}")
+        
+        await self.config.custom("BACKUP_INDEX", entry["id"]).set(entry)
+        await ctx.send(f"Backup imported with the id: `{entry['id']}` ({entry['channel_count']} channels and {entry['role_count']} roles)")
         
     @backup.command(name="delete")
     async def backup_delete(self, ctx: commands.Context, id: str):
@@ -87,14 +797,14 @@ class ServerBackup(commands.Cog):
         
         `id` is the template id which you can see with `backup list`
         """
-        if not (temp:=(await self.config.custom("BACKUP").all()).get(id)):
+        if not (temp:=await self.get_index_entry(id)):
             await ctx.send("Backup not found.")
             return
         
         if temp["owner"] != ctx.author.id:
             return await ctx.send("You can only delete your own backups and you do now own this backup.")
         
-        await self.config.custom("BACKUP", id).clear()
+        await self.delete_template(id)
         await ctx.send("Backup deleted.")
         
     @backup.command(name="restore")
@@ -105,16 +815,162 @@ class ServerBackup(commands.Cog):
         
         `id` is the template id which you can see with `backup list`
         """
-        if not (temp:=(await self.config.custom("BACKUP").all()).get(id)):
+        if not await self.get_index_entry(id):
             await ctx.send("Backup not found.")
             return
         
         if (timestamp:=await self.config.guild(ctx.guild).last_use()) and self.greater_than_7_days(timestamp):
             return await ctx.send("You can only restore one backup every 7 days")
         
-        template = Template.from_json(temp)
+        if (replayer:=self._replays.get(ctx.guild.id)) and not replayer.done:
+            return await ctx.send("Messages from the last restore are still being replayed, try again once that's finished.")
+        
+        if self._journal_path(ctx.guild).exists():
+            await ctx.send(
+                "A restore of this server didn't finish. Use `backup resume` to continue it, "
+                "or say `yes` to discard it and start this restore."
+            )
+            pred = MessagePredicate.yes_or_no(ctx)
+            try:
+                await self.bot.wait_for("message", check=pred, timeout=60)
+            except asyncio.TimeoutError:
+                pred.result = False
+            if not pred.result:
+                ctx.command.reset_cooldown(ctx)
+                return await ctx.send("Cancelled.")
+        
+        template = await self.get_template(id)
+        journal = RestoreJournal(self._journal_path(ctx.guild), guild_id=ctx.guild.id, backup_id=template.id)
         await ctx.send("Restoring backup. This can take a while.")
         async with ctx.typing():
-            await template.apply_to_guild(ctx.guild)
-            template.uses += 1
-            await self.config.custom("BACKUP", template.id).set(template.json)
\ No newline at end of file
+            await self._run_restore(ctx.guild, template, journal)
+            await self.record_use(template.id)
+            
+    @backup.command(name="resume")
+    async def backup_resume(self, ctx: commands.Context):
+        """
+        Continue a restore that didn't finish.
+        
+        Everything the restore already did is skipped, so nothing is deleted or created twice.
+        """
+        if (replayer:=self._replays.get(ctx.guild.id)) and not replayer.done:
+            return await ctx.send("Messages from the last restore are still being replayed.")
+        
+        if not (journal:=RestoreJournal.load(self._journal_path(ctx.guild))):
+            return await ctx.send("There is no unfinished restore for this server.")
+        
+        if not (template:=await self.get_template(journal.backup_id)):
+            await journal.clear()
+            return await ctx.send("The backup that was being restored doesn't exist anymore.")
+        
+        await ctx.send(f"Resuming the restore of `{template.id}`. This can take a while.")
+        async with ctx.typing():
+            await self._run_restore(ctx.guild, template, journal)
+            
+    @backup.command(name="reconcile")
+    @commands.cooldown(1, 60*60*24, commands.BucketType.guild)
+    async def backup_reconcile(self, ctx: commands.Context, id: str):
+        """
+        Restore a backup by only changing what differs from the current server.
+        
+        Unlike `backup restore`, nothing is deleted and recreated unless it is missing from the backup.
+        The planned changes are shown before anything is done.
+        
+        `id` is the template id which you can see with `backup list`
+        """
+        if not await self.get_index_entry(id):
+            await ctx.send("Backup not found.")
+            return
+        
+        if (timestamp:=await self.config.guild(ctx.guild).last_use()) and self.greater_than_7_days(timestamp):
+            return await ctx.send("You can only restore one backup every 7 days")
+        
+        template = await self.get_template(id)
+        concurrency = await self.config.guild(ctx.guild).restore_concurrency()
+        plan = template.reconcile_plan(ctx.guild, concurrency=concurrency)
+        if not len(plan):
+            ctx.command.reset_cooldown(ctx)
+            return await ctx.send("This server already matches the backup.")
+        
+        await ctx.send(box(plan.summary(), "md") + "\nDo you want to apply these changes? (yes/no)")
+        pred = MessagePredicate.yes_or_no(ctx)
+        try:
+            await self.bot.wait_for("message", check=pred, timeout=60)
+        except asyncio.TimeoutError:
+            pred.result = False
+            
+        if not pred.result:
+            ctx.command.reset_cooldown(ctx)
+            return await ctx.send("Cancelled.")
+        
+        async with ctx.typing():
+            report = self.instrumentation.start("reconcile", ctx.guild.id, template.id)
+            try:
+                with report.active():
+                    await plan.apply()
+            except Exception as e:
+                self.instrumentation.finish(report, e)
+                raise
+            self.instrumentation.finish(report)
+            await self.record_use(template.id)
+        await ctx.send("Backup reconciled.")
+            
+    @commands.Cog.listener()
+    async def on_guild_channel_create(self, channel: discord.abc.GuildChannel):
+        if (mirror := self.mirrors.get(channel.guild.id)) is not None:
+            mirror.update_channel(channel)
+            
+    @commands.Cog.listener()
+    async def on_guild_channel_update(self, before: discord.abc.GuildChannel, after: discord.abc.GuildChannel):
+        # overwrite changes come through here too
+        if (mirror := self.mirrors.get(after.guild.id)) is not None:
+            mirror.update_channel(after)
+            
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel: discord.abc.GuildChannel):
+        if (mirror := self.mirrors.get(channel.guild.id)) is not None:
+            mirror.remove_channel(channel)
+            
+    @commands.Cog.listener()
+    async def on_guild_role_create(self, role: discord.Role):
+        if (mirror := self.mirrors.get(role.guild.id)) is not None:
+            mirror.update_role(role)
+            
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before: discord.Role, after: discord.Role):
+        if (mirror := self.mirrors.get(after.guild.id)) is not None:
+            mirror.update_role(after)
+            
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role: discord.Role):
+        if (mirror := self.mirrors.get(role.guild.id)) is not None:
+            mirror.remove_role(role)
+            
+    @commands.Cog.listener()
+    async def on_message(self, message: discord.Message):
+        if message.guild is not None and (mirror := self.mirrors.get(message.guild.id)) is not None:
+            mirror.add_message(message)
+            
+    @commands.Cog.listener()
+    async def on_message_edit(self, before: discord.Message, after: discord.Message):
+        if after.guild is not None and (mirror := self.mirrors.get(after.guild.id)) is not None:
+            mirror.edit_message(after)
+            
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        if payload.guild_id is not None and (mirror := self.mirrors.get(payload.guild_id)) is not None:
+            mirror.remove_message(payload.channel_id, payload.message_id)
+            
+    @commands.Cog.listener()
+    async def on_guild_available(self, guild: discord.Guild):
+        # after a reconnect the cache is fresh but the events in between are gone.
+        if (mirror := self.mirrors.get(guild.id)) is not None:
+            try:
+                await mirror.rebuild(guild, concurrency=await self.config.guild(guild).capture_concurrency())
+            except Exception as e:
+                # it stays not ready, so backups are captured from discord until the next reconnect
+                log.exception("Couldn't rebuild the live mirror of guild %s.", guild.id, exc_info=e)
+            
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild: discord.Guild):
+        self.mirrors.pop(guild.id, None)
@@ -0,0 +1,224 @@
+import asyncio
+import datetime
+import time
+from collections import deque
+from typing import TYPE_CHECKING, Deque, Dict, Optional, Set, Tuple
+
+import discord
+
+from .instrumentation import phase, record_api_call
+from .models import Template, TemplateCategory, TemplateChannel, TemplateMessage, TemplateRole, _NullSemaphore
+from .utils import _proper_overwrites_mapping, valid_role_for_template
+
+if TYPE_CHECKING:
+    from .cache import AssetCache
+
+_MIRRORED_TYPES = (discord.ChannelType.text, discord.ChannelType.voice)
+# the most messages a mirror keeps per channel, deeper histories are captured with `history.capture_backup`.
+MAX_MESSAGES = 100
+
+
+class GuildMirror:
+    """
+    A copy of a guild's template that is kept up to date from gateway events.
+
+    Roles, categories and channels are tracked by id and updated from the guild cache
+    as their events come in, and the latest `messages` messages of each text channel are
+    kept from `on_message`. `snapshot` turns it into a `Template` without any API calls."""
+    def __init__(self, guild: discord.Guild, *, messages: int = 3) -> None:
+        self.guild = guild
+        self.messages = messages
+        self.roles: Dict[int, TemplateRole] = {}
+        self.categories: Dict[int, TemplateCategory] = {}
+        self.channels: Dict[int, TemplateChannel] = {}
+        self.parents: Dict[int, Optional[int]] = {} # channel id -> id of its category
+        # channel id -> (message id, message), oldest first
+        self.buffers: Dict[int, Deque[Tuple[int, TemplateMessage]]] = {}
+        self._seeded: Set[int] = set() # channels whose history was fetched
+        self._generation = 0 # bumped by every `rebuild`, so an older one doesn't mark the mirror ready
+        self.ready = False
+
+    async def build(self, *, concurrency: int = 5):
+        """
+        Fill the mirror from the guild cache and fetch the latest messages of each text channel.
+
+        Only needed once, channels that already have their messages aren't fetched again."""
+        generation = self._generation
+        self.sync()
+        semaphore = asyncio.Semaphore(max(concurrency, 1))
+        await asyncio.gather(*(
+            self._seed(channel, semaphore) for channel in self.guild.channels
+            if channel.type is discord.ChannelType.text and channel.id not in self._seeded
+        ))
+        if generation == self._generation:
+            self.ready = True
+
+    async def rebuild(self, guild: discord.Guild, *, concurrency: int = 5):
+        """
+        Catch up after a reconnect. The events in between are gone, so along with the roles and
+        channels every text channel's messages are fetched again. The mirror isn't `ready` until
+        that's done, backups made in the meantime are captured from discord instead."""
+        self._generation += 1
+        self.ready = False
+        self.guild = guild
+        self.buffers, self._seeded = {}, set()
+        await self.build(concurrency=concurrency)
+
+    async def _seed(self, channel: discord.TextChannel, semaphore: Optional[asyncio.Semaphore] = None):
+        buffer = self._buffer(channel.id)
+        self._seeded.add(channel.id)
+        async with semaphore or _NullSemaphore():
+            with phase("capture:history"):
+                record_api_call()
+                async for msg in channel.history(limit=self.messages):
+                    # sent while this was fetching, on_message already added it
+                    if any(id == msg.id for id, _ in buffer):
+                        continue
+                    # a full buffer would drop the newest message to fit an older one
+                    if len(buffer) == buffer.maxlen:
+                        break
+                    # newest first, so each one goes in front of the newer ones already there
+                    buffer.appendleft((msg.id, TemplateMessage.from_message(msg)))
+
+    def sync(self):
+        """
+        Rebuild roles and channels from the guild cache, keeping the buffered messages
+        of channels that still exist."""
+        self.roles = {}
+        for role in self.guild.roles:
+            self.update_role(role)
+
+        self.categories, self.channels, self.parents = {}, {}, {}
+        for channel in self.guild.channels:
+            self.update_channel(channel)
+
+        for id in set(self.buffers) - set(self.channels):
+            del self.buffers[id]
+        self._seeded &= set(self.buffers)
+
+    def _buffer(self, channel_id: int) -> Deque[Tuple[int, TemplateMessage]]:
+        if (buffer := self.buffers.get(channel_id)) is None:
+            buffer = self.buffers[channel_id] = deque(maxlen=self.messages)
+        return buffer
+
+    def update_role(self, role: discord.Role):
+        # the default role is handled by overwrites, everything else is filtered again on snapshot
+        # since whether a role can be backed up depends on where the bot's own role is.
+        if role.is_default():
+            return
+        old = self.roles.get(role.id)
+        self.roles[role.id] = TemplateRole.from_role(role)
+        if old is not None and old.name != role.name:
+            # overwrites are stored by role name
+            self._refresh_overwrites()
+
+    def remove_role(self, role: discord.Role):
+        if self.roles.pop(role.id, None) is not None:
+            self._refresh_overwrites()
+
+    def _refresh_overwrites(self):
+        for id, stored in (*self.categories.items(), *self.channels.items()):
+            if (channel := self.guild.get_channel(id)) is not None:
+                stored.permissions = _proper_overwrites_mapping(channel.overwrites)
+
+    def update_channel(self, channel: discord.abc.GuildChannel):
+        if channel.type is discord.ChannelType.category:
+            self.categories[channel.id] = TemplateCategory(
+                name=channel.name,
+                position=channel.position,
+                permissions=_proper_overwrites_mapping(channel.overwrites)
+            )
+            return
+
+        if channel.category_id is None and channel.type not in _MIRRORED_TYPES:
+            return
+        self.parents[channel.id] = channel.category_id
+        self.channels[channel.id] = TemplateChannel(
+            name=channel.name,
+            topic=getattr(channel, "topic", None),
+            type=channel.type,
+            permissions=_proper_overwrites_mapping(channel.overwrites),
+            position=channel.position,
+        )
+        if channel.type is discord.ChannelType.text:
+            self._buffer(channel.id)
+
+    def remove_channel(self, channel: discord.abc.GuildChannel):
+        self.categories.pop(channel.id, None)
+        self.channels.pop(channel.id, None)
+        self.parents.pop(channel.id, None)
+        self.buffers.pop(channel.id, None)
+        self._seeded.discard(channel.id)
+
+    def add_message(self, message: discord.Message):
+        if (buffer := self.buffers.get(message.channel.id)) is not None:
+            buffer.append((message.id, TemplateMessage.from_message(message)))
+
+    def edit_message(self, message: discord.Message):
+        buffer = self.buffers.get(message.channel.id, ())
+        for index, (id, _) in enumerate(buffer):
+            if id == message.id:
+                buffer[index] = (id, TemplateMessage.from_message(message))
+                return
+
+    def remove_message(self, channel_id: int, message_id: int):
+        buffer = self.buffers.get(channel_id, ())
+        for entry in buffer:
+            if entry[0] == message_id:
+                # the buffer doesn't refill from older messages, it'll just hold one less until the next message.
+                buffer.remove(entry)
+                return
+
+    def _channel(self, id: int) -> TemplateChannel:
+        stored = self.channels[id]
+        # a fresh copy so later events can't change a snapshot that's still being saved
+        return TemplateChannel(
+            name=stored.name,
+            topic=stored.topic,
+            type=stored.type,
+            permissions=dict(stored.permissions),
+            position=stored.position,
+            last_messages=[msg for _, msg in self.buffers.get(id, ())],
+        )
+
+    async def snapshot(self, owner: discord.abc.Snowflake, *, cache: Optional["AssetCache"] = None) -> Template:
+        """
+        The current state of the mirror as a template.
+
+        If `cache` is given, attachments of the buffered messages are stored in it."""
+        start = time.perf_counter()
+        children: Dict[int, list] = {}
+        channels = []
+        for id, parent in self.parents.items():
+            if parent is None:
+                channels.append(self._channel(id))
+            elif parent in self.categories:
+                children.setdefault(parent, []).append(self._channel(id))
+
+        # like `Template.from_guild`, categories without channels aren't kept.
+        categories = [
+            TemplateCategory(name=stored.name, position=stored.position, permissions=dict(stored.permissions), children=children[id])
+            for id, stored in self.categories.items() if id in children
+        ]
+
+        roles = [
+            stored for id, stored in self.roles.items()
+            if (role := self.guild.get_role(id)) is not None and valid_role_for_template(role)
+        ]
+
+        if cache is not None:
+            with phase("capture:attachments"):
+                await asyncio.gather(*(
+                    msg.store_files(cache)
+                    for channel in channels + [c for category in categories for c in category._children]
+                    for msg in channel.last_messages if set(msg.attachments) - set(msg.files)
+                ))
+
+        return Template(
+            original_guild_id=self.guild.id,
+            owner=owner.id,
+            created_at=datetime.datetime.now(),
+            roles=list(roles),
+            channels=categories + channels,
+            capture_time=time.perf_counter() - start,
+        )
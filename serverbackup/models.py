@@ -1,11 +1,46 @@
+import asyncio
 import datetime
+import hashlib
 from io import BytesIO
+import json
 import secrets
-from typing import Dict, Optional, Union
-import aiohttp
+import time
+from concurrent.futures import Executor
+from functools import partial
+from typing import TYPE_CHECKING, Dict, Optional, Union
 import discord
 
-from .utils import _proper_overwrites_mapping, _overwrite_mapping_from_json, _overwrite_mapping_json, valid_role_for_template
+from .diff import TemplateDiff, diff_templates
+from .instrumentation import OperationReport, phase, record_api_call
+from .journal import RestoreJournal
+from .reconcile import ReconcilePlan, plan_reconcile
+from .replay import MessageReplayer, ProgressCallback
+from .scheduler import RestoreScheduler
+from .utils import (
+    _proper_overwrites_mapping,
+    _overwrite_mapping_compact,
+    _overwrite_mapping_from_compact,
+    _overwrite_mapping_from_json,
+    _overwrite_mapping_json,
+    valid_role_for_template
+)
+
+if TYPE_CHECKING:
+    from .cache import AssetCache
+
+async def _noop():
+    pass
+
+def _digest(*parts) -> str:
+    # canonical json so equal content always gives the same hash
+    return hashlib.sha256(json.dumps(parts, separators=(",", ":"), sort_keys=True).encode()).hexdigest()
+
+class _NullSemaphore:
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *args):
+        return False
 
 class Template:
     def __init__(self, **kwargs) -> None:
@@ -16,6 +51,7 @@ class Template:
         self.uses: int = kwargs.get('uses') or 0
         self._roles: list[TemplateRole] = kwargs.get('roles', [])
         self._channels: list[Union[TemplateCategory, TemplateChannel]] = kwargs.get('channels', [])
+        self.capture_time: Optional[float] = kwargs.get('capture_time') # seconds taken by from_guild, not stored
         
     @staticmethod
     def verify_json(json: dict):
@@ -37,6 +73,50 @@ class Template:
             "channels": [channel.json for channel in self._channels],
         }
         
+    @property
+    def compact(self):
+        """
+        Positional form of `json` used by the versioned encoding in `serialization`."""
+        return [
+            self.id,
+            self.created_at.timestamp(),
+            self.original_guild_id,
+            self.owner,
+            self.uses,
+            [role.compact for role in self._roles],
+            [channel.compact for channel in self._channels],
+        ]
+        
+    @property
+    def index_json(self):
+        """
+        The small summary of this template that's kept in the backup index."""
+        categories, channels = self.channels
+        return {
+            "id": self.id,
+            "owner": self.owner,
+            "original_guild_id": self.original_guild_id,
+            "created_at": self.created_at.timestamp(),
+            "uses": self.uses,
+            "channel_count": len(channels) + sum(len(category._children) + 1 for category in categories),
+            "role_count": len(self._roles),
+            "hash": self.content_hash,
+        }
+        
+    @property
+    def content_hash(self):
+        """
+        Hash of the roles and channels, two templates with the same hash restore the same server.
+        
+        Built from the hashes of each role and channel so changed parts can be found
+        by comparing those without looking into the rest."""
+        return self.hash_of([role.content_hash for role in self._roles], [channel.content_hash for channel in self._channels])
+        
+    @staticmethod
+    def hash_of(role_hashes: "list[str]", channel_hashes: "list[str]"):
+        # for building the hash a piece at a time, without having the whole template
+        return _digest(sorted(role_hashes), sorted(channel_hashes))
+        
     @property
     def roles(self):
         return sorted(self._roles, key=lambda role: role.position, reverse=True)
@@ -48,16 +128,56 @@ class Template:
             sorted([i for i in self._channels if isinstance(i, TemplateChannel)], key=lambda channel: channel.position, reverse=True)
             )
         
-    async def apply_to_guild(self, guild: discord.Guild):
-        reason = "Applying backup on server."
-        [await role.delete(reason=reason) for role in guild.roles if valid_role_for_template(role)]
-        [await category.delete(reason=reason) for category in guild.categories]
-        [await channel.delete(reason=reason) for channel in guild.channels]
-        
-        created_roles = {}
-        
-        for role in self.roles:
-            created_roles[role.name] = await guild.create_role(
+    @staticmethod
+    def _overwrite_dependencies(role_keys: Dict[str, str], overwrites: Dict[str, discord.PermissionOverwrite]):
+        return [role_keys[name] for name in overwrites if name in role_keys]
+        
+    def build_restore_schedule(
+        self,
+        guild: discord.Guild,
+        *,
+        concurrency: int = 5,
+        journal: Optional[RestoreJournal] = None,
+        reason: str = "Applying backup on server."
+    ):
+        """
+        Build the dependency graph used by `apply_to_guild`, returns it with the
+        stored text channels keyed by the step that creates them.
+        
+        Deletes don't depend on anything, roles are created once the old ones are gone,
+        categories and channels wait for the roles used in their overwrites and channels
+        wait for their category. Nothing is created with a position, once everything exists
+        the role hierarchy is set with one request and every channel position with another.
+        
+        With a `journal` from an earlier attempt, only what it planned to delete is deleted
+        and steps it already finished are skipped."""
+        scheduler = RestoreScheduler(concurrency, journal=journal)
+        
+        if journal is not None and journal.deletes is not None:
+            # resuming, the guild now also has what the first attempt created so it can't be listed again.
+            old_roles = [role for role in map(guild.get_role, journal.deletes["roles"]) if role is not None]
+            old_channels = [channel for channel in map(guild.get_channel, journal.deletes["channels"]) if channel is not None]
+        else:
+            old_roles = [role for role in guild.roles if valid_role_for_template(role)]
+            old_channels = list(guild.channels)
+            if journal is not None:
+                journal.deletes = {"roles": [r.id for r in old_roles], "channels": [c.id for c in old_channels]}
+        
+        role_deletes = [scheduler.add(f"delete:role:{role.id}", partial(role.delete, reason=reason)) for role in old_roles]
+        channel_deletes = [scheduler.add(f"delete:channel:{channel.id}", partial(channel.delete, reason=reason)) for channel in old_channels]
+        roles_deleted = scheduler.add("barrier:roles_deleted", _noop, depends=role_deletes, track=False)
+        channels_deleted = scheduler.add("barrier:channels_deleted", _noop, depends=channel_deletes, track=False)
+        
+        # overwrites are stored by role name, the default role is never deleted so it can be used right away.
+        role_keys: Dict[str, str] = {}
+        
+        def created_roles() -> Dict[str, discord.Role]:
+            roles = {name: scheduler.get(key) for name, key in role_keys.items() if scheduler.get(key) is not None}
+            roles[guild.default_role.name] = guild.default_role
+            return roles
+        
+        async def create_role(role: TemplateRole):
+            return await guild.create_role(
                 reason=reason,
                 colour=role.colour,
                 hoist=role.hoist,
@@ -65,50 +185,149 @@ class Template:
                 name=role.name,
                 permissions=role.permissions
             )
+        
+        # highest first, like `self.roles`
+        role_order = [
+            scheduler.add(f"create:role:{index}", partial(create_role, role), depends=[roles_deleted])
+            for index, role in enumerate(self.roles)
+        ]
+        role_keys.update((role.name, key) for role, key in zip(self.roles, role_order))
             
-        role = await guild.create_role(reason=reason, name=guild.me.name, permissions=discord.Permissions(administrator=True))
-        await guild.me.add_roles(role)
+        async def create_bot_role():
+            role = await guild.create_role(reason=reason, name=guild.me.name, permissions=discord.Permissions(administrator=True))
+            await guild.me.add_roles(role)
+            record_api_call() # the scheduler only counts one call per step
+            return role
             
-        categories, channels = self.channels
+        bot_role = scheduler.add("create:role:bot", create_bot_role, depends=[roles_deleted])
+        
+        async def order_roles():
+            # the lowest role goes right above the default role, and the bot's role above
+            # all of them so it can still manage them after the restore.
+            keys = [bot_role, *role_order]
+            positions = {scheduler.get(key): len(keys) - index for index, key in enumerate(keys) if scheduler.get(key) is not None}
+            if positions:
+                await guild.edit_role_positions(positions, reason=reason)
+                
+        scheduler.add("edit:role:positions", order_roles, depends=[bot_role, *role_order])
         
-            
-        for category in categories:
-            cat = await guild.create_category(
+        async def create_category(category: TemplateCategory):
+            return await guild.create_category(
                 name=category.name,
-                overwrites=self.get_proper_overwrites_with_roles(created_roles, category.permissions),
-                reason=reason,
-                position=category.position
+                overwrites=self.get_proper_overwrites_with_roles(created_roles(), category.permissions),
+                reason=reason
             )
             
-                
-            for child in category.children:
-                perms = self.get_proper_overwrites_with_roles(created_roles, child.permissions)
-                if child.type is discord.ChannelType.voice:
-                    await cat.create_voice_channel(name=child.name, overwrites=perms, reason=reason)
-                    
-                elif child.type is discord.ChannelType.text:
-                    act_chan: discord.TextChannel = await cat.create_text_channel(name=child.name, overwrites=perms, reason=reason, position=child.position, topic=child.topic)
-                    if child.last_messages:
-                        wh = await act_chan.create_webhook(name="new_webhook")
-                        for msg in child.last_messages:
-                            await wh.send(content=msg.content + "\n".join(msg.attachments), embeds=msg.embeds, avatar_url=msg.author_avatar_url, username=msg.author)
-                    
-                        
-        for channel in channels:
-            perms = self.get_proper_overwrites_with_roles(created_roles, channel.permissions)
+        async def create_channel(channel: TemplateChannel, category_key: Optional[str] = None):
+            target = scheduler.get(category_key) if category_key else guild
+            perms = self.get_proper_overwrites_with_roles(created_roles(), channel.permissions)
             if channel.type is discord.ChannelType.voice:
-                await guild.create_voice_channel(name=channel.name, overwrites=perms, reason=reason)
-                    
-            elif channel.type is discord.ChannelType.text:
-                act_chan = await guild.create_text_channel(name=channel.name, overwrites=perms, reason=reason, position=channel.position, topic=channel.topic)
-                if child.last_messages:
-                    wh = await act_chan.create_webhook(name="new_webhook")
-                    for msg in child.last_messages:
-                        await wh.edit(name=msg.author, avatar=await msg.avatar)
-                        await wh.send(content=msg.content + "\n".join(msg.attachments), embeds=msg.embeds)
-                        
-            await act_chan.send("Backup Restored.")
+                return await target.create_voice_channel(name=channel.name, overwrites=perms, reason=reason)
+            
+            return await target.create_text_channel(name=channel.name, overwrites=perms, reason=reason, topic=channel.topic)
+        
+        # step key -> stored channel, for queueing the messages once the channels exist.
+        text_channels: Dict[str, TemplateChannel] = {}
+        # step key -> stored category or channel, for setting all of their positions at once.
+        positioned: Dict[str, Union[TemplateCategory, TemplateChannel]] = {}
+        
+        def add_channel(key: str, channel: TemplateChannel, category_key: Optional[str] = None):
+            if channel.type not in (discord.ChannelType.text, discord.ChannelType.voice):
+                return
+            
+            depends = [channels_deleted, category_key, *self._overwrite_dependencies(role_keys, channel.permissions)]
+            scheduler.add(key, partial(create_channel, channel, category_key), depends=depends)
+            positioned[key] = channel
+            if channel.type is discord.ChannelType.text:
+                text_channels[key] = channel
+            
+        categories, channels = self.channels
+            
+        for index, category in enumerate(categories):
+            cat_key = scheduler.add(
+                f"create:category:{index}",
+                partial(create_category, category),
+                depends=[channels_deleted, *self._overwrite_dependencies(role_keys, category.permissions)]
+            )
+            positioned[cat_key] = category
+            for child_index, child in enumerate(category.children):
+                add_channel(f"create:channel:{index}:{child_index}", child, cat_key)
+                
+        for index, channel in enumerate(channels):
+            add_channel(f"create:channel:{index}", channel)
+            
+        async def order_channels():
+            data = [
+                {"id": created.id, "position": stored.position}
+                for key, stored in positioned.items() if (created := scheduler.get(key)) is not None
+            ]
+            if data:
+                await guild._state.http.bulk_channel_update(guild.id, data, reason=reason)
                 
+        scheduler.add("edit:channel:positions", order_channels, depends=list(positioned))
+            
+        async def announce():
+            if text_channels:
+                await scheduler.get(list(text_channels)[-1]).send("Backup Restored.")
+            
+        scheduler.add("announce", announce, depends=list(scheduler.steps))
+        
+        return scheduler, text_channels
+        
+    async def apply_to_guild(
+        self,
+        guild: discord.Guild,
+        *,
+        concurrency: int = 5,
+        cache: Optional["AssetCache"] = None,
+        background_replay: bool = False,
+        progress: Optional[ProgressCallback] = None,
+        report: Optional[OperationReport] = None,
+        journal: Optional[RestoreJournal] = None,
+        executor: Optional[Executor] = None
+    ) -> MessageReplayer:
+        """
+        Restore this template on the guild.
+        
+        Stored messages are replayed once every channel exists. With `background_replay`
+        this returns as soon as the structure is restored and the replay keeps running
+        on the returned replayer's task.
+        Timings and API calls of each phase are recorded on `report` if one is given.
+        Progress is checkpointed to `journal` if one is given, passing the journal of a
+        restore that didn't finish continues it instead of starting over.
+        Messages are decoded in `executor` one channel at a time as they're replayed."""
+        if journal is not None:
+            journal.guild = guild
+            
+        replayer = MessageReplayer(cache=cache, concurrency=concurrency, journal=journal, executor=executor)
+        scheduler, text_channels = self.build_restore_schedule(guild, concurrency=concurrency, journal=journal)
+        
+        # the background replay task copies the active report, so it keeps recording to it.
+        with (report or OperationReport("restore", guild.id, self.id)).active():
+            await scheduler.run()
+            
+            for key, channel in text_channels.items():
+                replayer.add(scheduler.get(key), channel, key=key)
+            if text_channels:
+                replayer.status_channel = scheduler.get(list(text_channels)[-1])
+            
+            if background_replay:
+                replayer.start(progress)
+            else:
+                await replayer.run(progress)
+            
+        return replayer
+        
+    def reconcile_plan(self, guild: discord.Guild, *, concurrency: int = 5) -> ReconcilePlan:
+        """
+        Plan the creates, edits and deletes needed to make `guild` match this template
+        without deleting everything first. Call `apply` on the returned plan to run it."""
+        return plan_reconcile(self, guild, concurrency=concurrency)
+        
+    def diff(self, other: "Template") -> TemplateDiff:
+        """
+        What changed from this template to `other`."""
+        return diff_templates(self, other)
         
     @classmethod
     def from_json(cls, json: dict):
@@ -122,7 +341,45 @@ class Template:
         return cls(**json)
     
     @classmethod
-    async def from_guild(cls, guild: discord.Guild, owner: discord.Member):
+    def from_compact(cls, compact: list, *, lazy: bool = False):
+        """
+        Build a template from `compact`. With `lazy`, messages stay in their compact
+        form until a channel's `last_messages` is first used."""
+        id, created_at, original_guild_id, owner, uses, roles, channels = compact
+        return cls(
+            id=id,
+            created_at=datetime.datetime.fromtimestamp(created_at),
+            original_guild_id=original_guild_id,
+            owner=owner,
+            uses=uses,
+            roles=[TemplateRole.from_compact(role) for role in roles],
+            channels=[
+                TemplateCategory.from_compact(channel, lazy=lazy) if channel[0] == TemplateCategory.COMPACT_TAG else TemplateChannel.from_compact(channel, lazy=lazy)
+                for channel in channels
+            ],
+        )
+    
+    @classmethod
+    async def from_guild(
+        cls,
+        guild: discord.Guild,
+        owner: discord.Member,
+        *,
+        concurrency: int = 5,
+        cache: Optional["AssetCache"] = None,
+        report: Optional[OperationReport] = None,
+        history: int = 3,
+    ):
+        """
+        Capture a template of the guild with the latest `history` messages of each text channel.
+        
+        History fetches run concurrently, at most `concurrency` at a time.
+        Deep histories are better captured with `history.capture_backup`, which doesn't keep them in memory.
+        The resulting channel order is the same as a sequential capture.
+        If `cache` is given, attachments of the captured messages are stored in it.
+        Timings and API calls of each phase are recorded on `report` if one is given."""
+        start = time.perf_counter()
+        semaphore = asyncio.Semaphore(max(concurrency, 1))
         attrs = {
             "id": None,
             "original_guild_id": guild.id,
@@ -130,29 +387,41 @@ class Template:
             "channels": [],
         }
         
-        for role in guild.roles:
-            if valid_role_for_template(role):
-                attrs["roles"].append(TemplateRole.from_role(role))
-            
-        categories: Dict[str, TemplateCategory] = {}
-        channels = []
-        for channel in guild.channels:
-            if not isinstance(channel, (discord.TextChannel, discord.VoiceChannel)):
-                continue
-            if channel.category:
-                if not categories.get(channel.category.name):
-                    categories[channel.category.name] = await TemplateCategory.from_category(channel.category)
-                    
-                continue
-            
-            channels.append(await TemplateChannel.from_channel(channel))
+        with (report or OperationReport("create", guild.id)).active():
+            with phase("capture:roles"):
+                for role in guild.roles:
+                    if valid_role_for_template(role):
+                        attrs["roles"].append(TemplateRole.from_role(role))
+                
+            categories: Dict[str, discord.CategoryChannel] = {}
+            channels = []
+            for channel in guild.channels:
+                if channel.type not in (discord.ChannelType.text, discord.ChannelType.voice):
+                    continue
+                if channel.category:
+                    categories.setdefault(channel.category.name, channel.category)
+                    continue
+                
+                channels.append(channel)
+                
+            # gather keeps the order of its arguments, so categories still come first
+            # in the order they were first seen, followed by the uncategorised channels.
+            captured = await asyncio.gather(
+                *(TemplateCategory.from_category(category, semaphore=semaphore, cache=cache, history=history) for category in categories.values()),
+                *(TemplateChannel.from_channel(channel, semaphore=semaphore, cache=cache, limit=history) for channel in channels)
+            )
             
-        attrs["channels"] = [category for category in categories.values()] + channels
+        attrs["channels"] = list(captured)
         attrs["owner"] = owner.id
+        attrs["capture_time"] = time.perf_counter() - start
         
         return cls(**attrs)
     
 class TemplateCategory:
+    __slots__ = ("name", "position", "_children", "permissions")
+    
+    COMPACT_TAG = 1
+    
     def __init__(self, **kwargs) -> None:
         self.name: str = kwargs.get('name', 'New Category')
         self.position: int = kwargs.get('position', 0)
@@ -167,14 +436,36 @@ class TemplateCategory:
     def json(self):
         return {
             "name": self.name,
+            "position": self.position,
             "children": [c.json for c in self.children],
             "permissions": _overwrite_mapping_json(self.permissions)
         }
         
+    @property
+    def compact(self):
+        return [self.COMPACT_TAG, self.name, self.position, _overwrite_mapping_compact(self.permissions), [c.compact for c in self._children]]
+        
     @property
     def children(self):
         return sorted(self._children, key=lambda c: c.position)
         
+    @property
+    def content_hash(self):
+        return self.hash_with([c.content_hash for c in self._children])
+        
+    def hash_with(self, child_hashes: "list[str]"):
+        return _digest(self.COMPACT_TAG, self.name, self.position, _overwrite_mapping_compact(self.permissions), sorted(child_hashes))
+        
+    @classmethod
+    def from_compact(cls, compact: list, *, lazy: bool = False):
+        _, name, position, permissions, children = compact
+        return cls(
+            name=name,
+            position=position,
+            permissions=_overwrite_mapping_from_compact(permissions),
+            children=[TemplateChannel.from_compact(c, lazy=lazy) for c in children]
+        )
+        
     @classmethod
     def from_json(cls, json: dict):
         if not cls.verify_json(json):
@@ -186,16 +477,22 @@ class TemplateCategory:
         return cls(**json)
     
     @classmethod
-    async def from_category(cls, category: discord.CategoryChannel):
+    async def from_category(cls, category: discord.CategoryChannel, *, semaphore: Optional[asyncio.Semaphore] = None, cache: Optional["AssetCache"] = None, history: int = 3):
+        children = await asyncio.gather(*(TemplateChannel.from_channel(c, semaphore=semaphore, cache=cache, limit=history) for c in category.channels))
         self = cls(
             name=category.name,
-            children=[await TemplateChannel.from_channel(c) for c in category.channels],
+            position=category.position,
+            children=list(children),
             permissions=_proper_overwrites_mapping(category.overwrites)
         )
         
         return self
 
 class TemplateChannel:
+    __slots__ = ("name", "topic", "type", "permissions", "position", "category", "_last_messages", "_raw_messages")
+    
+    COMPACT_TAG = 0
+    
     def __init__(self, **kwargs) -> None:
         self.name: str = kwargs.get('name', "default channel name")
         self.topic: str = kwargs.get('topic', "")
@@ -203,7 +500,40 @@ class TemplateChannel:
         self.permissions: Dict[str, discord.PermissionOverwrite] = kwargs.get("permissions", {})
         self.position: int = kwargs.get("position", 0)
         self.category: TemplateCategory = kwargs.get("category", None)
-        self.last_messages: list[TemplateMessage] = kwargs.get("last_messages", [])
+        # compact messages of a lazily decoded channel, only turned into `TemplateMessage`s when they're used.
+        self._raw_messages: Optional[list] = kwargs.get("raw_messages")
+        self._last_messages: Optional[list[TemplateMessage]] = None if self._raw_messages is not None else kwargs.get("last_messages", [])
+        
+    @property
+    def last_messages(self) -> "list[TemplateMessage]":
+        if self._last_messages is None:
+            self._last_messages = [TemplateMessage.from_compact(m) for m in self._raw_messages]
+            self._raw_messages = None
+        return self._last_messages
+    
+    @last_messages.setter
+    def last_messages(self, messages: "list[TemplateMessage]"):
+        self._last_messages = messages
+        self._raw_messages = None
+        
+    @property
+    def message_count(self) -> int:
+        return len(self._raw_messages if self._last_messages is None else self._last_messages)
+        
+    def decode_messages(self) -> "list[TemplateMessage]":
+        """
+        The messages without keeping them decoded on the channel, so they're freed once
+        whoever decoded them is done. Safe to call from another thread."""
+        if self._last_messages is not None:
+            return self._last_messages
+        return [TemplateMessage.from_compact(m) for m in self._raw_messages]
+        
+    @property
+    def messages_compact(self) -> list:
+        # without decoding them if they haven't been yet
+        if self._last_messages is None:
+            return self._raw_messages
+        return [m.compact for m in self._last_messages]
         
     @staticmethod
     def verify_json(json: dict):
@@ -220,6 +550,51 @@ class TemplateChannel:
             "last_messages": [m.json for m in self.last_messages]
         }
         
+    @property
+    def compact(self):
+        return [
+            self.COMPACT_TAG,
+            self.name,
+            self.topic,
+            self.type.value,
+            _overwrite_mapping_compact(self.permissions),
+            self.position,
+            self.messages_compact
+        ]
+        
+    @property
+    def content_hash(self):
+        return self.hash_with(self.message_hashes)
+        
+    def hash_with(self, message_hashes: "list[str]"):
+        # for channels whose messages were stored without being kept, see `history.capture_backup`
+        return _digest(
+            self.COMPACT_TAG,
+            self.name,
+            self.topic,
+            self.type.value,
+            _overwrite_mapping_compact(self.permissions),
+            self.position,
+            message_hashes
+        )
+        
+    @property
+    def message_hashes(self):
+        return [TemplateMessage.compact_hash(m) for m in self.messages_compact]
+        
+    @classmethod
+    def from_compact(cls, compact: list, *, lazy: bool = False):
+        _, name, topic, type, permissions, position, last_messages = compact
+        messages = {"raw_messages": last_messages} if lazy else {"last_messages": [TemplateMessage.from_compact(m) for m in last_messages]}
+        return cls(
+            name=name,
+            topic=topic,
+            type=discord.ChannelType(type),
+            permissions=_overwrite_mapping_from_compact(permissions),
+            position=position,
+            **messages
+        )
+        
     @classmethod
     def from_json(cls, json: dict):
         if not cls.verify_json(json):
@@ -232,12 +607,30 @@ class TemplateChannel:
         return cls(**json)
     
     @classmethod
-    async def from_channel(cls, channel: Union[discord.TextChannel, discord.VoiceChannel]):
+    async def from_channel(
+        cls,
+        channel: Union[discord.TextChannel, discord.VoiceChannel],
+        *,
+        semaphore: Optional[asyncio.Semaphore] = None,
+        cache: Optional["AssetCache"] = None,
+        limit: int = 3
+    ):
         last_messages = []
-        if type(channel) is discord.TextChannel:
-            async for msg in channel.history(limit=3):
-                last_messages.insert(0, TemplateMessage.from_message(msg)) 
-                # so that messages aren't in reversed order lol
+        if channel.type is discord.ChannelType.text and limit:
+            # the semaphore only guards the history request, categories never hold it
+            # so nested captures can't deadlock each other.
+            async with semaphore or _NullSemaphore():
+                with phase("capture:history"):
+                    record_api_call()
+                    async for msg in channel.history(limit=limit):
+                        last_messages.append(TemplateMessage.from_message(msg))
+            # history is newest first, reversed once so messages are in the order they were sent
+            last_messages.reverse()
+                    
+            if cache is not None:
+                # attachment urls expire, keep their content so they can still be sent on restore.
+                with phase("capture:attachments"):
+                    await asyncio.gather(*(msg.store_files(cache) for msg in last_messages))
         attrs = {
             "name": channel.name,
             "topic": getattr(channel, "topic", None),
@@ -249,12 +642,18 @@ class TemplateChannel:
         return cls(**attrs)
     
 class TemplateMessage:
+    __slots__ = ("author", "author_avatar_url", "content", "embeds", "attachments", "files")
+    
+    # the most a webhook can upload without boosts
+    MAX_FILE_SIZE = 8 * 1024 * 1024
+    
     def __init__(self, **kwargs) -> None:
         self.author: str = kwargs.get("author", "default author") # author name with discrim only
         self.author_avatar_url: Optional[str] = kwargs.get("author_avatar_url") # the avatar url, if available
         self.content: str = kwargs.get("content") # content of the message
         self.embeds: list[discord.Embed] = kwargs.get("embeds", []) # embeds of the message
         self.attachments: list[str] = kwargs.get("attachments", []) # we will only be saving urls of the attachments for this
+        self.files: Dict[str, str] = kwargs.get("files", {}) # attachment url -> content hash in the AssetCache, if it was cached
         
     @property
     def json(self):
@@ -263,18 +662,54 @@ class TemplateMessage:
             "author_avatar_url": self.author_avatar_url,
             "content": self.content,
             "embeds": [e.to_dict() for e in self.embeds],
-            "attachments": self.attachments
+            "attachments": self.attachments,
+            "files": self.files
         }
         
     @property
-    def avatar(self):
-        return self.get_avatar_bytes(self.author_avatar_url)
+    def compact(self):
+        return [self.author, self.author_avatar_url, self.content, [e.to_dict() for e in self.embeds], self.attachments, self.files]
+        
+    @property
+    def content_hash(self):
+        return self.compact_hash(self.compact)
         
     @staticmethod
-    async def get_avatar_bytes(avatar_url):
-        async with aiohttp.request("GET", avatar_url) as resp:
-            avatar = BytesIO(await resp.read())
-            return avatar
+    def compact_hash(compact: list):
+        # files only says which attachments were cached, the message is the same either way
+        return _digest(*compact[:5])
+        
+    @classmethod
+    def from_compact(cls, compact: list):
+        # schema version 1 didn't have files
+        author, author_avatar_url, content, embeds, attachments, *files = compact
+        return cls(
+            author=author,
+            author_avatar_url=author_avatar_url,
+            content=content,
+            embeds=[discord.Embed.from_dict(e) for e in embeds],
+            attachments=attachments,
+            files=files[0] if files else {}
+        )
+        
+    async def store_files(self, cache: "AssetCache"):
+        for url in self.attachments:
+            if digest := await cache.download(url, max_size=self.MAX_FILE_SIZE):
+                self.files[url] = digest
+                
+    async def cached_files(self, cache: Optional["AssetCache"]):
+        """
+        Split the attachments into files that can be uploaded from the cache and urls that can't."""
+        files, urls = [], []
+        for url in self.attachments:
+            data = await cache.get(self.files[url]) if cache is not None and url in self.files else None
+            if data is None:
+                urls.append(url)
+                continue
+            
+            files.append(discord.File(BytesIO(data), filename=url.rsplit("/", 1)[-1].split("?", 1)[0]))
+            
+        return files, urls
         
     @staticmethod
     def verify_json(json: dict):
@@ -301,6 +736,8 @@ class TemplateMessage:
         return cls(**attrs)
     
 class TemplateRole:
+    __slots__ = ("name", "color", "hoist", "permissions", "mentionable", "is_everyone", "position")
+    
     def __init__(self, **kwargs) -> None:
         self.name: str = kwargs.get("name", "default role name")
         self.color: discord.Color = kwargs.get("color", discord.Color.default())
@@ -322,10 +759,31 @@ class TemplateRole:
             "position": self.position
         }
         
+    @property
+    def compact(self):
+        return [self.name, self.color.value, self.hoist, self.permissions.value, self.mentionable, self.is_everyone, self.position]
+        
+    @property
+    def content_hash(self):
+        return _digest(self.compact)
+        
     @property
     def colour(self):
         return self.color
         
+    @classmethod
+    def from_compact(cls, compact: list):
+        name, color, hoist, permissions, mentionable, is_everyone, position = compact
+        return cls(
+            name=name,
+            color=discord.Color(color),
+            hoist=hoist,
+            permissions=discord.Permissions(permissions),
+            mentionable=mentionable,
+            is_everyone=is_everyone,
+            position=position
+        )
+        
     @staticmethod
     def verify_json(json: dict):
         return all(k in json for k in ['name', 'color', 'hoist', 'permissions', 'mentionable', 'is_everyone', 'position'])
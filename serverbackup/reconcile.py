@@ -0,0 +1,309 @@
+from collections import Counter
+from functools import partial
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+import discord
+
+from .scheduler import RestoreScheduler
+from .utils import _proper_overwrites_mapping, valid_role_for_template
+
+if TYPE_CHECKING:
+    from .models import Template, TemplateCategory, TemplateChannel, TemplateRole
+
+
+class ReconcileOperation:
+    def __init__(self, action: str, kind: str, name: str, func: Callable[[], Awaitable[Any]], **kwargs) -> None:
+        self.action = action # create, edit or delete
+        self.kind = kind # role, category or channel
+        self.name = name
+        self.func = func
+        self.depends: List[str] = kwargs.get("depends", [])
+        self.changes: List[str] = kwargs.get("changes", []) # the attributes an edit touches
+        self.key: str = kwargs.get("key") or f"{action}:{kind}:{name}"
+
+    def __repr__(self) -> str:
+        return f"<ReconcileOperation action={self.action!r} kind={self.kind!r} name={self.name!r}>"
+
+    @property
+    def description(self):
+        desc = f"{self.action} {self.kind} `{self.name}`"
+        if self.changes:
+            desc += f" ({', '.join(self.changes)})"
+        return desc
+
+
+class ReconcilePlan:
+    """
+    The operations needed to turn a live guild into a template.
+
+    Nothing is sent to discord until `apply` is called, so the plan can be shown first."""
+    def __init__(self, guild: discord.Guild, *, concurrency: int = 5) -> None:
+        self.guild = guild
+        self.operations: List[ReconcileOperation] = []
+        self.scheduler = RestoreScheduler(concurrency)
+
+    def __len__(self):
+        return len(self.operations)
+
+    def add(self, operation: ReconcileOperation) -> str:
+        self.scheduler.add(operation.key, operation.func, depends=operation.depends)
+        self.operations.append(operation)
+        return operation.key
+
+    @property
+    def counts(self) -> Counter:
+        return Counter(op.action for op in self.operations)
+
+    def summary(self, limit: int = 15) -> str:
+        counts = self.counts
+        lines = [
+            f"{len(self)} operations: {counts['create']} to create, "
+            f"{counts['edit']} to edit and {counts['delete']} to delete."
+        ]
+        lines.extend(f"- {op.description}" for op in self.operations[:limit])
+        if len(self) > limit:
+            lines.append(f"...and {len(self) - limit} more.")
+        return "\n".join(lines)
+
+    async def apply(self):
+        return await self.scheduler.run()
+
+
+def _overwrites_differ(live: Dict[str, discord.PermissionOverwrite], stored: Dict[str, discord.PermissionOverwrite]):
+    # empty overwrites are the same as no overwrite at all for discord.
+    live = {k: v for k, v in live.items() if not v.is_empty()}
+    stored = {k: v for k, v in stored.items() if not v.is_empty()}
+    return live != stored
+
+
+def _channel_key(name: str, type: discord.ChannelType) -> Tuple[str, str]:
+    return (name, type.name)
+
+
+def plan_reconcile(template: "Template", guild: discord.Guild, *, concurrency: int = 5, reason: str = "Reconciling server with backup.") -> ReconcilePlan:
+    """
+    Compare `guild` with `template` and plan only the changes between them.
+
+    Roles and categories are matched by name and channels by name and type, preferring
+    one in the same category. A channel in another category is moved instead of being
+    deleted and created again. Stored messages aren't replayed since there is no way to tell whether they are still there."""
+    plan = ReconcilePlan(guild, concurrency=concurrency)
+    # steps are keyed by template index or live id, names don't have to be unique.
+
+    live_roles: Dict[str, List[discord.Role]] = {}
+    for role in reversed(guild.roles):
+        if valid_role_for_template(role):
+            live_roles.setdefault(role.name, []).append(role)
+
+    # role name -> live role, roles that get created are added once they exist.
+    resolved: Dict[str, discord.Role] = {guild.default_role.name: guild.default_role}
+    resolved.update((name, roles[0]) for name, roles in live_roles.items())
+    role_steps: Dict[str, str] = {}
+
+    def overwrites_for(permissions: Dict[str, discord.PermissionOverwrite]):
+        return {resolved[name]: ow for name, ow in permissions.items() if name in resolved}
+
+    def depends_for(permissions: Dict[str, discord.PermissionOverwrite]):
+        return [role_steps[name] for name in permissions if name in role_steps]
+
+    async def create_role(role: "TemplateRole"):
+        created = await guild.create_role(
+            reason=reason,
+            colour=role.colour,
+            hoist=role.hoist,
+            mentionable=role.mentionable,
+            name=role.name,
+            permissions=role.permissions
+        )
+        resolved[role.name] = created
+        return created
+
+    kept_roles: List[discord.Role] = []
+    previous = None
+    for index, role in enumerate(template.roles):
+        # roles with the same name are matched in order, highest first
+        candidates = live_roles.get(role.name)
+        if not candidates:
+            # created roles go to the bottom, chaining them keeps their relative order.
+            previous = role_steps[role.name] = plan.add(ReconcileOperation(
+                "create", "role", role.name, partial(create_role, role), depends=[previous], key=f"create:role:{index}"
+            ))
+            continue
+
+        live = candidates.pop(0)
+        kept_roles.append(live)
+        changes = {}
+        if live.colour != role.colour:
+            changes["colour"] = role.colour
+        if live.hoist != role.hoist:
+            changes["hoist"] = role.hoist
+        if live.mentionable != role.mentionable:
+            changes["mentionable"] = role.mentionable
+        if live.permissions != role.permissions:
+            changes["permissions"] = role.permissions
+
+        if changes:
+            plan.add(ReconcileOperation(
+                "edit", "role", role.name, partial(live.edit, reason=reason, **changes), changes=list(changes),
+                key=f"edit:role:{live.id}"
+            ))
+
+    if [r.id for r in kept_roles] != [r.id for r in sorted(kept_roles, key=lambda r: r.position, reverse=True)]:
+        # keep the current slots of the kept roles and hand them out in the backup's order.
+        slots = sorted((r.position for r in kept_roles), reverse=True)
+        positions = dict(zip(kept_roles, slots))
+        plan.add(ReconcileOperation(
+            "edit", "role", "hierarchy", partial(guild.edit_role_positions, positions, reason=reason),
+            changes=["position"], key="edit:role:positions"
+        ))
+
+    channel_ops: List[str] = []
+    categories, channels = template.channels
+
+    # categories are referred to by their index in `categories`, None is no category.
+    live_categories: Dict[str, List[discord.CategoryChannel]] = {}
+    for category in guild.categories:
+        live_categories.setdefault(category.name, []).append(category)
+    matched_categories: Dict[int, discord.CategoryChannel] = {}
+    for index, category in enumerate(categories):
+        if candidates := live_categories.get(category.name):
+            matched_categories[index] = candidates.pop(0)
+    created_categories: Dict[int, str] = {}
+
+    live_channels: Dict[Tuple[str, str], List[Union[discord.TextChannel, discord.VoiceChannel]]] = {}
+    for channel in guild.channels:
+        if channel.type in (discord.ChannelType.text, discord.ChannelType.voice):
+            live_channels.setdefault(_channel_key(channel.name, channel.type), []).append(channel)
+
+    def in_place(live: discord.abc.GuildChannel, category: Optional[int]) -> bool:
+        # whether a live channel already is in the category it belongs in
+        if category is None:
+            return live.category is None
+        return category in matched_categories and live.category is not None and live.category.id == matched_categories[category].id
+
+    # stored channel -> the live one it becomes. channels already in the right category are matched first,
+    # so a channel that has to move never takes the match of one that doesn't.
+    wanted = [(child, index) for index, category in enumerate(categories) for child in category.children] + [(channel, None) for channel in channels]
+    matches: Dict["TemplateChannel", Union[discord.TextChannel, discord.VoiceChannel]] = {}
+    for same_category in (True, False):
+        for channel, category in wanted:
+            if channel in matches:
+                continue
+            candidates = live_channels.get(_channel_key(channel.name, channel.type), [])
+            for live in candidates:
+                if not same_category or in_place(live, category):
+                    candidates.remove(live)
+                    matches[channel] = live
+                    break
+
+    def category_for(category: int) -> discord.CategoryChannel:
+        # the category once it exists, whether it was matched or gets created
+        step = created_categories.get(category)
+        return plan.scheduler.get(step) if step else matched_categories[category]
+
+    async def create_category(category: "TemplateCategory"):
+        return await guild.create_category(
+            name=category.name,
+            overwrites=overwrites_for(category.permissions),
+            reason=reason,
+            position=category.position
+        )
+
+    async def create_channel(channel: "TemplateChannel", category: Optional[int]):
+        target = guild if category is None else category_for(category)
+
+        perms = overwrites_for(channel.permissions)
+        if channel.type is discord.ChannelType.voice:
+            return await target.create_voice_channel(name=channel.name, overwrites=perms, reason=reason)
+
+        return await target.create_text_channel(name=channel.name, overwrites=perms, reason=reason, position=channel.position, topic=channel.topic)
+
+    async def edit_channel(live: discord.abc.GuildChannel, permissions: Dict[str, discord.PermissionOverwrite], **changes):
+        if permissions is not None:
+            changes["overwrites"] = overwrites_for(permissions)
+        if "category" in changes:
+            # only the index is known when planning, the category may not exist yet
+            changes["category"] = None if changes["category"] is None else category_for(changes["category"])
+        await live.edit(reason=reason, **changes)
+
+    def diff_channel(live, stored, kind: str, name: str, *, category: Optional[int] = None):
+        changes = {}
+        permissions = None
+        depends = depends_for(stored.permissions)
+        if _overwrites_differ(_proper_overwrites_mapping(live.overwrites), stored.permissions):
+            permissions = stored.permissions
+        # a topic that was cleared since the backup is cleared here too
+        if kind == "channel" and live.type is discord.ChannelType.text and (live.topic or "") != (stored.topic or ""):
+            changes["topic"] = stored.topic or ""
+        if live.position != stored.position:
+            changes["position"] = stored.position
+        if kind == "channel" and not in_place(live, category):
+            changes["category"] = category
+            if category in created_categories:
+                depends.append(created_categories[category])
+
+        if permissions is None and not changes:
+            return
+
+        changed = list(changes) + (["overwrites"] if permissions is not None else [])
+        channel_ops.append(plan.add(ReconcileOperation(
+            "edit", kind, name, partial(edit_channel, live, permissions, **changes),
+            changes=changed, depends=depends, key=f"edit:{kind}:{live.id}"
+        )))
+
+    def reconcile_channel(channel: "TemplateChannel", category: Optional[int], index: int):
+        if channel.type not in (discord.ChannelType.text, discord.ChannelType.voice):
+            return
+
+        live = matches.get(channel)
+        if live is not None:
+            diff_channel(live, channel, "channel", channel.name, category=category)
+            return
+
+        depends = depends_for(channel.permissions)
+        if category in created_categories:
+            depends.append(created_categories[category])
+        channel_ops.append(plan.add(ReconcileOperation(
+            "create", "channel", channel.name, partial(create_channel, channel, category),
+            depends=depends, key=f"create:channel:{category}:{index}"
+        )))
+
+    for index, category in enumerate(categories):
+        live = matched_categories.get(index)
+        if live is None:
+            created_categories[index] = plan.add(ReconcileOperation(
+                "create", "category", category.name, partial(create_category, category),
+                depends=depends_for(category.permissions), key=f"create:category:{index}"
+            ))
+            channel_ops.append(created_categories[index])
+
+        else:
+            diff_channel(live, category, "category", category.name)
+
+        for child_index, child in enumerate(category.children):
+            reconcile_channel(child, index, child_index)
+
+    for index, channel in enumerate(channels):
+        reconcile_channel(channel, None, index)
+
+    # whatever is left over isn't part of the backup.
+    for channel in (live for candidates in live_channels.values() for live in candidates):
+        plan.add(ReconcileOperation(
+            "delete", "channel", channel.name, partial(channel.delete, reason=reason),
+            key=f"delete:channel:{channel.id}"
+        ))
+
+    for category in (live for candidates in live_categories.values() for live in candidates):
+        plan.add(ReconcileOperation(
+            "delete", "category", category.name, partial(category.delete, reason=reason),
+            key=f"delete:category:{category.id}"
+        ))
+
+    # roles are deleted last so overwrites pointing at them are replaced first.
+    for role in (live for candidates in live_roles.values() for live in candidates):
+        plan.add(ReconcileOperation(
+            "delete", "role", role.name, partial(role.delete, reason=reason),
+            depends=channel_ops, key=f"delete:role:{role.id}"
+        ))
+
+    return plan
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import Executor
+from typing import TYPE_CHECKING, Awaitable, Callable, List, Optional, Set, Tuple
+
+import discord
+
+from .instrumentation import phase, record_api_call
+
+if TYPE_CHECKING:
+    from .cache import AssetCache
+    from .journal import RestoreJournal
+    from .models import TemplateChannel
+
+log = logging.getLogger("red.vcraycogs.serverbackup.replay")
+
+ProgressCallback = Callable[["MessageReplayer"], Awaitable[None]]
+
+
+class MessageReplayer:
+    """
+    Replays stored messages into restored channels through webhooks.
+
+    Each channel gets one webhook that is reused for all of its messages, the author's
+    name and avatar are passed with every send instead of editing the webhook.
+    Messages in a channel are sent in order, while up to `concurrency` channels replay at once.
+    A channel's messages are only decoded, in `executor`, once it starts replaying."""
+    def __init__(
+        self,
+        *,
+        cache: Optional["AssetCache"] = None,
+        concurrency: int = 3,
+        webhook_name: str = "Server Backup",
+        reuse_existing: bool = False,
+        journal: Optional["RestoreJournal"] = None,
+        executor: Optional[Executor] = None
+    ) -> None:
+        self.cache = cache
+        self.journal = journal # messages already replayed according to it are skipped
+        self.reuse_existing = reuse_existing # look for an existing webhook first, not needed for channels that were just created
+        self.concurrency = max(concurrency, 1)
+        self.webhook_name = webhook_name
+        self.executor = executor
+        # channel, the stored channel its messages come from, how many of them were already replayed and the journal key
+        self.queues: List[Tuple[discord.TextChannel, "TemplateChannel", int, Optional[str]]] = []
+        self._reuse: Set[int] = set()
+        self.sent = 0
+        self.failed = 0
+        self.task: Optional[asyncio.Task] = None
+        self.status_channel: Optional[discord.TextChannel] = None # where progress can be reported, set by the restore
+
+    @property
+    def total(self):
+        return sum(source.message_count - skip for _, source, skip, _ in self.queues)
+
+    @property
+    def done(self):
+        return self.task is not None and self.task.done()
+
+    def add(self, channel: discord.TextChannel, source: "TemplateChannel", *, key: Optional[str] = None):
+        """
+        Queue the messages of a stored channel for a channel, `key` identifies the channel in the journal."""
+        skip = 0
+        if self.journal is not None and key is not None:
+            skip = self.journal.replayed.get(key, 0)
+            if key in self.journal.replayed:
+                # this channel already got some messages, its webhook may still be there.
+                self._reuse.add(channel.id)
+        if source.message_count > skip:
+            self.queues.append((channel, source, skip, key))
+
+    async def _get_webhook(self, channel: discord.TextChannel) -> discord.Webhook:
+        if self.reuse_existing or channel.id in self._reuse:
+            # a channel that wasn't recreated may already have one from an earlier restore.
+            record_api_call()
+            for webhook in await channel.webhooks():
+                if webhook.name == self.webhook_name and webhook.token:
+                    return webhook
+
+        record_api_call()
+        return await channel.create_webhook(name=self.webhook_name)
+
+    async def _replay_channel(self, channel: discord.TextChannel, source: "TemplateChannel", skip: int, key: Optional[str], semaphore: asyncio.Semaphore, progress: Optional[ProgressCallback]):
+        done = skip
+        async with semaphore:
+            try:
+                with phase("replay:webhooks"):
+                    webhook = await self._get_webhook(channel)
+            except discord.HTTPException as e:
+                log.warning("Couldn't get a webhook for channel %s, skipping its messages.", channel.id, exc_info=e)
+                self.failed += source.message_count - skip
+                return
+
+            # decoded off the event loop and only while this channel replays, so they're freed after it.
+            messages = await asyncio.get_running_loop().run_in_executor(self.executor, source.decode_messages)
+            try:
+                for msg in messages[skip:]:
+                    files, urls = await msg.cached_files(self.cache)
+                    try:
+                        with phase("replay:messages"):
+                            record_api_call()
+                            await webhook.send(
+                                content=msg.content + "\n".join(urls),
+                                embeds=msg.embeds,
+                                files=files,
+                                username=msg.author,
+                                avatar_url=msg.author_avatar_url,
+                            )
+                        self.sent += 1
+                    except discord.HTTPException as e:
+                        log.debug("Couldn't replay a message in channel %s.", channel.id, exc_info=e)
+                        self.failed += 1
+
+                    if self.journal is not None and key is not None:
+                        done += 1
+                        await self.journal.record_replayed(key, done)
+
+                    if progress is not None:
+                        await progress(self)
+            finally:
+                if self.journal is not None and key is not None:
+                    # the journal only checkpoints every few messages, the rest are saved once the channel is done or stopped.
+                    await asyncio.shield(self.journal.flush())
+
+    async def run(self, progress: Optional[ProgressCallback] = None):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        start = time.perf_counter()
+        await asyncio.gather(*(self._replay_channel(channel, source, skip, key, semaphore, progress) for channel, source, skip, key in self.queues))
+        log.debug("Replayed %s messages (%s failed) in %.2fs.", self.sent, self.failed, time.perf_counter() - start)
+
+    def start(self, progress: Optional[ProgressCallback] = None) -> asyncio.Task:
+        """
+        Run the replay in the background and return its task."""
+        self.task = asyncio.create_task(self.run(progress))
+        return self.task
@@ -0,0 +1,117 @@
+import asyncio
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+from .instrumentation import phase, record_api_call
+
+if TYPE_CHECKING:
+    from .journal import RestoreJournal
+
+
+class StepAborted(Exception):
+    """
+    Raised by steps that didn't start because another step failed."""
+
+
+class RestoreStep:
+    def __init__(self, key: str, func: Callable[[], Awaitable[Any]], depends: Iterable[str] = (), track: bool = True) -> None:
+        self.key = key
+        self.func = func # called with no arguments, results of other steps are read from the scheduler
+        self.depends: List[str] = list(depends)
+        # "create:role:3" is recorded under the "create:role" phase. untracked steps don't talk to discord.
+        self.phase: Optional[str] = ":".join(key.split(":")[:2]) if track else None
+
+    def __repr__(self) -> str:
+        return f"<RestoreStep key={self.key!r} depends={self.depends!r}>"
+
+
+class RestoreScheduler:
+    """
+    Runs restore steps as a dependency graph.
+
+    A step starts as soon as every step it depends on has finished,
+    and at most `concurrency` steps talk to discord at the same time.
+    With a journal, finished steps are checkpointed and steps it already has are skipped."""
+    def __init__(self, concurrency: int = 5, *, journal: Optional["RestoreJournal"] = None) -> None:
+        self.concurrency = max(concurrency, 1)
+        self.journal = journal
+        self.steps: Dict[str, RestoreStep] = {}
+        self.results: Dict[str, Any] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._failed: Optional[BaseException] = None
+
+    def __len__(self):
+        return len(self.steps)
+
+    def add(self, key: str, func: Callable[[], Awaitable[Any]], *, depends: Iterable[str] = (), track: bool = True) -> str:
+        if key in self.steps:
+            raise ValueError(f"A step with the key {key!r} was already added.")
+
+        depends = [dep for dep in depends if dep is not None]
+        for dep in depends:
+            if dep not in self.steps:
+                # steps can only depend on steps that already exist, which also rules out cycles.
+                raise ValueError(f"Step {key!r} depends on unknown step {dep!r}.")
+
+        self.steps[key] = RestoreStep(key, func, depends, track)
+        return key
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self.results.get(key, default)
+
+    async def _run_step(self, step: RestoreStep, semaphore: asyncio.Semaphore):
+        if step.depends:
+            await asyncio.gather(*(self._tasks[dep] for dep in step.depends))
+
+        if self.journal is not None and self.journal.is_done(step.key):
+            result = self.journal.resolve(step.key)
+            # a step whose role or channel was deleted since has to run again.
+            if result is not None or self.journal.done[step.key] is None:
+                self.results[step.key] = result
+                return result
+
+        async with semaphore:
+            if self._failed is not None:
+                raise StepAborted(step.key)
+            if step.phase is None:
+                result = await step.func()
+            else:
+                with phase(step.phase):
+                    result = await step.func()
+                    record_api_call()
+
+        self.results[step.key] = result
+        if self.journal is not None:
+            # shielded so a cancelled restore still checkpoints a request that already went through.
+            await asyncio.shield(self.journal.record(step.key, result))
+        return result
+
+    async def run(self, *, concurrency: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Run every added step and return the results keyed by step key.
+
+        If a step fails, steps that already sent their request are left to finish,
+        the others don't start and the exception is raised."""
+        semaphore = asyncio.Semaphore(concurrency or self.concurrency)
+        self._failed = None
+        # steps are added in dependency order so the tasks they wait on always exist.
+        for key, step in self.steps.items():
+            self._tasks[key] = asyncio.ensure_future(self._run_step(step, semaphore))
+
+        try:
+            await asyncio.gather(*self._tasks.values())
+
+        except Exception as e:
+            self._failed = e
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+            raise
+
+        except BaseException:
+            for task in self._tasks.values():
+                task.cancel()
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+            raise
+
+        finally:
+            self._tasks.clear()
+
+        return self.results
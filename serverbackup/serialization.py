@@ -0,0 +1,134 @@
+import asyncio
+import json
+import struct
+import zlib
+from concurrent.futures import Executor
+from functools import partial
+from typing import Any, Callable, Optional, Tuple, Union
+
+from .models import Template, TemplateCategory, TemplateChannel, TemplateMessage, TemplateRole
+
+# Every encoded backup starts with MAGIC, the schema version and a flags byte.
+# Bump SCHEMA_VERSION whenever the layout of `Template.compact` changes
+# and teach `decode` how to read the older version.
+MAGIC = b"SBK"
+SCHEMA_VERSION = 3 # 2: messages store the hashes of cached attachments, 3: chunked manifests
+HEADER = struct.Struct(">3sBB")
+
+FLAG_COMPRESSED = 0x01
+FLAG_CHUNKED = 0x02 # the payload is a manifest of chunks, see `chunks`
+
+
+def _pack(compact: list, flags: int, compress: bool) -> bytes:
+    payload = json.dumps(compact, separators=(",", ":")).encode()
+    if compress:
+        payload = zlib.compress(payload)
+        flags |= FLAG_COMPRESSED
+
+    return HEADER.pack(MAGIC, SCHEMA_VERSION, flags) + payload
+
+
+def _unpack(data: Union[bytes, bytearray, memoryview]) -> Tuple[int, list]:
+    if not is_encoded(data):
+        raise ValueError("Data is not an encoded backup.")
+
+    data = bytes(data)
+    _, version, flags = HEADER.unpack_from(data)
+    if version > SCHEMA_VERSION:
+        raise ValueError(f"Backup uses schema version {version} but only up to {SCHEMA_VERSION} is supported.")
+
+    payload = data[HEADER.size:]
+    if flags & FLAG_COMPRESSED:
+        payload = zlib.decompress(payload)
+
+    return flags, json.loads(payload)
+
+
+def encode(template: Template, *, compress: bool = True) -> bytes:
+    return _pack(template.compact, 0, compress)
+
+
+def encode_manifest(manifest: list, *, compress: bool = True) -> bytes:
+    return _pack(manifest, FLAG_CHUNKED, compress)
+
+
+def is_encoded(data: Union[bytes, dict]) -> bool:
+    return isinstance(data, (bytes, bytearray, memoryview)) and bytes(data[:len(MAGIC)]) == MAGIC
+
+
+def is_chunked(data: Union[bytes, dict]) -> bool:
+    return is_encoded(data) and bool(data[len(MAGIC) + 1] & FLAG_CHUNKED)
+
+
+def decode(data: Union[bytes, dict], *, lazy: bool = False) -> Template:
+    """
+    Decode a backup made by `encode`.
+
+    Dicts are treated as the old `Template.json` layout, so backups made
+    before the compact encoding existed can still be read.
+    With `lazy`, messages are only decoded once they're used, see `Template.from_compact`."""
+    if isinstance(data, dict):
+        return Template.from_json(data)
+
+    flags, compact = _unpack(data)
+    if flags & FLAG_CHUNKED:
+        raise ValueError("Backup is a manifest of chunks, it has to be read through `chunks.ChunkedBackups`.")
+
+    return Template.from_compact(compact, lazy=lazy)
+
+
+def validate(data: dict):
+    """
+    Check a backup in the `Template.json` layout on every level without building anything from it.
+
+    Raises ValueError saying which part is invalid."""
+    if not isinstance(data, dict) or not Template.verify_json(data):
+        raise ValueError("Invalid json for Template")
+
+    def channel(entry: dict, where: str):
+        if not isinstance(entry, dict) or not TemplateChannel.verify_json(entry):
+            raise ValueError(f"Invalid json for {where}")
+        for index, message in enumerate(entry.get("last_messages", [])):
+            if not isinstance(message, dict) or not TemplateMessage.verify_json(message):
+                raise ValueError(f"Invalid json for message {index} of {where}")
+
+    for index, role in enumerate(data["roles"]):
+        if not isinstance(role, dict) or not TemplateRole.verify_json(role):
+            raise ValueError(f"Invalid json for role {index}")
+
+    for index, entry in enumerate(data["channels"]):
+        if isinstance(entry, dict) and entry.get("children") is not None:
+            if not TemplateCategory.verify_json(entry):
+                raise ValueError(f"Invalid json for category {index}")
+            for child_index, child in enumerate(entry["children"]):
+                channel(child, f"channel {child_index} of category {index}")
+        else:
+            channel(entry, f"channel {index}")
+
+
+async def run_in_executor(func: Callable[..., Any], *args, executor: Optional[Executor] = None, **kwargs) -> Any:
+    """
+    Run `func` in `executor`, the loop's default thread pool if it's None, so it doesn't block the event loop.
+
+    Templates hold discord.py enums that can't be pickled, so this is meant for thread pools."""
+    return await asyncio.get_running_loop().run_in_executor(executor, partial(func, *args, **kwargs))
+
+
+async def encode_async(template: Template, *, compress: bool = True, executor: Optional[Executor] = None) -> bytes:
+    return await run_in_executor(encode, template, compress=compress, executor=executor)
+
+
+async def decode_async(data: Union[bytes, dict], *, lazy: bool = False, executor: Optional[Executor] = None) -> Template:
+    return await run_in_executor(decode, data, lazy=lazy, executor=executor)
+
+
+async def validate_async(data: dict, *, executor: Optional[Executor] = None):
+    await run_in_executor(validate, data, executor=executor)
+
+
+def decode_manifest(data: Union[bytes, bytearray, memoryview]) -> list:
+    flags, manifest = _unpack(data)
+    if not flags & FLAG_CHUNKED:
+        raise ValueError("Backup is not a manifest of chunks.")
+    return manifest
+
@@ -0,0 +1,250 @@
+import abc
+import asyncio
+import os
+import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import AsyncIterator, Dict, Iterable, List, Optional
+
+_VALID_ID = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+def _check_id(id: str):
+    if not _VALID_ID.match(id):
+        raise ValueError(f"Invalid backup id: {id!r}")
+    return id
+
+
+class BackupStore(abc.ABC):
+    """
+    Where encoded backups are kept.
+
+    Every method only touches the backup it's given so the cost of reading or
+    writing one backup doesn't depend on how many others are stored.
+    Blocking IO runs in a single worker thread to keep it off the event loop."""
+    name: str
+
+    def __init__(self) -> None:
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"serverbackup-{self.name}")
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def get(self, id: str) -> Optional[bytes]:
+        return await self._run(self._get, _check_id(id))
+
+    async def put(self, id: str, data: bytes):
+        await self._run(self._put, _check_id(id), bytes(data))
+
+    async def delete(self, id: str) -> bool:
+        return await self._run(self._delete, _check_id(id))
+
+    async def size(self, id: str) -> Optional[int]:
+        """
+        Size of a stored backup on disk in bytes, None if it doesn't exist."""
+        return await self._run(self._size, _check_id(id))
+
+    async def ids(self) -> List[str]:
+        return await self._run(self._ids)
+
+    async def get_many(self, ids: Iterable[str]) -> Dict[str, bytes]:
+        """
+        Read several entries at once, ids that don't exist are left out."""
+        return await self._run(self._get_many, [_check_id(id) for id in ids])
+
+    async def put_many(self, items: Dict[str, bytes]):
+        await self._run(self._put_many, {_check_id(id): bytes(data) for id, data in items.items()})
+
+    async def delete_many(self, ids: Iterable[str]):
+        await self._run(self._delete_many, [_check_id(id) for id in ids])
+
+    async def total_size(self) -> int:
+        """
+        Bytes used by everything in the store."""
+        return await self._run(self._total_size)
+
+    async def stream(self, id: str, chunk_size: int = 64 * 1024) -> AsyncIterator[bytes]:
+        """
+        Read a backup in chunks of at most `chunk_size` bytes."""
+        _check_id(id)
+        offset = 0
+        while True:
+            chunk = await self._run(self._read, id, offset, chunk_size)
+            if not chunk:
+                return
+            yield chunk
+            offset += len(chunk)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    @abc.abstractmethod
+    def _get(self, id: str) -> Optional[bytes]:
+        ...
+
+    @abc.abstractmethod
+    def _put(self, id: str, data: bytes):
+        ...
+
+    @abc.abstractmethod
+    def _delete(self, id: str) -> bool:
+        ...
+
+    @abc.abstractmethod
+    def _size(self, id: str) -> Optional[int]:
+        ...
+
+    @abc.abstractmethod
+    def _ids(self) -> List[str]:
+        ...
+
+    @abc.abstractmethod
+    def _read(self, id: str, offset: int, length: int) -> bytes:
+        ...
+
+    # backends can do these in one go, by default they're just loops.
+    def _get_many(self, ids: List[str]) -> Dict[str, bytes]:
+        return {id: data for id in ids if (data := self._get(id)) is not None}
+
+    def _put_many(self, items: Dict[str, bytes]):
+        for id, data in items.items():
+            self._put(id, data)
+
+    def _delete_many(self, ids: List[str]):
+        for id in ids:
+            self._delete(id)
+
+    def _total_size(self) -> int:
+        return sum(self._size(id) or 0 for id in self._ids())
+
+
+class SQLiteBackupStore(BackupStore):
+    name = "sqlite"
+
+    def __init__(self, path: Path) -> None:
+        super().__init__()
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS backups (id TEXT PRIMARY KEY, data BLOB NOT NULL)")
+
+    def _get(self, id):
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM backups WHERE id = ?", (id,)).fetchone()
+        return row[0] if row else None
+
+    def _put(self, id, data):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO backups (id, data) VALUES (?, ?)", (id, data))
+
+    def _delete(self, id):
+        with self._lock, self._conn:
+            return self._conn.execute("DELETE FROM backups WHERE id = ?", (id,)).rowcount > 0
+
+    def _size(self, id):
+        with self._lock:
+            row = self._conn.execute("SELECT length(data) FROM backups WHERE id = ?", (id,)).fetchone()
+        return row[0] if row else None
+
+    def _ids(self):
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT id FROM backups")]
+
+    def _read(self, id, offset, length):
+        # substr is 1-indexed and only copies the requested part of the blob.
+        with self._lock:
+            row = self._conn.execute("SELECT substr(data, ?, ?) FROM backups WHERE id = ?", (offset + 1, length, id)).fetchone()
+        return row[0] if row else b""
+
+    def _get_many(self, ids):
+        found = {}
+        with self._lock:
+            # sqlite limits how many parameters one query can have
+            for start in range(0, len(ids), 500):
+                batch = ids[start:start + 500]
+                query = f"SELECT id, data FROM backups WHERE id IN ({','.join('?' * len(batch))})"
+                found.update(self._conn.execute(query, batch))
+        return found
+
+    def _put_many(self, items):
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO backups (id, data) VALUES (?, ?)", items.items())
+
+    def _delete_many(self, ids):
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM backups WHERE id = ?", ((id,) for id in ids))
+
+    def _total_size(self):
+        with self._lock:
+            return self._conn.execute("SELECT coalesce(sum(length(data)), 0) FROM backups").fetchone()[0]
+
+    def close(self):
+        super().close()
+        self._conn.close()
+
+
+class FileBackupStore(BackupStore):
+    name = "file"
+
+    def __init__(self, path: Path) -> None:
+        super().__init__()
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def _file(self, id: str) -> Path:
+        return self.path / f"{id}.sbk"
+
+    def _get(self, id):
+        try:
+            return self._file(id).read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def _put(self, id, data):
+        # write then rename so a crash never leaves half a backup behind.
+        tmp = self._file(id).with_suffix(".tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, self._file(id))
+
+    def _delete(self, id):
+        try:
+            self._file(id).unlink()
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _size(self, id):
+        try:
+            return self._file(id).stat().st_size
+        except FileNotFoundError:
+            return None
+
+    def _ids(self):
+        return [file.stem for file in self.path.glob("*.sbk")]
+
+    def _read(self, id, offset, length):
+        try:
+            with self._file(id).open("rb") as f:
+                f.seek(offset)
+                return f.read(length)
+        except FileNotFoundError:
+            return b""
+
+
+BACKENDS = {
+    SQLiteBackupStore.name: lambda data_path: SQLiteBackupStore(data_path / "backups.sqlite3"),
+    FileBackupStore.name: lambda data_path: FileBackupStore(data_path / "backups"),
+}
+
+
+def open_store(backend: str, data_path: Path) -> BackupStore:
+    try:
+        factory = BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f"Unknown backup storage backend: {backend!r}") from None
+
+    return factory(Path(data_path))
@@ -0,0 +1,341 @@
+import datetime
+import gzip
+import json
+import zlib
+from concurrent.futures import Executor
+from pathlib import Path
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+import discord
+
+from . import serialization
+from .chunks import ChunkedBackups
+from .models import Template, TemplateCategory, TemplateChannel, TemplateMessage, TemplateRole
+
+# Backups are exported as gzipped json lines: a header line, one line per role, category and
+# channel in the order `ChunkedBackups.iter_backup` yields them, and an end line with the counts
+# and hash of everything before it. Each line is written and read on its own, so neither side
+# ever holds the whole backup. Since version 2 a channel's messages come in messages lines right
+# before it, as many as it takes to keep every line under `MAX_LINE`.
+FORMAT = "serverbackup"
+VERSION = 2
+MAX_LINE = 16 * 1024 * 1024
+
+_GZIP_MAGIC = b"\x1f\x8b"
+
+
+def _line(data: dict, *, max_line: int = MAX_LINE) -> bytes:
+    line = json.dumps(data, separators=(",", ":")).encode() + b"\n"
+    if len(line) > max_line:
+        raise ValueError(f"A {data['kind']} line is longer than {max_line} bytes.")
+    return line
+
+
+def _message_lines(messages: List[dict], *, max_line: int = MAX_LINE) -> Iterator[bytes]:
+    # as many messages as fit go on each line
+    head, tail = b'{"kind":"messages","messages":[', b"]}\n"
+    batch, size = [], len(head) + len(tail)
+    for message in messages:
+        data = json.dumps(message, separators=(",", ":")).encode()
+        if len(head) + len(data) + len(tail) > max_line:
+            raise ValueError(f"A message is longer than {max_line} bytes.")
+        if batch and size + len(data) + 1 > max_line:
+            yield head + b",".join(batch) + tail
+            batch, size = [], len(head) + len(tail)
+        batch.append(data)
+        size += len(data) + 1
+    if batch:
+        yield head + b",".join(batch) + tail
+
+
+async def export_lines(backups: ChunkedBackups, id: str, *, max_line: int = MAX_LINE) -> AsyncIterator[bytes]:
+    """
+    The lines of an exported backup, nothing is yielded if it doesn't exist.
+
+    No line is longer than `max_line`, a channel's messages are split over as many lines as that takes."""
+    role_hashes: List[str] = []
+    channel_hashes: List[str] = []
+    category: Optional[Tuple[TemplateCategory, List[str]]] = None # the open category and its channels' hashes
+    channel_count = 0
+    found = False
+
+    def close_category():
+        nonlocal category
+        if category is not None:
+            channel_hashes.append(category[0].hash_with(category[1]))
+            category = None
+
+    async for kind, item in backups.iter_backup(id):
+        if kind == "header":
+            found = True
+            yield _line({
+                "kind": "header",
+                "format": FORMAT,
+                "version": VERSION,
+                "id": item.id,
+                "created_at": item.created_at.timestamp(),
+                "original_guild_id": item.original_guild_id,
+                "owner": item.owner,
+                "uses": item.uses,
+            })
+        elif kind == "role":
+            role_hashes.append(item.content_hash)
+            yield _line({"kind": "role", **item.json})
+        elif kind == "category":
+            close_category()
+            category = (item, [])
+            channel_count += 1
+            data = item.json
+            del data["children"]
+            yield _line({"kind": "category", **data})
+        else:
+            if kind == "child":
+                category[1].append(item.content_hash)
+            else:
+                close_category()
+                channel_hashes.append(item.content_hash)
+            channel_count += 1
+            data = item.json
+            for line in _message_lines(data["last_messages"], max_line=max_line):
+                yield line
+            data["last_messages"] = []
+            yield _line({"kind": "channel", "category": kind == "child", **data}, max_line=max_line)
+
+    if found:
+        close_category()
+        yield _line({"kind": "end", "roles": len(role_hashes), "channels": channel_count, "hash": Template.hash_of(role_hashes, channel_hashes)})
+
+
+async def export_to_file(backups: ChunkedBackups, id: str, path: Path, *, executor: Optional[Executor] = None) -> int:
+    """
+    Export a backup to a gzipped file at `path` and return its size."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with gzip.open(path, "wb") as f:
+        # compressing is done in the executor, a line can be a whole channel's history.
+        async for line in export_lines(backups, id):
+            await serialization.run_in_executor(f.write, line, executor=executor)
+    return path.stat().st_size
+
+
+async def iter_lines(chunks: AsyncIterator[bytes], *, max_line: int = MAX_LINE) -> AsyncIterator[bytes]:
+    """
+    Split a stream of bytes into lines, decompressing it first if it's gzipped.
+
+    Lines longer than `max_line` raise ValueError instead of being buffered."""
+    decompress = None
+    buffer = bytearray()
+    first = True
+
+    def split(data: bytes) -> List[bytes]:
+        # only the new data is searched, a long line isn't scanned again for every piece of it.
+        start, lines = 0, []
+        search = len(buffer)
+        buffer.extend(data)
+        while (end := buffer.find(b"\n", search)) != -1:
+            if end - start > max_line:
+                raise ValueError(f"A line is longer than {max_line} bytes.")
+            lines.append(bytes(buffer[start:end]))
+            start = search = end + 1
+        del buffer[:start]
+        if len(buffer) > max_line:
+            raise ValueError(f"A line is longer than {max_line} bytes.")
+        return lines
+
+    async for chunk in chunks:
+        if first:
+            first = False
+            if chunk[:2] == _GZIP_MAGIC:
+                decompress = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if decompress is None:
+            for line in split(chunk):
+                yield line
+            continue
+        # a small compressed chunk can hold a lot, it's decompressed a bit at a time.
+        while chunk:
+            data = decompress.decompress(chunk, 64 * 1024)
+            chunk = decompress.unconsumed_tail
+            for line in split(data):
+                yield line
+
+    if decompress is not None and not decompress.eof:
+        raise ValueError("The file was cut off.")
+    if buffer:
+        yield bytes(buffer)
+
+
+# the types each kind of line's fields can have, so a file that was edited by hand can't store
+# something a restore chokes on later.
+_NONE = type(None)
+_FIELDS: Dict[str, Dict[str, Tuple[type, ...]]] = {
+    "header": {"format": (str,), "version": (int,), "created_at": (int, float, _NONE), "original_guild_id": (int, _NONE), "owner": (int, _NONE), "uses": (int,)},
+    "role": {"name": (str,), "color": (int,), "hoist": (bool,), "permissions": (int,), "mentionable": (bool,), "is_everyone": (bool,), "position": (int,)},
+    "category": {"name": (str,), "position": (int,), "permissions": (dict,)},
+    "channel": {"name": (str,), "topic": (str, _NONE), "type": (str,), "permissions": (dict,), "position": (int,), "last_messages": (list,), "category": (bool,)},
+    "messages": {"messages": (list,)},
+    "message": {"author": (str,), "author_avatar_url": (str, _NONE), "content": (str, _NONE), "embeds": (list,), "attachments": (list,)},
+    "end": {"roles": (int,), "channels": (int,), "hash": (str,)},
+}
+_OPTIONAL: Dict[str, Tuple[str, ...]] = {
+    "header": ("format", "version", "created_at", "original_guild_id", "owner", "uses"),
+    "channel": ("category",),
+}
+
+
+def _check(data, fields: Dict[str, Tuple[type, ...]], what: str, *, optional: Tuple[str, ...] = ()):
+    if not isinstance(data, dict):
+        raise ValueError(f"{what} isn't a json object.")
+    for name, types in fields.items():
+        if name not in data:
+            if name in optional:
+                continue
+            raise ValueError(f"{what} has no {name}.")
+        value = data[name]
+        # bools are ints to python but not to anything reading the backup
+        if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+            expected = " or ".join("null" if t is _NONE else t.__name__ for t in types)
+            raise ValueError(f"{what}'s {name} should be {expected}, not {type(value).__name__}.")
+
+
+def _check_items(items, types: Tuple[type, ...], what: str):
+    for index, item in enumerate(items):
+        if not isinstance(item, types):
+            raise ValueError(f"{what} {index} should be {types[0].__name__}, not {type(item).__name__}.")
+
+
+def _check_overwrites(overwrites: dict, what: str):
+    for target, overwrite in overwrites.items():
+        if not isinstance(overwrite, dict) or not all(isinstance(v, (bool, _NONE)) for v in overwrite.values()):
+            raise ValueError(f"{what}'s overwrite for {target} should map permissions to true, false or null.")
+
+
+def _check_message(message, what: str):
+    _check(message, _FIELDS["message"], what)
+    _check_items(message["embeds"], (dict,), f"{what}'s embed")
+    _check_items(message["attachments"], (str,), f"{what}'s attachment")
+    files = message.get("files", {})
+    if not isinstance(files, dict) or not all(isinstance(v, str) for v in files.values()):
+        raise ValueError(f"{what}'s files should map urls to hashes.")
+
+
+def _parse(line: bytes):
+    data = json.loads(line)
+    if not isinstance(data, dict):
+        raise ValueError("Expected a json object.")
+    kind = data.pop("kind", None)
+    if kind not in _FIELDS or kind == "message":
+        raise ValueError(f"Unknown line type {kind!r}.")
+    # the header's fields are checked against the format and version by import_lines
+    _check(data, _FIELDS[kind], f"The {kind}", optional=_OPTIONAL.get(kind, ()))
+
+    if kind == "role":
+        return kind, TemplateRole.from_json(data)
+    if kind == "category":
+        _check_overwrites(data["permissions"], "The category")
+        return kind, TemplateCategory.from_json({**data, "children": []})
+    if kind == "channel":
+        _check_overwrites(data["permissions"], "The channel")
+        if data["type"] not in discord.ChannelType.__members__:
+            raise ValueError(f"The channel's type {data['type']!r} isn't a channel type.")
+        for index, message in enumerate(data["last_messages"]):
+            _check_message(message, f"Message {index}")
+        in_category = data.pop("category", False)
+        return kind, (TemplateChannel.from_json(data), in_category)
+    if kind == "messages":
+        for index, message in enumerate(data["messages"]):
+            _check_message(message, f"Message {index}")
+        return kind, [TemplateMessage.from_json(m) for m in data["messages"]]
+    if kind == "header" and data.get("created_at") is not None:
+        try:
+            data["created_at"] = datetime.datetime.fromtimestamp(data["created_at"])
+        except (OverflowError, OSError) as e:
+            raise ValueError("The header's created_at isn't a valid time.") from e
+    return kind, data
+
+
+async def import_lines(
+    backups: ChunkedBackups,
+    chunks: AsyncIterator[bytes],
+    *,
+    owner: discord.abc.Snowflake,
+    max_line: int = MAX_LINE,
+    executor: Optional[Executor] = None,
+) -> dict:
+    """
+    Store a backup from an exported file, read from `chunks` as it comes in.
+
+    The backup gets a new id and belongs to `owner`. Every line is checked as it's read,
+    and the backup is only stored once the end line's counts and hash match what came
+    before it, otherwise ValueError is raised and nothing is kept. Returns the backup's
+    index entry."""
+    lines = iter_lines(chunks, max_line=max_line)
+    writer = None
+    number = 0
+    # digests and hashes of the messages lines since the last channel, they belong to the next one
+    messages: Optional[Tuple[List[str], List[str]]] = None
+    try:
+        async for line in lines:
+            number += 1
+            if not line.strip():
+                continue
+            try:
+                kind, item = await serialization.run_in_executor(_parse, line, executor=executor)
+            except (KeyError, TypeError, ValueError) as e:
+                raise ValueError(f"Line {number} is invalid: {e}") from e
+
+            if writer is None:
+                if kind != "header" or item.get("format") != FORMAT:
+                    raise ValueError("This isn't an exported backup.")
+                if not isinstance(item.get("version"), int) or item["version"] > VERSION:
+                    raise ValueError(f"This backup was exported with version {item.get('version')} but only up to {VERSION} is supported.")
+                writer = backups.writer(Template(
+                    created_at=item.get("created_at") or datetime.datetime.now(),
+                    original_guild_id=item.get("original_guild_id"),
+                    owner=owner.id,
+                ))
+                continue
+
+            if kind == "header":
+                raise ValueError(f"Line {number} is a second header.")
+            if kind == "messages":
+                digests, hashes = await writer.add_messages(item)
+                if messages is None:
+                    messages = ([], [])
+                messages[0].extend(digests)
+                messages[1].extend(hashes)
+                continue
+            if messages is not None and kind != "channel":
+                raise ValueError(f"Line {number} isn't the channel of the messages before it.")
+            if kind == "role":
+                if writer.channel_count:
+                    raise ValueError(f"Line {number} is a role after the channels.")
+                await writer.add_role(item)
+            elif kind == "category":
+                await writer.add_category(item)
+            elif kind == "channel":
+                channel, in_category = item
+                if messages is not None and channel.message_count:
+                    raise ValueError(f"Line {number} has messages of its own after messages lines.")
+                try:
+                    await writer.add_channel(channel, in_category=bool(in_category), messages=messages)
+                except ValueError as e:
+                    raise ValueError(f"Line {number}: {e}") from e
+                messages = None
+            else:
+                expected = (writer.role_count, writer.channel_count, writer.content_hash)
+                if (item.get("roles"), item.get("channels"), item.get("hash")) != expected:
+                    raise ValueError("The backup doesn't match its end line, it was changed or cut off.")
+                break
+        else:
+            raise ValueError("The file ended before the end of the backup." if writer is not None else "The file is empty.")
+
+        async for line in lines:
+            if line.strip():
+                raise ValueError("There's more after the end of the backup.")
+
+        size, stored = await writer.finish()
+    except BaseException:
+        if writer is not None:
+            await writer.abort()
+        raise
+
+    return {**writer.index_json, "size": size, "stored": stored}
@@ -12,6 +12,15 @@ def _overwrite_mapping_from_json(json: dict):
 def _overwrite_mapping_json(permissions: dict):
     return {k: {key: value for key, value in v} for k, v in permissions.items()}
 
+
+def _overwrite_mapping_compact(permissions: dict):
+    # [allow, deny] bitfields instead of a dict with every permission flag
+    return {k: [allow.value, deny.value] for k, (allow, deny) in ((k, v.pair()) for k, v in permissions.items())}
+
+
+def _overwrite_mapping_from_compact(compact: dict):
+    return {k: discord.PermissionOverwrite.from_pair(discord.Permissions(allow), discord.Permissions(deny)) for k, (allow, deny) in compact.items()}
+
 def valid_role_for_template(role: discord.Role):
     return all(
         [not role.is_bot_managed(), not role.is_default(), not role.is_integration(), not role.managed, not role.is_premium_subscriber(), not role.guild.me.top_role <= role]